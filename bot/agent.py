@@ -1,26 +1,207 @@
 import os
-from mistralai import Mistral
+import time
+from typing import List, Optional
+
 import discord
+import metrics
+from conversation_memory import ConversationMemory, Turn
+from llm_gateway import get_gateway, message_content
+from response_cache import ResponseCache
 
 MISTRAL_MODEL = "mistral-large-latest"
 SYSTEM_PROMPT = "You are a helpful assistant."
+SUMMARY_PROMPT = (
+    "Update the summary of a Discord conversation with the new messages below. "
+    "Keep facts, names and open questions the assistant may need later. "
+    "Answer with the summary only, in at most {words} words."
+)
+
+# Discord rejects messages longer than this
+MESSAGE_LIMIT = 2000
+
+DISCORD_SEND_TIME = metrics.histogram("discord_send_seconds", "Latency of Discord message sends and edits", ["kind"])
+FIRST_VISIBLE_TIME = metrics.histogram("agent_first_visible_seconds", "Time until the first text of a streamed reply is visible")
+
+
+def split_point(text: str, limit: int = MESSAGE_LIMIT) -> int:
+    """Index at which to cut ``text`` so the head fits in one message, preferring line then word breaks."""
+    if len(text) <= limit:
+        return len(text)
+    for separator in ("\n", " "):
+        index = text.rfind(separator, limit // 2, limit)
+        if index != -1:
+            return index + 1
+    return limit
+
+
+class StreamingReply:
+    """Shows a reply while it is being generated.
+
+    The first message is posted as soon as text arrives and then edited in place
+    at most once every ``edit_interval`` seconds, which keeps well inside
+    Discord's per-channel edit rate limit. Text past 2000 characters continues
+    in follow-up messages.
+    """
+
+    def __init__(self, message: discord.Message, edit_interval: float):
+        self.message = message
+        self.edit_interval = edit_interval
+        self.messages: List[discord.Message] = []
+        self.text = ""
+        self.shown = ""
+        self.last_edit = 0.0
+        self.first_visible_at: Optional[float] = None
+
+    async def _show(self) -> None:
+        # Discord rejects blank messages, so a new message waits for visible text
+        if self.text == self.shown or (not self.shown and not self.text.strip()):
+            return
+        if self.shown:
+            with DISCORD_SEND_TIME.labels("edit").time():
+                await self.messages[-1].edit(content=self.text)
+        elif self.messages:
+            with DISCORD_SEND_TIME.labels("send").time():
+                self.messages.append(await self.message.channel.send(self.text))
+        else:
+            with DISCORD_SEND_TIME.labels("reply").time():
+                self.messages.append(await self.message.reply(self.text))
+            self.first_visible_at = time.perf_counter()
+        self.shown = self.text
+        self.last_edit = time.monotonic()
+
+    async def feed(self, text: str) -> None:
+        """Add generated text, updating the visible reply if the throttle allows."""
+        self.text += text
+        while len(self.text) > MESSAGE_LIMIT:
+            cut = split_point(self.text)
+            rest = self.text[cut:]
+            self.text = self.text[:cut]
+            await self._show()
+            self.text, self.shown = rest, ""
+
+        # Post a new message (the first one or a continuation) right away, then throttle edits
+        if not self.shown or time.monotonic() - self.last_edit >= self.edit_interval:
+            await self._show()
+
+    async def finish(self) -> None:
+        """Show the complete text."""
+        await self._show()
 
-#mistral agent for the chatbot 
+
+#mistral agent for the chatbot
 class MistralAgent:
     def __init__(self):
-        MISTRAL_API_KEY = os.getenv("MISTRAL_API_KEY")
+        self.gateway = get_gateway()
+        self.streaming = os.getenv("AGENT_STREAMING", "1") != "0"
+        self.edit_interval = float(os.getenv("AGENT_EDIT_INTERVAL", "1.0"))
+        self.memory = ConversationMemory(summarize=self._summarize)
+        self.cache = ResponseCache()
 
-        self.client = Mistral(api_key=MISTRAL_API_KEY)
+        # Time from the start of a streamed reply until its first text is visible
+        self.streamed_replies = 0
+        self.total_first_visible = 0.0
+        self.max_first_visible = 0.0
 
-    async def run(self, message: discord.Message):
-        messages = [
-            {"role": "system", "content": SYSTEM_PROMPT},
+    @staticmethod
+    def _conversation_key(message: discord.Message) -> str:
+        return str(message.channel.id)
+
+    @staticmethod
+    def _cache_scope(message: discord.Message) -> str:
+        """Scope a cached reply is shared within: the guild, or the DM channel so no user sees another's answer."""
+        if message.guild is not None:
+            return str(message.guild.id)
+        return f"dm:{message.channel.id}"
+
+    def _context_free(self, message: discord.Message) -> bool:
+        """Whether a reply to this message is generated without earlier turns or a summary.
+
+        Only such replies are stored in the response cache, since they answer the
+        question alone; lookups then serve them in any conversation of the scope.
+        """
+        return not self.memory.has_context(self._conversation_key(message))
+
+    def _messages(self, message: discord.Message):
+        key = self._conversation_key(message)
+        system_prompt = SYSTEM_PROMPT
+        summary = self.memory.summary(key)
+        if summary:
+            system_prompt += f"\n\nSummary of the earlier conversation: {summary}"
+        return [
+            {"role": "system", "content": system_prompt},
+            *self.memory.history(key),
             {"role": "user", "content": message.content},
         ]
 
-        response = await self.client.chat.complete_async(
-            model=MISTRAL_MODEL,
-            messages=messages,
+    def _remember(self, message: discord.Message, reply: str) -> None:
+        key = self._conversation_key(message)
+        self.memory.append(key, "user", message.content)
+        self.memory.append(key, "assistant", reply)
+
+    async def _summarize(self, summary: str, turns: List[Turn]) -> str:
+        """Fold older turns of a conversation into its running summary."""
+        transcript = "\n".join(f"{role}: {content}" for role, content, _ in turns)
+        response = await self.gateway.chat(
+            "agent.summarize",
+            MISTRAL_MODEL,
+            [
+                {"role": "system", "content": SUMMARY_PROMPT.format(words=self.memory.summary_tokens * 3 // 4)},
+                {"role": "user", "content": f"Current summary: {summary or '(none)'}\n\nNew messages:\n{transcript}"},
+            ],
         )
+        return message_content(response)
+
+    async def run(self, message: discord.Message):
+        scope = self._cache_scope(message)
+        reply = self.cache.get(scope, message.content)
+        if reply is None:
+            context_free = self._context_free(message)
+            response = await self.gateway.chat(
+                "agent.run",
+                MISTRAL_MODEL,
+                self._messages(message),
+            )
+            reply = message_content(response)
+            if context_free:
+                self.cache.put(scope, message.content, reply)
+
+        self._remember(message, reply)
+        return reply
+
+    async def stream_reply(self, message: discord.Message) -> str:
+        """Reply to a message while the response streams in, returning the full text."""
+        started_at = time.perf_counter()
+        reply = StreamingReply(message, self.edit_interval)
+
+        # Repeated questions are answered from the cache without an LLM call
+        scope = self._cache_scope(message)
+        cached = self.cache.get(scope, message.content)
+        if cached is not None:
+            await reply.feed(cached)
+            await reply.finish()
+            self._remember(message, cached)
+            return cached
+
+        context_free = self._context_free(message)
+        full_text = []
+        try:
+            async for text in self.gateway.stream("agent.stream", MISTRAL_MODEL, self._messages(message)):
+                full_text.append(text)
+                await reply.feed(text)
+        except Exception:
+            if reply.messages:
+                await reply.feed("\n\n*(response interrupted)*")
+                await reply.finish()
+            raise
 
-        return response.choices[0].message.content
+        await reply.finish()
+        if context_free:
+            self.cache.put(scope, message.content, "".join(full_text))
+        self._remember(message, "".join(full_text))
+        if reply.first_visible_at is not None:
+            first_visible = reply.first_visible_at - started_at
+            self.streamed_replies += 1
+            self.total_first_visible += first_visible
+            self.max_first_visible = max(self.max_first_visible, first_visible)
+            FIRST_VISIBLE_TIME.observe(first_visible)
+        return "".join(full_text)
@@ -0,0 +1,258 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+import metrics
+
+# Setup logging
+logger = logging.getLogger("agent_pool")
+
+AGENT_QUEUE_WAIT = metrics.histogram("agent_queue_wait_seconds", "Time messages waited for an agent worker")
+AGENT_MESSAGES = metrics.counter(
+    "agent_messages", "Messages submitted to the agent pool by outcome (processed, error, rate_limited, shed)", ["outcome"]
+)
+
+RATE_LIMITED = "rate_limited"
+BUSY = "busy"
+
+DEFAULT_RATE_LIMITS = {"user": 6, "channel": 30, "guild": 60}
+
+
+def _parse_rate_limits(spec: str) -> Dict[str, int]:
+    """Parse a "scope=per_minute,scope=per_minute" string, keeping defaults for missing scopes."""
+    limits = dict(DEFAULT_RATE_LIMITS)
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        scope, _, limit = item.partition("=")
+        try:
+            limits[scope.strip()] = int(limit)
+        except ValueError:
+            logger.warning(f"Ignoring invalid rate limit: {item}")
+    return limits
+
+
+class TokenBucket:
+    """Allows ``capacity`` events at once, refilled continuously at ``rate`` tokens per second."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "notified_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        # Until when rejections by this bucket are not announced again
+        self.notified_until = 0.0
+
+    def refill(self, now: float) -> float:
+        """Add the tokens earned since the last update and return the balance."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+
+class AgentPool:
+    """Fixed pool of workers running agent replies from a bounded, fair queue.
+
+    Each message must pass token buckets for its user, channel and guild (limits
+    are per minute). Accepted messages are queued per guild (per user for DMs)
+    and workers take one message from each guild in turn, so one busy guild
+    can't starve the others. Messages are shed, with a cheap reply instead of an
+    LLM call, when the queue is full or when they waited longer than ``max_wait``.
+    A rate-limited message gets that reply at most once per bucket window (the
+    time the bucket takes to refill); later ones in the window are dropped
+    silently, so spamming the bot doesn't turn into one Discord send per message.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[Any], Awaitable[None]],
+        on_reject: Callable[[Any, str], Awaitable[None]],
+        workers: Optional[int] = None,
+        max_queue: Optional[int] = None,
+        max_wait: Optional[float] = None,
+        rate_limits: Optional[Dict[str, int]] = None,
+    ):
+        """Initialize the pool with limits taken from arguments or the environment."""
+        self.handler = handler
+        self.on_reject = on_reject
+        self.workers = workers or int(os.getenv("AGENT_WORKERS", "4"))
+        self.max_queue = max_queue or int(os.getenv("AGENT_MAX_QUEUE", "100"))
+        self.max_wait = max_wait or float(os.getenv("AGENT_MAX_WAIT", "30"))
+        if rate_limits is None:
+            rate_limits = _parse_rate_limits(os.getenv("AGENT_RATE_LIMITS", ""))
+        self.rate_limits = rate_limits
+
+        self._queues: "OrderedDict[str, Deque[Tuple[Any, float]]]" = OrderedDict()
+        self._depth = 0
+        self._ready: Optional[asyncio.Semaphore] = None
+        self._tasks = []
+        self._buckets: Dict[Tuple[str, str], TokenBucket] = {}
+
+        self.processed = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.shed = 0
+        self.busy_workers = 0
+        self.max_depth = 0
+        self._waits: Deque[float] = deque(maxlen=1000)
+
+    def start(self) -> None:
+        """Start the workers on the running event loop. Calling it again is a no-op."""
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._run_worker()) for _ in range(self.workers)]
+
+    def _ready_semaphore(self) -> asyncio.Semaphore:
+        """Return the semaphore counting queued messages, creating it on first use.
+
+        Messages submitted before ``start`` (e.g. before the bot is ready) wait in
+        the queue and are picked up once the workers run.
+        """
+        if self._ready is None:
+            self._ready = asyncio.Semaphore(0)
+        return self._ready
+
+    async def stop(self) -> None:
+        """Cancel the workers. Queued messages are dropped."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    @staticmethod
+    def _scopes(message) -> Dict[str, str]:
+        scopes = {"user": str(message.author.id), "channel": str(message.channel.id)}
+        if message.guild is not None:
+            scopes["guild"] = str(message.guild.id)
+        return scopes
+
+    def _acquire(self, scopes: Dict[str, str]) -> Optional[TokenBucket]:
+        """Take one token from every bucket of a message, or none if any is empty.
+
+        Returns None on success, else the empty bucket.
+        """
+        now = time.monotonic()
+        buckets = []
+        for scope, key in scopes.items():
+            limit = self.rate_limits.get(scope)
+            if not limit:
+                continue
+            bucket = self._buckets.get((scope, key))
+            if bucket is None:
+                bucket = self._buckets[(scope, key)] = TokenBucket(limit / 60, limit)
+            if bucket.refill(now) < 1:
+                return bucket
+            buckets.append(bucket)
+
+        for bucket in buckets:
+            bucket.tokens -= 1
+
+        # Full buckets carry no state, so forget them once there are many
+        if len(self._buckets) > 10000:
+            self._buckets = {key: bucket for key, bucket in self._buckets.items() if bucket.refill(now) < bucket.capacity}
+        return None
+
+    def _oldest_wait(self, now: float) -> float:
+        return max((now - queue[0][1] for queue in self._queues.values()), default=0.0)
+
+    async def submit(self, message) -> Optional[str]:
+        """Queue a message for the agent.
+
+        Returns None if it was queued, or the reason (RATE_LIMITED or BUSY) it was
+        rejected, after ``on_reject`` has replied (unless a rate-limit reply for
+        the same bucket was already sent in this window).
+        """
+        scopes = self._scopes(message)
+        reason = None
+        empty = self._acquire(scopes)
+        if empty is not None:
+            reason = RATE_LIMITED
+            self.rate_limited += 1
+            AGENT_MESSAGES.labels("rate_limited").inc()
+            now = time.monotonic()
+            if now < empty.notified_until:
+                return reason
+            empty.notified_until = now + empty.capacity / empty.rate
+        elif self._depth >= self.max_queue or self._oldest_wait(time.monotonic()) > self.max_wait:
+            reason = BUSY
+            self.shed += 1
+            AGENT_MESSAGES.labels("shed").inc()
+
+        if reason is not None:
+            await self.on_reject(message, reason)
+            return reason
+
+        lane = scopes.get("guild") or f"dm:{scopes['user']}"
+        self._queues.setdefault(lane, deque()).append((message, time.monotonic()))
+        self._depth += 1
+        self.max_depth = max(self.max_depth, self._depth)
+        self._ready_semaphore().release()
+        return None
+
+    def _next_job(self) -> Tuple[Any, float]:
+        """Pop the next message, taking guilds in round-robin order."""
+        lane, queue = next(iter(self._queues.items()))
+        job = queue.popleft()
+        if queue:
+            self._queues.move_to_end(lane)
+        else:
+            del self._queues[lane]
+        self._depth -= 1
+        return job
+
+    async def _run_worker(self) -> None:
+        while True:
+            await self._ready_semaphore().acquire()
+            message, enqueued_at = self._next_job()
+            wait = time.monotonic() - enqueued_at
+            self._waits.append(wait)
+            AGENT_QUEUE_WAIT.observe(wait)
+
+            if wait > self.max_wait:
+                self.shed += 1
+                AGENT_MESSAGES.labels("shed").inc()
+                try:
+                    await self.on_reject(message, BUSY)
+                except Exception as e:
+                    logger.error(f"Error replying to shed message: {e}")
+                continue
+
+            self.busy_workers += 1
+            try:
+                await self.handler(message)
+                self.processed += 1
+                AGENT_MESSAGES.labels("processed").inc()
+            except Exception as e:
+                self.errors += 1
+                AGENT_MESSAGES.labels("error").inc()
+                logger.error(f"Error running agent: {e}")
+            finally:
+                self.busy_workers -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Return queue depth, wait times and outcome counters."""
+        waits = sorted(self._waits)
+
+        def percentile(p: float) -> float:
+            return waits[min(len(waits) - 1, int(p * len(waits)))] if waits else 0.0
+
+        return {
+            "workers": self.workers,
+            "busy_workers": self.busy_workers,
+            "depth": self._depth,
+            "max_depth": self.max_depth,
+            "lanes": len(self._queues),
+            "oldest_wait": self._oldest_wait(time.monotonic()),
+            "wait_p50": percentile(0.5),
+            "wait_p95": percentile(0.95),
+            "wait_max": waits[-1] if waits else 0.0,
+            "processed": self.processed,
+            "errors": self.errors,
+            "rate_limited": self.rate_limited,
+            "shed": self.shed,
+        }
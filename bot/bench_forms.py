@@ -0,0 +1,356 @@
+"""Throughput and latency benchmark for the form pipeline (FormHandler + UserManager).
+
+Runs N simulated users concurrently through complete form sessions against a
+local Mistral stand-in server with configurable latency and failure rate, then
+reports per-turn latency percentiles, turns/sec, LLM calls per completed form
+and bytes written by the storage layer.
+
+    python bench_forms.py --users 200 --latency 0.3 --failure-rate 0.02 --output run.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+VALIDATION_RESPONSE = re.compile(r'User response: "(.*)"')
+
+
+class MistralStandIn:
+    """Local HTTP server answering /v1/chat/completions like the Mistral API.
+
+    Every request waits ``latency`` seconds (+/- ``jitter``), or ``slow_latency``
+    with probability ``slow_rate``, and fails with a 503 with probability
+    ``failure_rate``. Validation prompts get a JSON verdict
+    accepting the answer; ``"stream": true`` requests get server-sent events.
+    """
+
+    def __init__(
+        self,
+        latency: float,
+        jitter: float,
+        failure_rate: float,
+        seed: int = 0,
+        slow_rate: float = 0.0,
+        slow_latency: float = 0.0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.failures = 0
+        self.base_url: Optional[str] = None
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}/v1"
+        return self.base_url
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    @staticmethod
+    def _reply(messages: List[Dict[str, str]]) -> str:
+        prompt = messages[-1]["content"]
+        if "validation assistant" in messages[0]["content"]:
+            match = VALIDATION_RESPONSE.search(prompt)
+            return json.dumps({"valid": True, "formatted_response": match.group(1) if match else ""})
+        return "Thanks! Could you tell me a bit more? " + "lorem ipsum " * 10
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        payload = await request.json()
+        self.requests += 1
+        if self.random.random() < self.slow_rate:
+            await asyncio.sleep(self.slow_latency)
+        else:
+            await asyncio.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+        if self.random.random() < self.failure_rate:
+            self.failures += 1
+            return web.json_response({"message": "Service unavailable"}, status=503)
+
+        text = self._reply(payload["messages"])
+        usage = {"prompt_tokens": sum(len(m["content"]) for m in payload["messages"]) // 4, "completion_tokens": len(text) // 4}
+        if not payload.get("stream"):
+            return web.json_response({
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for word in text.split(" "):
+            chunk = {"choices": [{"index": 0, "delta": {"content": word + " "}}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(f"data: {json.dumps({'choices': [{'index': 0, 'delta': {}}], 'usage': usage})}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+
+class FakeAuthor:
+    """Stand-in for discord.User: records the DMs the bot sends."""
+
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.bot = False
+        self.received: List[str] = []
+
+    async def send(self, content: str):
+        self.received.append(content)
+
+
+class FakeMessage:
+    """Stand-in for a DM discord.Message."""
+
+    def __init__(self, author: FakeAuthor, content: str):
+        self.author = author
+        self.content = content
+        self.guild = None
+        self.channel = author
+
+
+def answer_for(field: Dict[str, Any], rng: random.Random, invalid_rate: float) -> str:
+    """A plausible answer to a form field, or a wrong one with probability ``invalid_rate``."""
+    if rng.random() < invalid_rate and field["type"] in ("email", "phone", "choice", "number", "yesno"):
+        return "not sure"
+    if field["type"] == "email":
+        return f"user{rng.randrange(10**6)}@example.com"
+    if field["type"] == "phone":
+        return f"+1415555{rng.randrange(10**4):04d}"
+    if field["type"] == "choice" and field.get("options"):
+        return rng.choice(list(field["options"]))
+    if field["type"] == "number":
+        return str(rng.randrange(100))
+    if field["type"] == "yesno":
+        return rng.choice(["yes", "no"])
+    return f"Answer {rng.randrange(10**6)}"
+
+
+def thread_written_bytes(thread: threading.Thread) -> Optional[int]:
+    """Bytes a thread has passed to write syscalls so far (Linux only)."""
+    try:
+        with open(f"/proc/self/task/{thread.native_id}/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+class StorageMeter:
+    """Counts the bytes the user store writes.
+
+    The SQLite store writes from its own thread, so that thread's I/O counters
+    are exact. The JSON store rewrites its whole file on the event loop thread,
+    next to the LLM client's socket writes, so each rewrite adds the file size.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.json_bytes = 0
+        writer = getattr(store, "_writer", None)
+        self.writer = writer if writer is not None and thread_written_bytes(writer) is not None else None
+        if self.writer is None and hasattr(store, "_write"):
+            write = store._write
+
+            def counted_write():
+                write()
+                self.json_bytes += os.path.getsize(store.data_file)
+
+            store._write = counted_write
+        self.start = self.total()
+
+    def total(self) -> Optional[int]:
+        if self.writer is not None:
+            return thread_written_bytes(self.writer)
+        return self.json_bytes if hasattr(self.store, "_write") else None
+
+    def written(self) -> Optional[int]:
+        self.store.flush()
+        total = self.total()
+        return total - self.start if total is not None and self.start is not None else None
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    stand_in = MistralStandIn(args.latency, args.jitter, args.failure_rate, args.seed, args.slow_rate, args.slow_latency)
+    base_url = await stand_in.start()
+
+    # Imported here so the environment set in main() is picked up
+    from form_handler import DEFAULT_FORM_ID, FormHandler
+    from llm_client import MistralHTTPClient
+    from llm_gateway import LLMGateway
+    from user_manager import UserManager
+
+    gateway = LLMGateway(client=MistralHTTPClient(api_key="bench", base_url=base_url))
+    user_manager = UserManager(data_file=os.path.join(args.workdir, "users.json"))
+    form_handler = FormHandler(user_manager, gateway=gateway)
+    form_id = args.form or DEFAULT_FORM_ID
+    fields = form_handler.get_form(form_id)["fields"]
+
+    for index in range(args.users):
+        await user_manager.register_user(str(10**17 + index), f"bench{index}", "password")
+    user_manager.store.flush()
+
+    if args.compile:
+        form_handler.compile_registered_forms()
+        # Incomplete compilations keep retrying in the background; wait for the first pass only
+        while not all(task.done() or form_id in form_handler.compiled_forms for (form_id, _), task in form_handler._compile_tasks.items()):
+            await asyncio.sleep(0.01)
+
+    turn_latencies: List[float] = []
+    errors = 0
+    completed = 0
+    calls_before = stand_in.requests
+    storage = StorageMeter(user_manager.store)
+
+    async def simulate(index: int) -> None:
+        nonlocal errors, completed
+        rng = random.Random(args.seed + index)
+        author = FakeAuthor(10**17 + index)
+        user_id = str(author.id)
+
+        started_at = time.perf_counter()
+        success, _ = await form_handler.start_form_collection(user_id, form_id, callback=author.send)
+        turn_latencies.append(time.perf_counter() - started_at)
+        if not success:
+            errors += 1
+            return
+
+        field_index = 0
+        for _ in range(len(fields) * 3):
+            await asyncio.sleep(rng.uniform(0, 2 * args.think_time))
+            message = FakeMessage(author, answer_for(fields[field_index], rng, args.invalid_rate))
+            started_at = time.perf_counter()
+            done = await form_handler.process_response(user_id, message.content, callback=lambda resp: message.author.send(resp))
+            turn_latencies.append(time.perf_counter() - started_at)
+            if author.received and author.received[-1].startswith("An error occurred"):
+                errors += 1
+            if done:
+                completed += 1
+                return
+            session = user_manager.get_active_session(user_id)
+            if session is None:
+                return
+            field_index = session["current_field"]
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(simulate(index) for index in range(args.users)))
+    elapsed = time.perf_counter() - started_at
+    storage_bytes = storage.written()
+
+    llm_calls = stand_in.requests - calls_before
+    user_manager.store.close()
+    await gateway.client.close()
+    await stand_in.stop()
+
+    return {
+        "commit": git_commit(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "workdir")},
+        "users": args.users,
+        "completed_forms": completed,
+        "turns": len(turn_latencies),
+        "errors": errors,
+        "elapsed": elapsed,
+        "turns_per_sec": len(turn_latencies) / elapsed if elapsed else 0.0,
+        "turn_latency": {
+            "p50": percentile(turn_latencies, 0.50),
+            "p95": percentile(turn_latencies, 0.95),
+            "p99": percentile(turn_latencies, 0.99),
+            "max": max(turn_latencies, default=0.0),
+        },
+        "llm_calls": llm_calls,
+        "llm_failures": stand_in.failures,
+        "llm_calls_per_form": llm_calls / completed if completed else None,
+        "storage_bytes_written": storage_bytes,
+        "gateway": gateway.snapshot(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100, help="concurrent simulated users")
+    parser.add_argument("--form", help="form ID (default: the sample form)")
+    parser.add_argument("--latency", type=float, default=0.2, help="mean stand-in LLM latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.05, help="+/- latency jitter in seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of LLM requests failing with 503")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="fraction of LLM requests taking --slow-latency")
+    parser.add_argument("--slow-latency", type=float, default=10.0, help="latency of slow LLM requests in seconds")
+    parser.add_argument("--deadline", type=float, help="per-call LLM deadline on a turn (FORM_LLM_DEADLINE, 0 disables)")
+    parser.add_argument("--hedge-after", type=float, help="hedge turn LLM calls slower than this (FORM_LLM_HEDGE_AFTER)")
+    parser.add_argument("--invalid-rate", type=float, default=0.1, help="fraction of answers that are invalid")
+    parser.add_argument("--think-time", type=float, default=0.05, help="mean pause between a user's answers in seconds")
+    parser.add_argument("--no-compile", dest="compile", action="store_false", help="don't pre-compile form messages")
+    parser.add_argument("--store", choices=("sqlite", "json"), default="sqlite")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    # Expected LLM failures would otherwise flood the output
+    logging.disable(logging.CRITICAL)
+    with tempfile.TemporaryDirectory() as workdir:
+        args.workdir = workdir
+        os.environ["USER_STORE"] = args.store
+        os.environ["USER_DB_PATH"] = str(Path(workdir) / "users.db")
+        os.environ["MISTRAL_API_KEY"] = "bench"
+        if args.deadline is not None:
+            os.environ["FORM_LLM_DEADLINE"] = str(args.deadline)
+        if args.hedge_after is not None:
+            os.environ["FORM_LLM_HEDGE_AFTER"] = str(args.hedge_after)
+        results = asyncio.run(run_benchmark(args))
+
+    print(
+        f"{results['completed_forms']}/{results['users']} forms, {results['turns']} turns in {results['elapsed']:.1f}s "
+        f"({results['turns_per_sec']:.1f} turns/s), p50 {results['turn_latency']['p50'] * 1000:.0f}ms "
+        f"p95 {results['turn_latency']['p95'] * 1000:.0f}ms p99 {results['turn_latency']['p99'] * 1000:.0f}ms, "
+        f"{results['llm_calls_per_form'] or 0:.1f} LLM calls/form, {results['errors']} errors, "
+        f"{results['storage_bytes_written']} storage bytes written",
+        file=sys.stderr,
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Memory benchmark: dict-of-dicts user layout vs the compact models.
+
+Builds N synthetic users, each with one completed onboarding session, the way
+they are loaded from storage, and reports the resident size of each layout.
+
+The models come out about 1.6x smaller than plain dicts, not several times:
+most of what remains per user is payload (the four answer strings, the user
+and session ID strings, the username and hash) plus the one-entry sessions
+dict, which the layout cannot shrink without changing the storage format.
+
+The session index adds about 180 bytes per user: the user -> active session
+map and, per session, one (user_id, session_id) tuple shared by the status
+and form_id sets plus a slot in each of those sets.
+
+    python bench_memory.py --users 100000
+"""
+import argparse
+import gc
+import hashlib
+import json
+import time
+import tracemalloc
+
+from form_registry import DEFAULT_FORMS_DIR
+from models import User
+from session_store import SessionStore
+
+with open(DEFAULT_FORMS_DIR / "sample-form.json", 'r') as f:
+    FORM = json.load(f)
+
+
+def make_records(count: int, embed_form: bool) -> str:
+    """Serialize ``count`` users in the storage layer's JSON layout."""
+    users = {}
+    for i in range(count):
+        session = {
+            "form_id": "sample-form",
+            "status": "completed",
+            "current_field": 4,
+            "last_activity": time.time(),
+            "collected_data": {
+                "fullName": f"User Number {i}",
+                "email": f"user{i}@example.com",
+                "phone": f"+1555{i:07d}",
+                "preferredContact": "Email" if i % 2 else "Phone",
+            },
+        }
+        if embed_form:
+            session["form_data"] = FORM
+        else:
+            session["form_version"] = 1
+        users[str(100000000000000000 + i)] = {
+            "username": f"user{i}#0001",
+            "password_hash": hashlib.sha256(str(i).encode()).hexdigest(),
+            "sessions": {f"session_{i:024x}": session},
+            "forms": [],
+        }
+    return json.dumps(users)
+
+
+def measure(build) -> int:
+    """Bytes still allocated after ``build()`` returns, keeping its result alive."""
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def build_models(text: str):
+    records = json.loads(text)
+    users = {user_id: User.from_record(record) for user_id, record in records.items()}
+    del records
+    return users
+
+
+def build_models_with_index(text: str):
+    users = build_models(text)
+    index = SessionStore()
+    for user_id, user in users.items():
+        index.add_user(user_id, user.sessions)
+    return users, index
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    legacy_text = make_records(args.users, embed_form=True)
+    text = make_records(args.users, embed_form=False)
+
+    results = {
+        "users": args.users,
+        "dict_layout_embedded_form": measure(lambda: json.loads(legacy_text)),
+        "dict_layout": measure(lambda: json.loads(text)),
+        "models": measure(lambda: build_models(text)),
+        "models_with_session_index": measure(lambda: build_models_with_index(text)),
+    }
+
+    baseline = results["dict_layout"]
+    print(f"{'layout':<28}{'total MB':>10}{'bytes/user':>12}{'vs dict':>9}")
+    for name, size in results.items():
+        if name == "users":
+            continue
+        print(f"{name:<28}{size / 2**20:>10.1f}{size / args.users:>12.0f}{baseline / size:>8.1f}x")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,20 @@
+import io
 import os
+import time
 import discord
 import logging
 import asyncio
+import metrics
+import tracing
 from discord.ext import commands
 from dotenv import load_dotenv
-from agent import MistralAgent
+from agent import DISCORD_SEND_TIME, MistralAgent
+from agent_pool import AgentPool, RATE_LIMITED
+from llm_gateway import get_gateway
 from user_manager import UserManager
 from form_handler import FormHandler
+from outbound import OutboundScheduler
+from survey_dispatch import SurveyDispatcher, parse_user_ids
 
 PREFIX = "!"
 
@@ -25,12 +33,64 @@ bot = commands.Bot(command_prefix=PREFIX, intents=intents)
 # Import the Mistral agent from the agent.py file
 agent = MistralAgent()
 
+
+async def reply_with_agent(message: discord.Message):
+    """Run the agent on a message and reply with its response."""
+    # Process the message with the agent you wrote
+    # Open up the agent.py file to customize the agent
+    logger.info(f"Processing message from {message.author}: {message.content}")
+    if agent.streaming:
+        # Post the reply as soon as the first tokens arrive and edit it as the rest streams in
+        await agent.stream_reply(message)
+        return
+    response = await agent.run(message)
+
+    # Send the response back to the channel
+    with DISCORD_SEND_TIME.labels("reply").time():
+        await message.reply(response)
+
+
+async def reply_rejected(message: discord.Message, reason: str):
+    """Cheap reply for messages the agent pool won't run."""
+    if reason == RATE_LIMITED:
+        await message.reply("You're sending messages faster than I can answer. Please wait a moment.")
+    else:
+        await message.reply("I'm busy right now, please try again in a minute.")
+
+
+# Bounded pool of agent workers with rate limiting and load shedding
+agent_pool = AgentPool(reply_with_agent, reply_rejected)
+
+# Rate-limited queue for form DMs; handlers enqueue and carry on
+outbound = OutboundScheduler()
+
 # Initialize the user manager and form handler
 user_manager = UserManager()
 form_handler = FormHandler(user_manager)
 
-# Dictionary to track users with active form collection sessions
-active_form_users = {}
+# Dictionary to track users with active form collection sessions, rebuilt from the
+# persisted sessions so users mid-form keep reaching the form handler after a restart
+active_form_users = user_manager.sessions.active_users()
+logger.info(f"Restored {len(active_form_users)} active form sessions")
+
+# Background task expiring idle form sessions, started once the bot is ready
+session_reaper = None
+
+# Process metrics, served on METRICS_HOST:METRICS_PORT once the bot is ready
+ON_MESSAGE_TIME = metrics.histogram(
+    "bot_on_message_seconds", "Time spent handling a Discord message, by route (form, agent, command, ignored)", ["route"]
+)
+metrics.gauge("bot_active_form_sessions", "Users with a form collection in progress").set_function(lambda: len(active_form_users))
+metrics.gauge("bot_cached_users", "Users held in the user manager's working set").set_function(lambda: len(user_manager.users))
+metrics.gauge("bot_cached_user_bytes", "Approximate bytes held by the user manager's working set").set_function(lambda: user_manager.resident_bytes)
+queue_depth = metrics.gauge("bot_queue_depth", "Items waiting in each internal queue", ["queue"])
+queue_depth.labels("agent").set_function(lambda: agent_pool.stats()["depth"])
+queue_depth.labels("outbound").set_function(lambda: outbound.stats()["queued"])
+queue_depth.labels("user_store").set_function(lambda: user_manager.store.pending())
+monitoring = None
+
+# Opt-in CPU/memory profiling for !profile; sampled traces are kept for !slowtraces
+profiler = tracing.Profiler()
 
 # Get the token from the environment variables
 token = os.getenv("DISCORD_TOKEN")
@@ -47,6 +107,30 @@ async def on_ready():
     """
     print(f"Bot is ready! Logged in as {bot.user}")
     logger.info(f"{bot.user} has connected to Discord!")
+    
+    # Pre-generate the conversational messages of every registered form
+    form_handler.compile_registered_forms()
+    
+    # Start the agent workers and the DM scheduler (no-ops after reconnects)
+    agent_pool.start()
+    outbound.start()
+    
+    # on_ready fires again after reconnects, so only start the reaper once
+    global session_reaper, monitoring
+    if session_reaper is None:
+        session_reaper = asyncio.create_task(user_manager.run_session_reaper(on_expire=on_session_expired))
+    
+    # Same for the metrics endpoint and the event loop lag probe
+    if monitoring is None:
+        monitoring = asyncio.create_task(metrics.monitor_event_loop())
+        await metrics.start_server()
+
+
+def on_session_expired(user_id: str, session_id: str):
+    """Stop routing a user's DMs to the form handler once their session is reaped."""
+    if active_form_users.get(user_id) == session_id:
+        del active_form_users[user_id]
+    form_handler.cancel_prefetch(user_id)
 
 
 @bot.event
@@ -56,36 +140,43 @@ async def on_message(message: discord.Message):
 
     https://discordpy.readthedocs.io/en/latest/api.html#discord.on_message
     """
-    # Don't delete this line! It's necessary for the bot to process commands.
-    await bot.process_commands(message)
+    started_at = time.perf_counter()
+    route = "ignored"
+    with tracing.get_tracer().trace("on_message") as span:
+        try:
+            # Don't delete this line! It's necessary for the bot to process commands.
+            await bot.process_commands(message)
 
-    # Ignore messages from self or other bots to prevent infinite loops.
-    if message.author.bot or message.content.startswith("!"):
-        return
-    
-    # Check if this user has an active form collection session
-    user_id = str(message.author.id)
-    if user_id in active_form_users:
-        # Process form response
-        is_complete = await form_handler.process_response(
-            user_id, 
-            message.content,
-            callback=lambda resp: message.author.send(resp)
-        )
-        
-        if is_complete:
-            # Form collection is complete, remove from active sessions
-            del active_form_users[user_id]
-        
-        return
-
-    # Process the message with the agent you wrote
-    # Open up the agent.py file to customize the agent
-    logger.info(f"Processing message from {message.author}: {message.content}")
-    response = await agent.run(message)
+            # Ignore messages from self or other bots to prevent infinite loops.
+            if message.author.bot:
+                return
+            if message.content.startswith("!"):
+                route = "command"
+                return
+            
+            # Check if this user has an active form collection session
+            user_id = str(message.author.id)
+            if user_id in active_form_users:
+                route = "form"
+                # Process form response
+                is_complete = await form_handler.process_response(
+                    user_id, 
+                    message.content,
+                    callback=lambda resp: outbound.send(message.author, resp)
+                )
+                
+                if is_complete:
+                    # Form collection is complete, remove from active sessions
+                    del active_form_users[user_id]
+                
+                return
 
-    # Send the response back to the channel
-    await message.reply(response)
+            # Queue the message for the agent workers
+            route = "agent"
+            await agent_pool.submit(message)
+        finally:
+            span.set("route", route)
+            ON_MESSAGE_TIME.labels(route).observe(time.perf_counter() - started_at)
 
 
 # Commands
@@ -120,7 +211,7 @@ async def register(ctx):
         password = password_msg.content
         
         # Register the user
-        success = user_manager.register_user(
+        success = await user_manager.register_user(
             str(user.id),
             str(user),
             password
@@ -157,7 +248,7 @@ async def signin(ctx):
         password = password_msg.content
         
         # Authenticate the user
-        success = user_manager.authenticate_user(str(user.id), password)
+        success = await user_manager.authenticate_user(str(user.id), password)
         
         if success:
             await user.send("Sign in successful! You can now use all bot features.")
@@ -182,7 +273,8 @@ async def form_collect(ctx, form_id: str = "sample-form"):
         success, session_id = await form_handler.start_form_collection(
             user_id,
             form_id,
-            callback=lambda resp: user.send(resp)
+            # Wait for delivery so closed DMs fail the start instead of leaving a silent session
+            callback=lambda resp: outbound.deliver(user, resp)
         )
         
         if success:
@@ -219,7 +311,8 @@ async def api_collect(ctx, discord_user_id: str, form_id: str, api_key: str = No
         success, session_id = await form_handler.start_form_collection(
             discord_user_id,
             form_id,
-            callback=lambda resp: user.send(resp)
+            # Wait for delivery so closed DMs fail the start instead of leaving a silent session
+            callback=lambda resp: outbound.deliver(user, resp)
         )
         
         if success:
@@ -233,7 +326,157 @@ async def api_collect(ctx, discord_user_id: str, form_id: str, api_key: str = No
         logger.error(f"Error starting API form collection: {e}")
         await ctx.send(f"An error occurred: {str(e)}")
 
+@bot.command(name="bulk_collect", help="Start a form for many users: !bulk_collect <form_id> <@role | user IDs...> (or attach a file of IDs)")
+async def bulk_collect(ctx, form_id: str, *targets: str):
+    """Start a form collection process with every member of a role and/or a list of users."""
+    if ctx.author.id != bot.owner_id and not (ctx.guild and ctx.author.guild_permissions.administrator):
+        await ctx.send("You don't have permission to use this command.")
+        return
+    
+    recipients = {}
+    for target in targets:
+        ids = parse_user_ids(target)
+        role = ctx.guild.get_role(int(ids[0])) if ctx.guild and len(ids) == 1 else None
+        if role is not None:
+            recipients.update((str(member.id), member) for member in role.members if not member.bot)
+        else:
+            recipients.update((user_id, user_id) for user_id in ids)
+    for attachment in ctx.message.attachments:
+        content = (await attachment.read()).decode(errors="ignore")
+        recipients.update((user_id, user_id) for user_id in parse_user_ids(content))
+    
+    if not recipients:
+        await ctx.send("No users to send the form to. Mention a role, list user IDs or attach a file of IDs.")
+        return
+    # Unlike single collection, never fall back to the default form for a whole batch
+    if form_handler.form_registry.get(form_id) is None:
+        await ctx.send(f"Unknown form: {form_id}")
+        return
+    
+    progress = await ctx.send(f"Sending form {form_id} to {len(recipients)} users...")
+    
+    async def report_progress(report):
+        await progress.edit(content=f"Sending form {form_id}: {report.summary()}")
+    
+    dispatcher = SurveyDispatcher(bot, form_handler, outbound, on_started=active_form_users.__setitem__)
+    report = await dispatcher.dispatch(recipients.values(), form_id, on_progress=report_progress)
+    
+    await progress.edit(content=f"Form {form_id} sent: {report.summary()}")
+    if report.failures:
+        breakdown = ", ".join(f"{len(user_ids)} {reason}" for reason, user_ids in report.failures.items())
+        await ctx.send(
+            f"Could not start the form for: {breakdown}",
+            file=discord.File(io.BytesIO(report.failure_csv().encode()), filename=f"{form_id}-failures.csv"),
+        )
+
+@bot.command(name="llmstats", help="Show LLM latency, token and error counters per call site")
+async def llm_stats(ctx):
+    """Show the LLM gateway counters for each call site."""
+    if ctx.author.id != bot.owner_id and not (ctx.guild and ctx.author.guild_permissions.administrator):
+        await ctx.send("You don't have permission to use this command.")
+        return
+    
+    snapshot = get_gateway().snapshot()
+    if not snapshot:
+        await ctx.send("No LLM calls recorded yet.")
+        return
+    
+    lines = []
+    for site, stats in sorted(snapshot.items()):
+        lines.append(
+            f"{site}: {stats['calls']} calls, {stats['upstream_calls']} upstream, "
+            f"{stats['coalesced']} coalesced, {stats['errors']} errors, "
+            f"avg {stats['avg_latency']:.2f}s, max {stats['max_latency']:.2f}s, "
+            f"{stats['prompt_tokens']}+{stats['completion_tokens']} tokens"
+            + (f", first token avg {stats['avg_first_token']:.2f}s" if stats['streams'] else "")
+            + (f", {stats['timeouts']} timeouts, {stats['hedged']} hedged, {stats['short_circuited']} short-circuited"
+               if stats['timeouts'] or stats['hedged'] or stats['short_circuited'] else "")
+        )
+    cache = form_handler.prompt_cache.stats()
+    lines.append(
+        f"prompt cache: {cache['entries']} entries, {cache['hits']} hits, "
+        f"{cache['misses']} misses ({cache['hit_rate']:.0%}), {cache['evictions']} evictions"
+    )
+    responses = agent.cache.stats()
+    lines.append(
+        f"response cache: {responses['entries']} entries, {responses['exact_hits']} exact + "
+        f"{responses['near_hits']} near hits, {responses['misses']} misses ({responses['hit_rate']:.0%}), "
+        f"{responses['evictions']} evictions"
+    )
+    users = user_manager.cache_stats()
+    lines.append(
+        f"user cache: {users['resident']} resident ({users['active']} active), "
+        f"{users['resident_bytes'] / 2**20:.1f}/{users['capacity_bytes'] / 2**20:.0f} MB, "
+        f"{users['hits']} hits, {users['misses']} misses ({users['hit_rate']:.0%}), {users['evictions']} evictions"
+    )
+    await ctx.send("```\n" + "\n".join(lines) + "\n```")
+
+@bot.command(name="queuestats", help="Show agent queue depth, wait times and load shedding counters")
+async def queue_stats(ctx):
+    """Show the agent worker pool counters."""
+    if ctx.author.id != bot.owner_id and not (ctx.guild and ctx.author.guild_permissions.administrator):
+        await ctx.send("You don't have permission to use this command.")
+        return
+    
+    stats = agent_pool.stats()
+    outbound_stats = outbound.stats()
+    await ctx.send(
+        f"```\nagent pool: {stats['busy_workers']}/{stats['workers']} workers busy, "
+        f"{stats['depth']} queued across {stats['lanes']} guilds (max {stats['max_depth']}), "
+        f"oldest {stats['oldest_wait']:.1f}s\n"
+        f"wait p50 {stats['wait_p50']:.2f}s, p95 {stats['wait_p95']:.2f}s, max {stats['wait_max']:.2f}s\n"
+        f"{stats['processed']} processed, {stats['errors']} errors, "
+        f"{stats['rate_limited']} rate limited, {stats['shed']} shed\n"
+        f"outbound DMs: {outbound_stats['queued']} queued ({outbound_stats['interactive_channels']} interactive, "
+        f"{outbound_stats['bulk_channels']} bulk channels), {outbound_stats['sent']} sent, {outbound_stats['merged']} merged, "
+        f"{outbound_stats['failed']} failed\n"
+        f"streamed replies: {agent.streamed_replies}, first visible text avg "
+        f"{agent.total_first_visible / max(agent.streamed_replies, 1):.2f}s, max {agent.max_first_visible:.2f}s\n```"
+    )
+
+@bot.command(name="slowtraces", help="Show the slowest recently traced messages: !slowtraces [count]")
+async def slow_traces(ctx, count: int = 3):
+    """Show the span trees of the slowest sampled traces."""
+    if ctx.author.id != bot.owner_id and not (ctx.guild and ctx.author.guild_permissions.administrator):
+        await ctx.send("You don't have permission to use this command.")
+        return
+    
+    tracer = tracing.get_tracer()
+    traces = tracer.slowest(max(1, min(count, 10)))
+    if not traces:
+        await ctx.send(f"No traces recorded yet (sampling {tracer.sample_rate:.0%} of messages).")
+        return
+    
+    for record in traces:
+        text = tracing.format_trace(record)
+        if len(text) > 1900:
+            text = text[:1900] + "\n..."
+        await ctx.send("```\n" + text + "\n```")
+
+@bot.command(name="profile", help="Profile the bot for a while: !profile <cpu|memory> [seconds]")
+async def profile(ctx, kind: str = "cpu", seconds: float = 30.0):
+    """Capture a CPU or memory profile over a fixed window and post the top entries."""
+    if ctx.author.id != bot.owner_id and not (ctx.guild and ctx.author.guild_permissions.administrator):
+        await ctx.send("You don't have permission to use this command.")
+        return
+    
+    seconds = max(1.0, min(seconds, 300.0))
+    await ctx.send(f"Capturing a {kind} profile for {seconds:.0f}s...")
+    try:
+        summary, path = await profiler.capture(kind, seconds)
+    except (ValueError, RuntimeError) as e:
+        await ctx.send(str(e))
+        return
+    
+    if len(summary) > 1800:
+        summary = summary[:1800] + "\n..."
+    await ctx.send(f"Saved to {path}\n```\n{summary}\n```")
+
 print("About to run bot...")  
 
 # Start the bot, connecting it to the gateway
-bot.run(token)
\ No newline at end of file
+bot.run(token)
+
+# Make sure queued user data and traces reach disk before the process exits
+user_manager.store.close()
+tracing.get_tracer().close()
\ No newline at end of file
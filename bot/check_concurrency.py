@@ -0,0 +1,239 @@
+"""Self-check for the survey state compare-and-advance and the LLM circuit breaker.
+
+Exercises, without any external service:
+  * survey state compare-and-advance on SQLite and on Redis (served by
+    redis_standin), including the WATCH/MULTI/EXEC retry after a conflicting
+    write and racing workers that must never lose or duplicate an answer;
+  * the LLM circuit breaker's closed -> open -> half-open -> closed cycle, both
+    directly and through LLMGateway.chat.
+
+Prints one line per check and exits non-zero if any fails.
+
+    python check_concurrency.py
+"""
+import argparse
+import asyncio
+import json
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from pathlib import Path
+from typing import List
+
+from llm_gateway import CircuitBreaker, CircuitOpenError, LLMGateway
+from redis_standin import RedisStandIn
+from survey_state import RedisConnection, RedisError, RedisSurveyState, SQLiteSurveyState, SurveyStateStore
+
+QUESTIONS = [{"question": f"Question {i}?"} for i in range(20)]
+
+
+def check(condition: bool, message: str) -> None:
+    if not condition:
+        raise AssertionError(message)
+
+
+def check_single_winner(state: SurveyStateStore) -> None:
+    """Workers answering the same question at once: exactly one is recorded."""
+    survey = state.start_survey("race", QUESTIONS)
+    barrier = threading.Barrier(8)
+    results: List[object] = []
+
+    def answer(worker: int) -> None:
+        barrier.wait()
+        results.append(state.advance_survey("race", survey["survey_id"], 0, {"worker": worker}))
+
+    threads = [threading.Thread(target=answer, args=(worker,)) for worker in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    winners = [result for result in results if result is not None]
+    check(len(winners) == 1, f"expected one winner, got {len(winners)}")
+    stored = state.get_survey("race")
+    check(stored["current_question"] == 1 and len(stored["answers"]) == 1, f"survey advanced wrongly: {stored}")
+
+
+def check_no_lost_answers(state: SurveyStateStore) -> None:
+    """Workers racing through a whole survey: every question answered exactly once, in order."""
+    survey = state.start_survey("walk", QUESTIONS)
+
+    def walk(worker: int) -> None:
+        while True:
+            current = state.get_survey("walk")
+            if current is None or current["current_question"] >= len(QUESTIONS):
+                return
+            expected = current["current_question"]
+            state.advance_survey("walk", survey["survey_id"], expected, {"question": expected, "worker": worker})
+
+    threads = [threading.Thread(target=walk, args=(worker,)) for worker in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stored = state.get_survey("walk")
+    check(stored["current_question"] == len(QUESTIONS), f"stopped at question {stored['current_question']}")
+    check([answer["question"] for answer in stored["answers"]] == list(range(len(QUESTIONS))), "answers lost, duplicated or reordered")
+
+
+def check_stale_survey_rejected(state: SurveyStateStore) -> None:
+    """An answer for a survey that was restarted or ended is not recorded."""
+    old = state.start_survey("stale", QUESTIONS)
+    state.start_survey("stale", QUESTIONS)
+    check(state.advance_survey("stale", old["survey_id"], 0, {}) is None, "answer recorded against a replaced survey")
+    current = state.get_survey("stale")
+    state.end_survey("stale", current["survey_id"])
+    check(state.get_survey("stale") is None, "ended survey still present")
+
+
+def check_redis_cas_retry(state: RedisSurveyState) -> None:
+    """A write landing between WATCH and EXEC makes the transaction retry on fresh data."""
+    survey = state.start_survey("cas", QUESTIONS)
+    other = RedisConnection(state.host, state.port, state.db)
+    key = state._survey("cas")
+    calls = []
+
+    def change(value):
+        calls.append(value["current_question"])
+        if len(calls) == 1:
+            # Another worker records an answer after our read, before our EXEC
+            other.execute("SET", key, json.dumps({**value, "current_question": 1, "answers": [{"by": "other"}]}))
+        return {**value, "current_question": value["current_question"] + 1, "answers": value["answers"] + [{"by": "us"}]}
+
+    try:
+        result = state._update(key, change)
+        check(calls == [0, 1], f"expected a retry on the fresh value, change saw {calls}")
+        check([answer["by"] for answer in result["answers"]] == ["other", "us"], f"conflicting write lost: {result['answers']}")
+        check(state.get_survey("cas")["current_question"] == 2, "retried write not stored")
+
+        def always_conflicts(value):
+            other.execute("SET", key, json.dumps({**value, "current_question": value["current_question"] + 1}))
+            return value
+
+        try:
+            state._update(key, always_conflicts, attempts=3)
+        except RedisError:
+            pass
+        else:
+            raise AssertionError("endless conflicts did not give up")
+    finally:
+        other.close()
+        state.end_survey("cas", survey["survey_id"])
+
+
+def check_breaker_cycle() -> None:
+    """Consecutive failures open the breaker; after the cooldown one trial decides."""
+    breaker = CircuitBreaker("check", threshold=3, cooldown=0.05)
+    for _ in range(2):
+        check(breaker.allow(), "closed breaker rejected a request")
+        breaker.record_failure()
+    check(not breaker.open, "opened before the threshold")
+    breaker.record_success()
+    for _ in range(3):
+        breaker.record_failure()
+    check(breaker.open and not breaker.allow(), "did not open after 3 consecutive failures")
+
+    time.sleep(0.06)
+    check(breaker.allow(), "no trial request after the cooldown")
+    check(not breaker.allow(), "more than one trial request let through")
+    breaker.abandon()
+    check(breaker.allow(), "a cancelled trial was not replaced")
+    breaker.record_failure()
+    check(breaker.open and breaker.retry_in() > 0 and not breaker.allow(), "failed trial did not reopen the breaker")
+
+    time.sleep(0.06)
+    check(breaker.allow(), "no trial request after the second cooldown")
+    breaker.record_success()
+    check(not breaker.open and breaker.allow() and breaker.allow(), "successful trial did not close the breaker")
+
+
+class _FlakyClient:
+    """Chat client that fails until told to recover."""
+
+    def __init__(self):
+        self.healthy = False
+        self.calls = 0
+
+    async def chat_completion(self, model, messages, **params):
+        self.calls += 1
+        if not self.healthy:
+            raise ConnectionError("upstream down")
+        return {"choices": [{"message": {"content": "ok"}}]}
+
+
+def check_gateway_breaker() -> None:
+    """LLMGateway.chat fails fast while the breaker is open and recovers through a trial."""
+    async def run() -> None:
+        client = _FlakyClient()
+        gateway = LLMGateway(client=client, breaker_failures=2, breaker_cooldown=0.05)
+        for attempt in range(2):
+            try:
+                await gateway.chat("check", "model", [{"role": "user", "content": str(attempt)}])
+            except ConnectionError:
+                pass
+        try:
+            await gateway.chat("check", "model", [{"role": "user", "content": "open"}])
+        except CircuitOpenError:
+            pass
+        else:
+            raise AssertionError("open breaker let a request through")
+        check(client.calls == 2, f"open breaker reached the upstream ({client.calls} calls)")
+
+        await asyncio.sleep(0.06)
+        client.healthy = True
+        data = await gateway.chat("check", "model", [{"role": "user", "content": "trial"}])
+        check(data["choices"][0]["message"]["content"] == "ok", "trial response lost")
+        await gateway.chat("check", "model", [{"role": "user", "content": "closed"}])
+        check(client.calls == 4 and not gateway.breaker("model").open, "breaker did not close after a successful trial")
+        check(gateway.snapshot()["check"]["short_circuited"] == 1, "short-circuited call not counted")
+
+    asyncio.run(run())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args()
+
+    workdir = tempfile.TemporaryDirectory()
+    redis = RedisStandIn()
+    redis_url = redis.start()
+    sqlite_state = SQLiteSurveyState(Path(workdir.name) / "state.db", ttl=3600)
+    redis_state = RedisSurveyState(redis_url, ttl=3600)
+
+    checks: List[tuple] = []
+    for name, state in (("sqlite", sqlite_state), ("redis", redis_state)):
+        checks += [
+            (f"{name}: one winner per question", lambda state=state: check_single_winner(state)),
+            (f"{name}: no lost answers under races", lambda state=state: check_no_lost_answers(state)),
+            (f"{name}: stale survey rejected", lambda state=state: check_stale_survey_rejected(state)),
+        ]
+    checks += [
+        ("redis: WATCH/MULTI/EXEC retries after a conflict", lambda: check_redis_cas_retry(redis_state)),
+        ("breaker: open / half-open / close cycle", check_breaker_cycle),
+        ("gateway: fails fast while open, recovers via trial", check_gateway_breaker),
+    ]
+
+    failures = 0
+    for name, run in checks:
+        try:
+            run()
+        except Exception:
+            failures += 1
+            print(f"FAIL  {name}")
+            traceback.print_exc()
+        else:
+            print(f"ok    {name}")
+
+    redis_state.close()
+    sqlite_state.close()
+    redis.stop()
+    workdir.cleanup()
+    print(f"{len(checks) - failures}/{len(checks)} checks passed")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
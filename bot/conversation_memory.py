@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import os
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+# Setup logging
+logger = logging.getLogger("conversation_memory")
+
+Turn = Tuple[str, str, int]
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about four characters per token for English text)."""
+    return len(text) // 4 + 1
+
+
+class Conversation:
+    """Recent turns of one channel plus a running summary of older ones."""
+
+    __slots__ = ("turns", "tokens", "summary", "pending", "pending_tokens", "compacting")
+
+    def __init__(self, max_turns: int):
+        self.turns: Deque[Turn] = deque(maxlen=max_turns)
+        self.tokens = 0
+        self.summary = ""
+        # Turns trimmed from the buffer that aren't folded into the summary yet
+        self.pending: List[Turn] = []
+        self.pending_tokens = 0
+        self.compacting = False
+
+
+class ConversationMemory:
+    """Per-channel conversation history with a token budget.
+
+    Each channel (or DM) keeps a ring buffer of its latest turns. When the turns
+    exceed ``token_budget`` the oldest are trimmed; once enough trimmed text has
+    accumulated it is compacted into a short summary by ``summarize``, meant to
+    be sent ahead of the recent turns. At most ``max_conversations`` channels are
+    kept; the least recently used are forgotten.
+    """
+
+    def __init__(
+        self,
+        summarize: Optional[Callable[[str, List[Turn]], Awaitable[str]]] = None,
+        max_conversations: Optional[int] = None,
+        max_turns: Optional[int] = None,
+        token_budget: Optional[int] = None,
+        summary_tokens: Optional[int] = None,
+    ):
+        """Initialize the memory with limits taken from arguments or the environment."""
+        self.summarize = summarize
+        self.max_conversations = max_conversations or int(os.getenv("AGENT_MEMORY_CHANNELS", "1000"))
+        self.max_turns = max_turns or int(os.getenv("AGENT_MEMORY_TURNS", "40"))
+        self.token_budget = token_budget or int(os.getenv("AGENT_MEMORY_TOKENS", "1500"))
+        self.summary_tokens = summary_tokens or int(os.getenv("AGENT_SUMMARY_TOKENS", "250"))
+
+        self._conversations: "OrderedDict[str, Conversation]" = OrderedDict()
+        self._tasks = set()
+        self.evictions = 0
+        self.compactions = 0
+
+    def __len__(self) -> int:
+        return len(self._conversations)
+
+    def _get(self, key: str) -> Conversation:
+        conversation = self._conversations.get(key)
+        if conversation is None:
+            conversation = self._conversations[key] = Conversation(self.max_turns)
+            while len(self._conversations) > self.max_conversations:
+                self._conversations.popitem(last=False)
+                self.evictions += 1
+        self._conversations.move_to_end(key)
+        return conversation
+
+    def history(self, key: str) -> List[Dict[str, str]]:
+        """Recent turns of a channel as chat messages, oldest first."""
+        if key not in self._conversations:
+            return []
+        return [{"role": role, "content": content} for role, content, _ in self._get(key).turns]
+
+    def has_context(self, key: str) -> bool:
+        """Whether a channel has earlier turns or a summary that a reply could depend on."""
+        conversation = self._conversations.get(key)
+        return conversation is not None and bool(conversation.turns or conversation.summary)
+
+    def summary(self, key: str) -> str:
+        """Summary of a channel's turns that no longer fit in its history."""
+        conversation = self._conversations.get(key)
+        return conversation.summary if conversation is not None else ""
+
+    def append(self, key: str, role: str, content: str) -> None:
+        """Record a turn, trimming the oldest ones past the token budget."""
+        conversation = self._get(key)
+        if len(conversation.turns) == conversation.turns.maxlen:
+            self._trim(conversation, conversation.turns.popleft())
+        tokens = estimate_tokens(content)
+        conversation.turns.append((role, content, tokens))
+        conversation.tokens += tokens
+
+        while conversation.tokens > self.token_budget and len(conversation.turns) > 1:
+            self._trim(conversation, conversation.turns.popleft())
+
+        if conversation.pending_tokens >= self.token_budget // 4 and not conversation.compacting:
+            self._schedule_compaction(key, conversation)
+
+    def _trim(self, conversation: Conversation, turn: Turn) -> None:
+        conversation.tokens -= turn[2]
+        if self.summarize is None:
+            return
+        conversation.pending.append(turn)
+        conversation.pending_tokens += turn[2]
+        # Never hold more unsummarized text than the budget, even if summarizing keeps failing
+        while conversation.pending_tokens > self.token_budget:
+            conversation.pending_tokens -= conversation.pending.pop(0)[2]
+
+    def _schedule_compaction(self, key: str, conversation: Conversation) -> None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        conversation.compacting = True
+        task = loop.create_task(self._compact(key, conversation))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _compact(self, key: str, conversation: Conversation) -> None:
+        """Fold the trimmed turns of a conversation into its summary."""
+        turns, conversation.pending, conversation.pending_tokens = conversation.pending, [], 0
+        try:
+            summary = await self.summarize(conversation.summary, turns)
+            conversation.summary = summary[: self.summary_tokens * 4].strip()
+            self.compactions += 1
+        except Exception as e:
+            logger.error(f"Error summarizing conversation {key}: {e}")
+        finally:
+            conversation.compacting = False
+
+        # Turns trimmed while the summary was being written
+        if conversation.pending_tokens >= self.token_budget // 4 and self._conversations.get(key) is conversation:
+            self._schedule_compaction(key, conversation)
+
+    def forget(self, key: str) -> None:
+        """Drop a channel's history."""
+        self._conversations.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        """Return the number of conversations and counters."""
+        return {
+            "conversations": len(self._conversations),
+            "capacity": self.max_conversations,
+            "tokens": sum(conversation.tokens for conversation in self._conversations.values()),
+            "evictions": self.evictions,
+            "compactions": self.compactions,
+        }
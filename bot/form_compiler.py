@@ -0,0 +1,122 @@
+import asyncio
+import hashlib
+import json
+import logging
+from typing import Dict, Any, Awaitable, Callable, Optional
+
+# Setup logging
+logger = logging.getLogger("form_compiler")
+
+
+def fingerprint(*parts: Any) -> str:
+    """Hash JSON-serializable parts into a stable fingerprint."""
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def intro_fingerprint(form: Dict[str, Any]) -> str:
+    """Fingerprint the inputs of a form's introduction message."""
+    return fingerprint(form["name"], form["fields"][0])
+
+
+class CompiledMessage:
+    """A pre-generated message and the fingerprint of the inputs it was built from."""
+
+    __slots__ = ("source", "text")
+
+    def __init__(self, source: str, text: str):
+        self.source = source
+        self.text = text
+
+
+class CompiledForm:
+    """Conversational messages generated ahead of time for one form definition."""
+
+    def __init__(self, form_id: str, version: int = 0):
+        self.form_id = form_id
+        self.version = version
+        self.intro: Optional[CompiledMessage] = None
+        self.prompts: Dict[str, CompiledMessage] = {}
+        self.retries: Dict[str, CompiledMessage] = {}
+        # Messages that failed to generate and should be compiled again
+        self.missing = 0
+
+    def intro_message(self, form: Dict[str, Any]) -> Optional[str]:
+        """Return the compiled intro if it still matches the form definition."""
+        if self.intro is not None and self.intro.source == intro_fingerprint(form):
+            return self.intro.text
+        return None
+
+    def field_message(self, field: Dict[str, Any]) -> Optional[str]:
+        """Return the compiled question for a field if it still matches the field."""
+        return self._lookup(self.prompts, field)
+
+    def retry_message(self, field: Dict[str, Any]) -> Optional[str]:
+        """Return the compiled retry template for a field if it still matches the field."""
+        return self._lookup(self.retries, field)
+
+    @staticmethod
+    def _lookup(messages: Dict[str, CompiledMessage], field: Dict[str, Any]) -> Optional[str]:
+        compiled = messages.get(field["name"])
+        if compiled is not None and compiled.source == fingerprint(field):
+            return compiled.text
+        return None
+
+
+class FormCompiler:
+    """Builds the intro, field prompts and retry templates of a form once.
+
+    Compilation is incremental: messages whose inputs have not changed since the
+    previous compilation are carried over instead of being regenerated. A message
+    whose generator raises is left out and counted in ``CompiledForm.missing``,
+    so compiling again later fills it in.
+    """
+
+    def __init__(
+        self,
+        generate_intro: Callable[[str, Dict[str, Any]], Awaitable[str]],
+        generate_field: Callable[[Dict[str, Any]], Awaitable[str]],
+        generate_retry: Callable[[Dict[str, Any]], Awaitable[str]],
+    ):
+        """Initialize the compiler with the coroutines that generate each kind of message."""
+        self.generate_intro = generate_intro
+        self.generate_field = generate_field
+        self.generate_retry = generate_retry
+
+    async def compile(self, form_id: str, form: Dict[str, Any], previous: Optional[CompiledForm] = None) -> CompiledForm:
+        """Compile a form, reusing any still-valid messages from a previous compilation."""
+        compiled = CompiledForm(form_id, form.get("version", 0))
+        jobs = []
+
+        async def build(target: Dict[str, CompiledMessage], name: str, source: str, generate: Awaitable[str]) -> None:
+            try:
+                target[name] = CompiledMessage(source, await generate)
+            except Exception as e:
+                logger.error(f"Error compiling {name} of form {form_id}: {e}")
+                compiled.missing += 1
+
+        intro_source = intro_fingerprint(form)
+        if previous is not None and previous.intro is not None and previous.intro.source == intro_source:
+            compiled.intro = previous.intro
+        else:
+            async def build_intro() -> None:
+                try:
+                    compiled.intro = CompiledMessage(intro_source, await self.generate_intro(form["name"], form["fields"][0]))
+                except Exception as e:
+                    logger.error(f"Error compiling intro of form {form_id}: {e}")
+                    compiled.missing += 1
+            jobs.append(build_intro())
+
+        for field in form["fields"]:
+            source = fingerprint(field)
+            for kind, generate in (("prompts", self.generate_field), ("retries", self.generate_retry)):
+                old = getattr(previous, kind).get(field["name"]) if previous is not None else None
+                if old is not None and old.source == source:
+                    getattr(compiled, kind)[field["name"]] = old
+                else:
+                    jobs.append(build(getattr(compiled, kind), field["name"], source, generate(field)))
+
+        if jobs:
+            logger.info(f"Compiling form {form_id}: generating {len(jobs)} messages")
+            await asyncio.gather(*jobs)
+        return compiled
@@ -1,11 +1,17 @@
+import asyncio
+import functools
 import json
 import logging
 import os
 from typing import Dict, Any, List, Optional, Tuple
 
 from dotenv import load_dotenv
-import requests
+from form_compiler import CompiledForm, FormCompiler
+from llm_gateway import LLMGateway, get_gateway, message_content
+from prompt_cache import PromptCache
+from tracing import traced
 from user_manager import UserManager
+from validators import ACCEPT, REJECT, validate_locally
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
@@ -13,36 +19,154 @@ logger = logging.getLogger("form_handler")
 
 load_dotenv()
 
+FORM_MODEL = "mistral-small"
+CONVERSATION_SYSTEM_PROMPT = "You are a helpful assistant that collects information through a friendly conversation."
+VALIDATION_SYSTEM_PROMPT = "You are a validation assistant that checks if user responses meet the required format and returns JSON."
+
+# Form served for any form_id that hasn't been published (see forms/sample-form.json)
+DEFAULT_FORM_ID = "sample-form"
+
 class FormHandler:
     """Handles form collection through Discord using Mistral API for natural language processing."""
     
-    def __init__(self, user_manager: UserManager):
-        """Initialize the form handler with a user manager."""
+    def __init__(self, user_manager: UserManager, gateway: Optional[LLMGateway] = None, prompt_cache: Optional[PromptCache] = None):
+        """Initialize the form handler with a user manager, the shared LLM gateway and a prompt cache."""
         self.user_manager = user_manager
         self.mistral_api_key = os.getenv("MISTRAL_API_KEY")
-        self.api_base_url = "https://api.mistral.ai/v1"
+        self.gateway = gateway or get_gateway()
+        self.prompt_cache = prompt_cache or PromptCache()
+        
+        # Latency budget of each LLM call on a user's turn; past it the template fallback is used
+        self.llm_deadline = float(os.getenv("FORM_LLM_DEADLINE", "4")) or None
+        self.llm_hedge_after = float(os.getenv("FORM_LLM_HEDGE_AFTER", "0")) or None
+        
+        # Shared form definitions and the messages compiled from their latest versions
+        self.form_registry = user_manager.form_registry
+        self.compiled_forms: Dict[str, CompiledForm] = {}
+        self._compile_tasks: Dict[Tuple[str, int], asyncio.Task] = {}
+        self.compile_retry_delay = float(os.getenv("FORM_COMPILE_RETRY", "30"))
+        self.compile_retry_max = float(os.getenv("FORM_COMPILE_RETRY_MAX", "600"))
+        
+        # Speculatively generated next-question messages, by user: (session_id, field index, task)
+        self._prefetched: Dict[str, Tuple[str, int, asyncio.Task]] = {}
+        self.compiler = FormCompiler(
+            functools.partial(self._generate_intro_message, background=True),
+            functools.partial(self._generate_field_message, background=True),
+            functools.partial(self._generate_retry_template, background=True),
+        )
         
         if not self.mistral_api_key:
             logger.warning("MISTRAL_API_KEY not found in environment variables. Conversational features will be limited.")
     
+    def register_form(self, form_id: str, form: Dict[str, Any]) -> Dict[str, Any]:
+        """Publish a form definition and compile its messages in the background."""
+        definition = self.form_registry.publish(form_id, form)
+        self._schedule_compile(definition)
+        return definition
+    
+    def compile_registered_forms(self) -> None:
+        """Compile the latest version of every published form. Call once the event loop is running."""
+        for form_id in self.form_registry.form_ids():
+            self._schedule_compile(self.form_registry.get(form_id))
+    
+    def get_form(self, form_id: str) -> Optional[Dict[str, Any]]:
+        """Get the latest version of a form, falling back to the default form."""
+        return self.form_registry.get(form_id) or self.form_registry.get(DEFAULT_FORM_ID)
+    
+    def _schedule_compile(self, form: Dict[str, Any]) -> None:
+        """Start compiling a form version if an event loop is running; otherwise it is compiled on first use."""
+        key = (form["form_id"], form["version"])
+        if key in self._compile_tasks:
+            return
+        
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._compile_tasks[key] = loop.create_task(self._compile_form(form))
+    
+    async def _compile_form(self, form: Dict[str, Any]) -> None:
+        """Compile a form's messages, reusing those whose inputs haven't changed.
+        
+        Messages that fail to generate are left out (they are generated on demand
+        meanwhile) and compilation is retried with backoff until the form is complete.
+        """
+        form_id = form["form_id"]
+        delay = self.compile_retry_delay
+        while True:
+            try:
+                compiled = await self.compiler.compile(form_id, form, self.compiled_forms.get(form_id))
+            except Exception as e:
+                logger.error(f"Error compiling form {form_id}: {e}")
+                compiled = None
+            
+            if compiled is not None:
+                # Don't let a slow compilation of an older version replace a newer one
+                current = self.compiled_forms.get(form_id)
+                if current is not None and current.version > compiled.version:
+                    return
+                self.compiled_forms[form_id] = compiled
+                if not compiled.missing:
+                    return
+                logger.warning(f"{compiled.missing} messages of form {form_id} failed to compile, retrying in {delay:.0f}s")
+            
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.compile_retry_max)
+    
+    def _compiled_form(self, form_id: str, form: Dict[str, Any]) -> CompiledForm:
+        """Get the compiled messages for a session's form, scheduling compilation if it hasn't started."""
+        if "version" in form:
+            self._schedule_compile(form)
+        return self.compiled_forms.get(form_id) or CompiledForm(form_id)
+    
+    async def _complete(
+        self,
+        site: str,
+        prompt: str,
+        max_tokens: int,
+        system_prompt: str = CONVERSATION_SYSTEM_PROMPT,
+        background: bool = False,
+    ) -> str:
+        """Run a chat completion through the LLM gateway, tagged with its call site.
+        
+        Calls made on a user's turn are bounded by FORM_LLM_DEADLINE (and hedged
+        after FORM_LLM_HEDGE_AFTER); ``background`` calls, such as form
+        compilation, wait as long as they need to.
+        """
+        data = await self.gateway.chat(
+            f"form_handler.{site}",
+            FORM_MODEL,
+            [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": prompt}
+            ],
+            deadline=None if background else self.llm_deadline,
+            hedge_after=None if background else self.llm_hedge_after,
+            max_tokens=max_tokens
+        )
+        return message_content(data)
+    
+    async def _complete_cached(self, site: str, prompt: str, max_tokens: int, background: bool = False) -> str:
+        """Run a completion whose output depends only on the prompt, reusing cached results."""
+        key = self.prompt_cache.make_key(FORM_MODEL, site, max_tokens, prompt)
+        cached = self.prompt_cache.get(key)
+        if cached is not None:
+            return cached
+        
+        content = await self._complete(site, prompt, max_tokens, background=background)
+        self.prompt_cache.put(key, content)
+        return content
+    
+    @traced("form.start")
     async def start_form_collection(self, user_id: str, form_id: str, callback) -> Tuple[bool, str]:
         """Start collecting form data from a user."""
-        # In a real implementation, we would fetch the form definition from the database
-        # For the prototype, we'll use a mock form
-        
+        session_id = None
         try:
-            # This would be a database call in production
-            mock_form = {
-                "name": "Customer Onboarding",
-                "fields": [
-                    {"name": "fullName", "type": "string", "prompt": "What's your full name?", "required": True},
-                    {"name": "email", "type": "email", "prompt": "What's your email address?", "required": True},
-                    {"name": "phone", "type": "phone", "prompt": "What's your phone number with country code?", "required": True},
-                    {"name": "preferredContact", "type": "choice", "prompt": "Do you prefer to be contacted by phone or email?", "options": ["Phone", "Email"], "required": True}
-                ]
-            }
-            
-            session_id = self.user_manager.start_form_session(user_id, form_id, mock_form)
+            form = self.get_form(form_id)
+            if form is None:
+                return False, f"Unknown form: {form_id}"
+            
+            session_id = await self.user_manager.start_form_session(user_id, form)
             if not session_id:
                 return False, "Failed to start form session. Please try again."
             
@@ -53,8 +177,13 @@ class FormHandler:
             
             field = session["form_data"]["fields"][0]
             
-            # Generate introduction message using Mistral API
-            intro_message = await self._generate_intro_message(session["form_data"]["name"], field)
+            # Serve the compiled introduction, generating it only if compilation hasn't caught up
+            intro_message = self._compiled_form(session["form_id"], session["form_data"]).intro_message(session["form_data"])
+            if intro_message is None:
+                intro_message = await self._generate_intro_message(session["form_data"]["name"], field)
+            
+            # Start preparing the second question while the user answers the first
+            self._prefetch(user_id, session, 1)
             
             # Send the intro message
             await callback(intro_message)
@@ -63,8 +192,13 @@ class FormHandler:
         
         except Exception as e:
             logger.error(f"Error starting form collection: {e}")
+            # Don't leave a session in progress that the user was never told about
+            if session_id:
+                self.cancel_prefetch(user_id)
+                self.user_manager.expire_session(user_id, session_id)
             return False, f"An error occurred: {str(e)}"
     
+    @traced("form.process_response")
     async def process_response(self, user_id: str, message: str, callback) -> bool:
         """Process a user's response to a form field."""
         try:
@@ -73,18 +207,28 @@ class FormHandler:
             if not session:
                 await callback("You don't have an active form. Please start a new form collection.")
                 return False
+            self.user_manager.touch_session(user_id, session["session_id"])
             
             # Get the current field
             current_field_idx = session["current_field"]
             field = session["form_data"]["fields"][current_field_idx]
+            compiled = self._compiled_form(session["form_id"], session["form_data"])
             
-            # Validate the response using Mistral API
+            # Fetch the next question concurrently with validating this answer
+            next_message = self._prefetch(user_id, session, current_field_idx + 1)
             valid, formatted_response = await self._validate_response(field, message)
             
             if not valid:
+                # Don't let an unfinished prefetch compete with the retry message for an LLM slot
+                if next_message is not None and not next_message.done():
+                    self.cancel_prefetch(user_id)
+                
                 # Ask the user again with a more specific prompt
-                retry_message = await self._generate_retry_message(field, message)
+                retry_message = compiled.retry_message(field)
+                if retry_message is None:
+                    retry_message = await self._generate_retry_message(field, message)
                 await callback(retry_message)
+                self._prefetch(user_id, session, current_field_idx + 1)
                 return False
             
             # Save the validated response
@@ -94,6 +238,8 @@ class FormHandler:
             next_step = self.user_manager.advance_session(user_id, session["session_id"])
             
             if next_step["status"] == "completed":
+                self.cancel_prefetch(user_id)
+                
                 # Form is complete, generate summary
                 completion_message = await self._generate_completion_message(session["form_data"]["name"], next_step["data"])
                 await callback(completion_message)
@@ -103,18 +249,64 @@ class FormHandler:
                 
                 return True
             
-            # Ask the next question
-            next_question = await self._generate_field_message(next_step["field"])
+            # Ask the next question, then start preparing the one after it
+            self._prefetched.pop(user_id, None)
+            next_question = await self._await_prefetched(next_message, session["form_id"], next_step["field"])
             await callback(next_question)
+            self._prefetch(user_id, session, current_field_idx + 2)
             
             return False
         
         except Exception as e:
+            self.cancel_prefetch(user_id)
             logger.error(f"Error processing response: {e}")
             await callback(f"An error occurred while processing your response. Please try again.")
             return False
     
-    async def _generate_intro_message(self, form_name: str, first_field: Dict[str, Any]) -> str:
+    def _prefetch(self, user_id: str, session: Dict[str, Any], field_idx: int) -> Optional[asyncio.Task]:
+        """Start (or reuse) generation of the message for a session's field, returning its task."""
+        fields = session["form_data"]["fields"]
+        if field_idx >= len(fields):
+            return None
+        
+        prefetched = self._prefetched.get(user_id)
+        if prefetched is not None:
+            session_id, prefetched_idx, task = prefetched
+            if session_id == session["session_id"] and prefetched_idx == field_idx and not task.cancelled():
+                return task
+            task.cancel()
+        
+        task = asyncio.ensure_future(self._next_field_message(session["form_id"], fields[field_idx]))
+        self._prefetched[user_id] = (session["session_id"], field_idx, task)
+        return task
+    
+    def cancel_prefetch(self, user_id: str) -> None:
+        """Cancel and forget any speculative message generation for a user."""
+        prefetched = self._prefetched.pop(user_id, None)
+        if prefetched is not None:
+            prefetched[2].cancel()
+    
+    async def _await_prefetched(self, task: Optional[asyncio.Task], form_id: str, field: Dict[str, Any]) -> str:
+        """Wait for a prefetched message, regenerating it if the prefetch was cancelled."""
+        if task is not None:
+            try:
+                return await asyncio.shield(task)
+            except asyncio.CancelledError:
+                # Re-raise if we are the ones being cancelled rather than the prefetch
+                if not task.cancelled():
+                    raise
+        return await self._next_field_message(form_id, field)
+    
+    @traced("form.next_message")
+    async def _next_field_message(self, form_id: str, field: Dict[str, Any]) -> str:
+        """Get the message asking for a field, from the compiled form if possible."""
+        compiled = self.compiled_forms.get(form_id)
+        message = compiled.field_message(field) if compiled is not None else None
+        if message is None:
+            message = await self._generate_field_message(field)
+        return message
+    
+    async def _generate_intro_message(self, form_name: str, first_field: Dict[str, Any], background: bool = False) -> str:
         """Generate an introduction message for the form."""
         if not self.mistral_api_key:
             return f"I'm collecting information for {form_name}. {first_field['prompt']}"
@@ -127,42 +319,22 @@ class FormHandler:
             Write a friendly, conversational introduction that explains the purpose of the form and asks for the first piece of information.
             Keep it brief and natural."""
             
-            response = requests.post(
-                f"{self.api_base_url}/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {self.mistral_api_key}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": "mistral-small",
-                    "messages": [
-                        {"role": "system", "content": "You are a helpful assistant that collects information through a friendly conversation."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    "max_tokens": 300
-                }
-            )
-            
-            data = response.json()
-            return data["choices"][0]["message"]["content"]
+            return await self._complete_cached("intro", prompt, 300, background)
         
         except Exception as e:
+            # A compiled template would outlive the outage; let the compiler retry instead
+            if background:
+                raise
             logger.error(f"Error generating intro message: {e}")
             return f"I'm collecting information for {form_name}. {first_field['prompt']}"
     
-    async def _generate_field_message(self, field: Dict[str, Any]) -> str:
+    async def _generate_field_message(self, field: Dict[str, Any], background: bool = False) -> str:
         """Generate a message to ask for a specific field."""
         if not self.mistral_api_key:
             return field["prompt"]
         
         try:
-            type_info = ""
-            if field["type"] == "email":
-                type_info = "This should be a valid email address."
-            elif field["type"] == "phone":
-                type_info = "This should be a valid phone number with country code."
-            elif field["type"] == "choice" and "options" in field:
-                type_info = f"Please choose from: {', '.join(field['options'])}."
+            type_info = self._type_info(field)
             
             prompt = f"""You are an AI assistant helping to collect information through a conversational interface.
             You need to ask the user for the following information: {field['prompt']} {type_info}
@@ -170,31 +342,25 @@ class FormHandler:
             Write a friendly, conversational message asking for this information.
             Keep it brief and natural."""
             
-            response = requests.post(
-                f"{self.api_base_url}/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {self.mistral_api_key}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": "mistral-small",
-                    "messages": [
-                        {"role": "system", "content": "You are a helpful assistant that collects information through a friendly conversation."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    "max_tokens": 200
-                }
-            )
-            
-            data = response.json()
-            return data["choices"][0]["message"]["content"]
+            return await self._complete_cached("field", prompt, 200, background)
         
         except Exception as e:
+            # A compiled template would outlive the outage; let the compiler retry instead
+            if background:
+                raise
             logger.error(f"Error generating field message: {e}")
             return field["prompt"]
     
+    @traced("form.validate")
     async def _validate_response(self, field: Dict[str, Any], response: str) -> Tuple[bool, str]:
-        """Validate a user's response to a field using Mistral API."""
+        """Validate a user's response to a field, using Mistral API only for ambiguous answers."""
+        # Settle clear-cut answers locally before paying for a round trip
+        verdict, value = validate_locally(field, response)
+        if verdict == ACCEPT:
+            return True, value
+        if verdict == REJECT:
+            return False, response
+        
         if not self.mistral_api_key:
             # Simple validation without Mistral API
             if field["type"] == "email" and "@" not in response:
@@ -218,24 +384,7 @@ class FormHandler:
             }}
             """
             
-            response_obj = requests.post(
-                f"{self.api_base_url}/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {self.mistral_api_key}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": "mistral-small",
-                    "messages": [
-                        {"role": "system", "content": "You are a validation assistant that checks if user responses meet the required format and returns JSON."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    "max_tokens": 300
-                }
-            )
-            
-            data = response_obj.json()
-            result_text = data["choices"][0]["message"]["content"]
+            result_text = await self._complete("validate", prompt, 300, system_prompt=VALIDATION_SYSTEM_PROMPT)
             
             # Extract the JSON part
             import re
@@ -253,25 +402,14 @@ class FormHandler:
             logger.error(f"Error validating response: {e}")
             return True, response  # Default to accepting the response if validation fails
     
+    @traced("form.retry_message")
     async def _generate_retry_message(self, field: Dict[str, Any], invalid_response: str) -> str:
         """Generate a message to ask the user to retry with a valid response."""
         if not self.mistral_api_key:
-            if field["type"] == "email":
-                return "That doesn't look like a valid email address. Please enter a valid email address."
-            elif field["type"] == "phone":
-                return "That doesn't look like a valid phone number. Please enter a valid phone number with country code."
-            elif field["type"] == "choice" and "options" in field:
-                return f"Please choose one of the following options: {', '.join(field['options'])}."
-            return f"Please provide a valid response. {field['prompt']}"
+            return self._fallback_retry_message(field)
         
         try:
-            type_info = ""
-            if field["type"] == "email":
-                type_info = "This should be a valid email address."
-            elif field["type"] == "phone":
-                type_info = "This should be a valid phone number with country code."
-            elif field["type"] == "choice" and "options" in field:
-                type_info = f"Please choose from: {', '.join(field['options'])}."
+            type_info = self._type_info(field)
             
             prompt = f"""You are an AI assistant helping to collect information through a conversational interface.
             You asked the user for: {field['prompt']} {type_info}
@@ -281,35 +419,59 @@ class FormHandler:
             Write a friendly, conversational message explaining why the response is not valid and asking them to try again.
             Keep it brief and natural."""
             
-            response = requests.post(
-                f"{self.api_base_url}/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {self.mistral_api_key}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": "mistral-small",
-                    "messages": [
-                        {"role": "system", "content": "You are a helpful assistant that collects information through a friendly conversation."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    "max_tokens": 200
-                }
-            )
-            
-            data = response.json()
-            return data["choices"][0]["message"]["content"]
+            # The prompt quotes the user's answer, so it would never hit the cache and would
+            # keep user input in it; the reusable part is the compiled retry template
+            return await self._complete("retry", prompt, 200)
         
         except Exception as e:
             logger.error(f"Error generating retry message: {e}")
-            if field["type"] == "email":
-                return "That doesn't look like a valid email address. Please enter a valid email address."
-            elif field["type"] == "phone":
-                return "That doesn't look like a valid phone number. Please enter a valid phone number with country code."
-            elif field["type"] == "choice" and "options" in field:
-                return f"Please choose one of the following options: {', '.join(field['options'])}."
-            return f"Please provide a valid response. {field['prompt']}"
+            return self._fallback_retry_message(field)
+    
+    async def _generate_retry_template(self, field: Dict[str, Any], background: bool = False) -> str:
+        """Generate a reusable retry message for a field that doesn't quote the user's answer."""
+        if not self.mistral_api_key:
+            return self._fallback_retry_message(field)
+        
+        try:
+            prompt = f"""You are an AI assistant helping to collect information through a conversational interface.
+            You asked the user for: {field['prompt']} {self._type_info(field)}
+            The user's answer was not valid for this field type.
+            
+            Write a friendly, conversational message explaining what a valid answer looks like and asking them to try again.
+            Do not quote or refer to the exact answer they gave. Keep it brief and natural."""
+            
+            return await self._complete_cached("retry_template", prompt, 200, background)
+        
+        except Exception as e:
+            # A compiled template would outlive the outage; let the compiler retry instead
+            if background:
+                raise
+            logger.error(f"Error generating retry template: {e}")
+            return self._fallback_retry_message(field)
+    
+    @staticmethod
+    def _type_info(field: Dict[str, Any]) -> str:
+        """Describe what a valid answer for the field's type looks like."""
+        if field["type"] == "email":
+            return "This should be a valid email address."
+        elif field["type"] == "phone":
+            return "This should be a valid phone number with country code."
+        elif field["type"] == "choice" and "options" in field:
+            return f"Please choose from: {', '.join(field['options'])}."
+        return ""
+    
+    @staticmethod
+    def _fallback_retry_message(field: Dict[str, Any]) -> str:
+        """Template retry message used when Mistral API isn't available."""
+        if field["type"] == "email":
+            return "That doesn't look like a valid email address. Please enter a valid email address."
+        elif field["type"] == "phone":
+            return "That doesn't look like a valid phone number. Please enter a valid phone number with country code."
+        elif field["type"] == "choice" and "options" in field:
+            return f"Please choose one of the following options: {', '.join(field['options'])}."
+        return f"Please provide a valid response. {field['prompt']}"
     
+    @traced("form.completion_message")
     async def _generate_completion_message(self, form_name: str, collected_data: Dict[str, str]) -> str:
         """Generate a completion message summarizing the collected data."""
         if not self.mistral_api_key:
@@ -332,24 +494,7 @@ class FormHandler:
             summarizing the information they provided, and letting them know it has been submitted successfully.
             Keep it brief and natural."""
             
-            response = requests.post(
-                f"{self.api_base_url}/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {self.mistral_api_key}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": "mistral-small",
-                    "messages": [
-                        {"role": "system", "content": "You are a helpful assistant that collects information through a friendly conversation."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    "max_tokens": 300
-                }
-            )
-            
-            data = response.json()
-            return data["choices"][0]["message"]["content"]
+            return await self._complete("completion", prompt, 300)
         
         except Exception as e:
             logger.error(f"Error generating completion message: {e}")
@@ -0,0 +1,182 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+
+from storage import BASE_DIR, DEFAULT_DB_PATH
+
+# Setup logging
+logger = logging.getLogger("form_registry")
+
+DEFAULT_FORMS_DIR = BASE_DIR / "forms"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bot_forms (
+    form_id TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    checksum TEXT NOT NULL,
+    definition TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    PRIMARY KEY (form_id, version)
+);
+"""
+
+
+class FrozenDict(dict):
+    """A dict that refuses modification. Still serializes like a plain dict."""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Form definitions are immutable; publish a new version instead")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+    def __hash__(self):
+        return hash(json.dumps(self, sort_keys=True))
+
+
+def freeze(value: Any) -> Any:
+    """Recursively convert dicts and lists into immutable equivalents."""
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def _checksum(definition: Dict[str, Any]) -> str:
+    payload = json.dumps({"name": definition["name"], "fields": definition["fields"]}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+# Devplatform question formats and the bot field types they map to
+QUESTION_FORMAT_TYPES = {
+    "text": "string",
+    "number": "number",
+    "yesno": "yesno",
+    "multiple": "choice",
+}
+
+
+def form_from_questions(name: str, questions: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Convert devplatform survey questions into a bot form definition."""
+    fields = []
+    for index, question in enumerate(questions):
+        field = {
+            "name": f"q{index + 1}",
+            "type": QUESTION_FORMAT_TYPES.get(question.get("format"), "string"),
+            "prompt": question["question"],
+            "required": True,
+        }
+        options = question.get("options")
+        if isinstance(options, dict):
+            field["options"] = list(options.values())
+        elif options:
+            field["options"] = list(options)
+        fields.append(field)
+    return {"name": name, "fields": fields}
+
+
+class FormRegistry:
+    """Versioned, shared store of form definitions.
+
+    Definitions are immutable: publishing changed content creates a new version,
+    and publishing identical content returns the existing one. Every version is
+    loaded at most once per process and shared by all sessions, which only keep
+    ``(form_id, version)``. Definitions live in the ``bot_forms`` table so the
+    devplatform can publish forms the bot then serves; JSON files in the forms
+    directory are published at startup.
+    """
+
+    def __init__(self, db_path: Optional[Path] = None, forms_dir: Path = DEFAULT_FORMS_DIR, refresh_interval: Optional[float] = None):
+        """Initialize the registry and publish the form files found on disk."""
+        self.db_path = Path(db_path or os.getenv("USER_DB_PATH", DEFAULT_DB_PATH))
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.refresh_interval = refresh_interval or float(os.getenv("FORM_REFRESH_INTERVAL", "30"))
+
+        self._versions: Dict[Tuple[str, int], FrozenDict] = {}
+        self._latest: Dict[str, Tuple[int, float]] = {}
+        self._lock = threading.RLock()
+
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+        if forms_dir.is_dir():
+            for path in sorted(forms_dir.glob("*.json")):
+                with open(path, 'r') as f:
+                    self.publish(path.stem, json.load(f))
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.db_path)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _load_version(self, conn: sqlite3.Connection, form_id: str, version: int) -> Optional[FrozenDict]:
+        row = conn.execute(
+            "SELECT definition FROM bot_forms WHERE form_id = ? AND version = ?", (form_id, version)
+        ).fetchone()
+        if row is None:
+            return None
+        form = freeze({**json.loads(row[0]), "form_id": form_id, "version": version})
+        self._versions[(form_id, version)] = form
+        return form
+
+    def publish(self, form_id: str, definition: Dict[str, Any]) -> FrozenDict:
+        """Store a definition, creating a new version only if its content changed."""
+        checksum = _checksum(definition)
+        content = {"name": definition["name"], "fields": definition["fields"]}
+
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT version, checksum FROM bot_forms WHERE form_id = ? ORDER BY version DESC LIMIT 1", (form_id,)
+            ).fetchone()
+            if row is not None and row[1] == checksum:
+                version = row[0]
+            else:
+                version = (row[0] + 1) if row is not None else 1
+                conn.execute(
+                    "INSERT INTO bot_forms (form_id, version, checksum, definition, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (form_id, version, checksum, json.dumps(content), datetime.now().isoformat()),
+                )
+                logger.info(f"Published form {form_id} version {version}")
+
+            self._latest[form_id] = (version, time.monotonic())
+            return self._versions.get((form_id, version)) or self._load_version(conn, form_id, version)
+
+    def form_ids(self) -> List[str]:
+        """IDs of every published form."""
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute("SELECT DISTINCT form_id FROM bot_forms ORDER BY form_id")]
+
+    def get(self, form_id: str, version: Optional[int] = None) -> Optional[FrozenDict]:
+        """Get a specific version of a form, or its latest version."""
+        with self._lock:
+            if version is None:
+                latest = self._latest.get(form_id)
+                if latest is not None and time.monotonic() - latest[1] < self.refresh_interval:
+                    version = latest[0]
+
+            if version is not None and (form_id, version) in self._versions:
+                return self._versions[(form_id, version)]
+
+            with self._connect() as conn:
+                if version is None:
+                    row = conn.execute("SELECT MAX(version) FROM bot_forms WHERE form_id = ?", (form_id,)).fetchone()
+                    if row is None or row[0] is None:
+                        return None
+                    version = row[0]
+                    self._latest[form_id] = (version, time.monotonic())
+                    if (form_id, version) in self._versions:
+                        return self._versions[(form_id, version)]
+                return self._load_version(conn, form_id, version)
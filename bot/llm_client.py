@@ -0,0 +1,144 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Dict, Any, AsyncIterator, List, Optional
+
+import aiohttp
+
+# Setup logging
+logger = logging.getLogger("llm_client")
+
+DEFAULT_API_BASE_URL = "https://api.mistral.ai/v1"
+
+
+def _env_float(name: str, default: float) -> float:
+    """Read a float setting from the environment, falling back to a default."""
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        logger.warning(f"Invalid value for {name}, using {default}")
+        return default
+
+
+def _env_int(name: str, default: int) -> int:
+    """Read an integer setting from the environment, falling back to a default."""
+    try:
+        return int(os.getenv(name, default))
+    except ValueError:
+        logger.warning(f"Invalid value for {name}, using {default}")
+        return default
+
+
+class MistralAPIError(Exception):
+    """Raised when the Mistral API answers with an error status."""
+
+    def __init__(self, status: int, body: Any):
+        super().__init__(f"Mistral API returned {status}: {body}")
+        self.status = status
+        self.body = body
+
+
+class MistralHTTPClient:
+    """Non-blocking client for the Mistral chat completions endpoint.
+
+    A single aiohttp session is shared by every caller so TCP/TLS connections are
+    kept alive and reused, and a semaphore bounds how many requests are in flight.
+    Timeouts and pool sizes can be tuned with the MISTRAL_* environment variables.
+    """
+
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        base_url: str = DEFAULT_API_BASE_URL,
+        connect_timeout: Optional[float] = None,
+        read_timeout: Optional[float] = None,
+        max_connections: Optional[int] = None,
+        max_in_flight: Optional[int] = None,
+    ):
+        """Initialize the client. The HTTP session is created lazily inside the running loop."""
+        self.api_key = api_key if api_key is not None else os.getenv("MISTRAL_API_KEY")
+        self.base_url = base_url.rstrip("/")
+        self.connect_timeout = connect_timeout or _env_float("MISTRAL_CONNECT_TIMEOUT", 5.0)
+        self.read_timeout = read_timeout or _env_float("MISTRAL_READ_TIMEOUT", 30.0)
+        self.max_connections = max_connections or _env_int("MISTRAL_MAX_CONNECTIONS", 32)
+        self.max_in_flight = max_in_flight or _env_int("MISTRAL_MAX_IN_FLIGHT", 64)
+
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Return the shared session, creating it on first use."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                keepalive_timeout=60,
+                ttl_dns_cache=300,
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=None,
+                sock_connect=self.connect_timeout,
+                sock_read=self.read_timeout,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=timeout,
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "Content-Type": "application/json",
+                },
+            )
+        return self._session
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        """Return the semaphore that bounds in-flight requests."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        return self._semaphore
+
+    async def chat_completion(self, model: str, messages: List[Dict[str, str]], **params) -> Dict[str, Any]:
+        """Send a chat completion request and return the decoded JSON response."""
+        payload = {"model": model, "messages": messages, **params}
+
+        async with self._get_semaphore():
+            session = self._get_session()
+            async with session.post(f"{self.base_url}/chat/completions", json=payload) as response:
+                data = await response.json(content_type=None)
+                if response.status >= 400:
+                    raise MistralAPIError(response.status, data)
+                return data
+
+    async def stream_chat_completion(self, model: str, messages: List[Dict[str, str]], **params) -> AsyncIterator[Dict[str, Any]]:
+        """Send a streaming chat completion request and yield each decoded server-sent chunk."""
+        payload = {"model": model, "messages": messages, **params, "stream": True}
+
+        async with self._get_semaphore():
+            session = self._get_session()
+            async with session.post(f"{self.base_url}/chat/completions", json=payload) as response:
+                if response.status >= 400:
+                    raise MistralAPIError(response.status, await response.json(content_type=None))
+                async for raw_line in response.content:
+                    line = raw_line.decode().strip()
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    yield json.loads(data)
+
+    async def close(self) -> None:
+        """Close the underlying HTTP session and its pooled connections."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+_shared_client: Optional[MistralHTTPClient] = None
+
+
+def get_client() -> MistralHTTPClient:
+    """Return the process-wide Mistral HTTP client."""
+    global _shared_client
+    if _shared_client is None:
+        _shared_client = MistralHTTPClient()
+    return _shared_client
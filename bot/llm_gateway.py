@@ -0,0 +1,474 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Any, AsyncIterator, List, Optional
+
+import metrics
+import tracing
+from llm_client import MistralHTTPClient, get_client
+
+# Setup logging
+logger = logging.getLogger("llm_gateway")
+
+LLM_LATENCY = metrics.histogram("llm_request_duration_seconds", "Upstream LLM request latency per call site", ["site"])
+LLM_QUEUE_WAIT = metrics.histogram("llm_queue_wait_seconds", "Time LLM requests waited for a concurrency slot", ["site"])
+LLM_REQUESTS = metrics.counter(
+    "llm_requests",
+    "LLM calls per call site by outcome (ok, error, cancelled, coalesced, timeout, short_circuited, hedged)",
+    ["site", "outcome"],
+)
+LLM_TOKENS = metrics.counter("llm_tokens", "LLM tokens used per call site", ["site", "kind"])
+LLM_FIRST_TOKEN = metrics.histogram("llm_first_token_seconds", "Time to the first streamed token per call site", ["site"])
+LLM_IN_FLIGHT = metrics.gauge("llm_requests_in_flight", "Upstream LLM requests currently running")
+LLM_CIRCUIT_OPEN = metrics.gauge("llm_circuit_open", "1 while the circuit breaker for a model is open", ["model"])
+
+
+def _parse_model_limits(spec: str) -> Dict[str, int]:
+    """Parse a "model=limit,model=limit" string into a dict."""
+    limits = {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        model, _, limit = item.partition("=")
+        try:
+            limits[model.strip()] = int(limit)
+        except ValueError:
+            logger.warning(f"Ignoring invalid model limit: {item}")
+    return limits
+
+
+def message_content(data: Dict[str, Any]) -> str:
+    """Extract the assistant message text from a chat completion response."""
+    return data["choices"][0]["message"]["content"]
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    """A chat completion did not finish within the caller's deadline."""
+
+
+class CircuitOpenError(Exception):
+    """A chat completion was skipped because the model's circuit breaker is open."""
+
+    def __init__(self, model: str, retry_in: float):
+        super().__init__(f"Circuit open for {model}, retrying in {retry_in:.1f}s")
+        self.model = model
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """Stops sending requests to a model for a while after repeated failures.
+
+    After ``threshold`` consecutive errors or missed deadlines the breaker opens
+    and calls fail fast for ``cooldown`` seconds. Then a single trial request is
+    let through; its outcome closes the breaker or opens it again.
+    """
+
+    __slots__ = ("model", "threshold", "cooldown", "failures", "opened_at", "trial")
+
+    def __init__(self, model: str, threshold: int, cooldown: float):
+        self.model = model
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial = False
+
+    @property
+    def open(self) -> bool:
+        return self.opened_at is not None
+
+    def retry_in(self) -> float:
+        """Seconds until the next trial request is allowed."""
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.opened_at + self.cooldown - time.monotonic())
+
+    def allow(self) -> bool:
+        """Return whether a request may be sent now."""
+        if self.opened_at is None:
+            return True
+        if self.trial or self.retry_in() > 0:
+            return False
+        self.trial = True
+        return True
+
+    def record_success(self) -> None:
+        if self.opened_at is not None:
+            logger.info(f"Circuit for {self.model} closed")
+            LLM_CIRCUIT_OPEN.labels(self.model).set(0)
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.trial or (self.opened_at is None and self.failures >= self.threshold):
+            if self.opened_at is None:
+                logger.warning(f"Circuit for {self.model} opened after {self.failures} consecutive failures")
+                LLM_CIRCUIT_OPEN.labels(self.model).set(1)
+            self.opened_at = time.monotonic()
+        self.trial = False
+
+    def abandon(self) -> None:
+        """Forget a request that ended without an outcome (it was cancelled)."""
+        self.trial = False
+
+
+class CallSiteStats:
+    """Latency, token and error counters for one call site."""
+
+    __slots__ = (
+        "calls", "upstream_calls", "coalesced", "errors",
+        "timeouts", "hedged", "short_circuited",
+        "prompt_tokens", "completion_tokens",
+        "total_latency", "max_latency", "total_queue_wait",
+        "streams", "total_first_token",
+    )
+
+    def __init__(self):
+        self.calls = 0
+        self.upstream_calls = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.hedged = 0
+        self.short_circuited = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.total_queue_wait = 0.0
+        self.streams = 0
+        self.total_first_token = 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Return the counters as a plain dict, with derived averages."""
+        data = {name: getattr(self, name) for name in self.__slots__}
+        data["avg_latency"] = self.total_latency / self.upstream_calls if self.upstream_calls else 0.0
+        data["avg_first_token"] = self.total_first_token / self.streams if self.streams else 0.0
+        return data
+
+
+class LLMGateway:
+    """Single entry point for every Mistral chat completion in the project.
+
+    The gateway caps concurrency globally and per model, merges identical requests
+    that are already in flight into one upstream call, and keeps per-call-site
+    counters so slow or chatty call paths can be identified. ``stream`` yields
+    the reply text as it is generated; streams are never merged.
+
+    Latency-sensitive callers pass ``deadline`` (give up and raise
+    DeadlineExceeded) and ``hedge_after`` (send a second copy of a slow request
+    and take whichever answers first) to ``chat``. A per-model circuit breaker
+    (LLM_BREAKER_FAILURES, LLM_BREAKER_COOLDOWN) makes ``chat`` fail fast with
+    CircuitOpenError while the upstream keeps failing or missing deadlines.
+
+    Async callers use ``chat`` from their own event loop. Synchronous callers use
+    ``chat_blocking``, which runs the request on a private loop thread, and the
+    Flask devplatform's async views use ``chat_async``, which awaits that same
+    thread. A single gateway instance should only be used from one loop.
+    """
+
+    def __init__(
+        self,
+        client: Optional[MistralHTTPClient] = None,
+        max_concurrency: Optional[int] = None,
+        model_limits: Optional[Dict[str, int]] = None,
+        breaker_failures: Optional[int] = None,
+        breaker_cooldown: Optional[float] = None,
+    ):
+        """Initialize the gateway with concurrency limits taken from arguments or the environment."""
+        self.client = client or get_client()
+        self.max_concurrency = max_concurrency or int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+        if model_limits is None:
+            model_limits = _parse_model_limits(os.getenv("LLM_MODEL_LIMITS", ""))
+        self.model_limits = model_limits
+        self.breaker_failures = breaker_failures or int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+        self.breaker_cooldown = breaker_cooldown or float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+        self.stats: Dict[str, CallSiteStats] = {}
+        self._stats_lock = threading.Lock()
+        self._global_semaphore: Optional[asyncio.Semaphore] = None
+        self._model_semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self._waiters: Dict[asyncio.Future, int] = {}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_lock = threading.Lock()
+
+    def _site_stats(self, site: str) -> CallSiteStats:
+        """Return the counters for a call site, creating them on first use."""
+        stats = self.stats.get(site)
+        if stats is None:
+            with self._stats_lock:
+                stats = self.stats.setdefault(site, CallSiteStats())
+        return stats
+
+    def _get_global_semaphore(self) -> asyncio.Semaphore:
+        """Return the semaphore bounding concurrent requests across all models."""
+        if self._global_semaphore is None:
+            self._global_semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._global_semaphore
+
+    def _model_semaphore(self, model: str) -> asyncio.Semaphore:
+        """Return the semaphore bounding concurrent requests for a model."""
+        semaphore = self._model_semaphores.get(model)
+        if semaphore is None:
+            limit = self.model_limits.get(model, self.max_concurrency)
+            semaphore = self._model_semaphores[model] = asyncio.Semaphore(limit)
+        return semaphore
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        """Return the circuit breaker for a model, creating it on first use."""
+        breaker = self._breakers.get(model)
+        if breaker is None:
+            breaker = self._breakers[model] = CircuitBreaker(model, self.breaker_failures, self.breaker_cooldown)
+        return breaker
+
+    @staticmethod
+    def request_key(model: str, messages: List[Dict[str, str]], params: Dict[str, Any]) -> str:
+        """Hash a request so identical in-flight requests can be merged."""
+        payload = json.dumps([model, messages, params], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    async def chat(
+        self,
+        site: str,
+        model: str,
+        messages: List[Dict[str, str]],
+        *,
+        deadline: Optional[float] = None,
+        hedge_after: Optional[float] = None,
+        **params,
+    ) -> Dict[str, Any]:
+        """Run a chat completion through the gateway and return the decoded response.
+
+        ``deadline`` bounds the whole call, queueing included, in seconds.
+        ``hedge_after`` sends a second copy of the request if the first hasn't
+        answered after that many seconds and a concurrency slot is free.
+        """
+        stats = self._site_stats(site)
+        stats.calls += 1
+
+        with tracing.span("llm.chat", site=site) as span:
+            key = self.request_key(model, messages, params)
+            task = self._in_flight.get(key)
+            if task is not None:
+                stats.coalesced += 1
+                LLM_REQUESTS.labels(site, "coalesced").inc()
+                span.set("coalesced", True)
+                return await self._wait(site, stats, key, task, deadline)
+
+            breaker = self.breaker(model)
+            if not breaker.allow():
+                stats.short_circuited += 1
+                LLM_REQUESTS.labels(site, "short_circuited").inc()
+                span.set("short_circuited", True)
+                raise CircuitOpenError(model, breaker.retry_in())
+
+            if hedge_after:
+                task = asyncio.ensure_future(self._dispatch_hedged(site, stats, model, messages, params, hedge_after))
+            else:
+                task = asyncio.ensure_future(self._dispatch(site, stats, model, messages, params))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._request_done(key, done))
+            try:
+                data = await self._wait(site, stats, key, task, deadline)
+            except Exception:
+                breaker.record_failure()
+                raise
+            except BaseException:
+                breaker.abandon()
+                raise
+            breaker.record_success()
+            return data
+
+    async def _wait(self, site: str, stats: CallSiteStats, key: str, task: asyncio.Future, deadline: Optional[float]) -> Dict[str, Any]:
+        """Wait for a (possibly shared) request, cancelling it if every waiter gives up."""
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            if deadline is None:
+                return await asyncio.shield(task)
+            try:
+                return await asyncio.wait_for(asyncio.shield(task), deadline)
+            except asyncio.TimeoutError:
+                if task.done():
+                    raise
+                stats.timeouts += 1
+                LLM_REQUESTS.labels(site, "timeout").inc()
+                raise DeadlineExceeded(f"{site} did not answer within {deadline:.1f}s") from None
+        finally:
+            waiters = self._waiters.pop(task) - 1
+            if waiters:
+                self._waiters[task] = waiters
+            elif not task.done():
+                task.cancel()
+                self._request_done(key, task)
+
+    def _request_done(self, key: str, task: asyncio.Future) -> None:
+        """Forget a finished request and mark its exception as retrieved."""
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        if task.done() and not task.cancelled():
+            task.exception()
+
+    async def _dispatch(self, site: str, stats: CallSiteStats, model: str, messages: List[Dict[str, str]], params: Dict[str, Any]) -> Dict[str, Any]:
+        """Send one upstream request while holding the global and per-model slots."""
+        queued_at = time.perf_counter()
+        async with self._get_global_semaphore(), self._model_semaphore(model):
+            started_at = time.perf_counter()
+            self._started(site, stats, started_at - queued_at)
+            try:
+                data = await self.client.chat_completion(model, messages, **params)
+            except BaseException as e:
+                self._finished(site, stats, started_at, "error" if isinstance(e, Exception) else "cancelled")
+                raise
+            self._finished(site, stats, started_at)
+
+        self._count_tokens(site, stats, data.get("usage") or {})
+        return data
+
+    async def _dispatch_hedged(
+        self,
+        site: str,
+        stats: CallSiteStats,
+        model: str,
+        messages: List[Dict[str, str]],
+        params: Dict[str, Any],
+        hedge_after: float,
+    ) -> Dict[str, Any]:
+        """Send a request, plus a second copy if it is slow; the first success wins.
+
+        The copy is only sent while both the global and the model's concurrency
+        limits have room, so hedging never queues behind (or delays) other calls.
+        """
+        attempts = [asyncio.ensure_future(self._dispatch(site, stats, model, messages, params))]
+        try:
+            done, _ = await asyncio.wait(attempts, timeout=hedge_after)
+            if not done and not self._get_global_semaphore().locked() and not self._model_semaphore(model).locked():
+                stats.hedged += 1
+                LLM_REQUESTS.labels(site, "hedged").inc()
+                span = tracing.get_tracer().current()
+                if span is not None:
+                    span.set("hedged", True)
+                attempts.append(asyncio.ensure_future(self._dispatch(site, stats, model, messages, params)))
+
+            pending = set(attempts)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    if attempt.exception() is None:
+                        return attempt.result()
+            # Every attempt failed; report the original request's error
+            return attempts[0].result()
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    def _started(self, site: str, stats: CallSiteStats, queue_wait: float) -> None:
+        """Record an upstream request leaving the queue."""
+        stats.total_queue_wait += queue_wait
+        stats.upstream_calls += 1
+        LLM_QUEUE_WAIT.labels(site).observe(queue_wait)
+        LLM_IN_FLIGHT.inc()
+
+    def _finished(self, site: str, stats: CallSiteStats, started_at: float, outcome: str = "ok") -> None:
+        """Record the latency and outcome (ok, error or cancelled) of an upstream request."""
+        latency = time.perf_counter() - started_at
+        stats.total_latency += latency
+        stats.max_latency = max(stats.max_latency, latency)
+        if outcome == "error":
+            stats.errors += 1
+        LLM_LATENCY.labels(site).observe(latency)
+        LLM_REQUESTS.labels(site, outcome).inc()
+        LLM_IN_FLIGHT.dec()
+
+    @staticmethod
+    def _count_tokens(site: str, stats: CallSiteStats, usage: Dict[str, int]) -> None:
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        completion_tokens = usage.get("completion_tokens", 0)
+        stats.prompt_tokens += prompt_tokens
+        stats.completion_tokens += completion_tokens
+        if prompt_tokens:
+            LLM_TOKENS.labels(site, "prompt").inc(prompt_tokens)
+        if completion_tokens:
+            LLM_TOKENS.labels(site, "completion").inc(completion_tokens)
+
+    async def stream(self, site: str, model: str, messages: List[Dict[str, str]], **params) -> AsyncIterator[str]:
+        """Run a streaming chat completion through the gateway, yielding text as it arrives."""
+        stats = self._site_stats(site)
+        stats.calls += 1
+
+        queued_at = time.perf_counter()
+        span = tracing.get_tracer().start_span("llm.stream", site=site)
+        async with self._get_global_semaphore(), self._model_semaphore(model):
+            started_at = time.perf_counter()
+            self._started(site, stats, started_at - queued_at)
+            first_token = True
+            outcome = "ok"
+            try:
+                async for chunk in self.client.stream_chat_completion(model, messages, **params):
+                    self._count_tokens(site, stats, chunk.get("usage") or {})
+
+                    choices = chunk.get("choices") or [{}]
+                    text = (choices[0].get("delta") or {}).get("content")
+                    if text:
+                        if first_token:
+                            first_token = False
+                            first_token_latency = time.perf_counter() - started_at
+                            stats.streams += 1
+                            stats.total_first_token += first_token_latency
+                            LLM_FIRST_TOKEN.labels(site).observe(first_token_latency)
+                            span.set("first_token", round(first_token_latency, 3))
+                        yield text
+            except BaseException as e:
+                outcome = "error" if isinstance(e, Exception) else "cancelled"
+                span.end(e)
+                raise
+            finally:
+                self._finished(site, stats, started_at, outcome)
+                span.end()
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        """Start the private event loop thread used by ``chat_blocking`` and ``chat_async``."""
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=self._loop.run_forever, name="llm-gateway", daemon=True)
+                thread.start()
+        return self._loop
+
+    def chat_blocking(self, site: str, model: str, messages: List[Dict[str, str]], timeout: Optional[float] = None, **params) -> Dict[str, Any]:
+        """Run ``chat`` from synchronous code and wait for the result."""
+        future = asyncio.run_coroutine_threadsafe(self.chat(site, model, messages, **params), self._ensure_loop())
+        return future.result(timeout)
+
+    async def chat_async(self, site: str, model: str, messages: List[Dict[str, str]], **params) -> Dict[str, Any]:
+        """Run ``chat`` on the private loop thread and await it from any other event loop.
+
+        For callers whose event loop is short-lived or per-request (Flask async
+        views), so every request shares one connection pool and one set of limits.
+        """
+        future = asyncio.run_coroutine_threadsafe(self.chat(site, model, messages, **params), self._ensure_loop())
+        return await asyncio.wrap_future(future)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Return a copy of the per-call-site counters."""
+        with self._stats_lock:
+            sites = list(self.stats.items())
+        return {site: stats.as_dict() for site, stats in sites}
+
+
+_shared_gateway: Optional[LLMGateway] = None
+
+
+def get_gateway() -> LLMGateway:
+    """Return the process-wide LLM gateway."""
+    global _shared_gateway
+    if _shared_gateway is None:
+        _shared_gateway = LLMGateway()
+    return _shared_gateway
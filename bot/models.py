@@ -0,0 +1,129 @@
+import sys
+import time
+from typing import Dict, Any, Optional, Tuple
+
+_intern = sys.intern
+
+
+# Field-name tuples shared by every session that answered the same fields in the same order
+_layouts: Dict[Tuple[str, ...], Tuple[str, ...]] = {}
+
+
+def _layout(fields: Tuple[str, ...]) -> Tuple[str, ...]:
+    return _layouts.setdefault(fields, tuple(_intern(name) for name in fields))
+
+
+class Session:
+    """A user's progress through one form.
+
+    Answers are kept as a tuple of values aligned to ``fields``, a tuple of field
+    names shared by every session that answered the same fields in the same
+    order (usually a prefix of the form's field list), rather than a dict or an
+    object per answer.
+    """
+
+    __slots__ = ("form_id", "form_version", "status", "current_field", "last_activity", "fields", "values", "form_data")
+
+    def __init__(
+        self,
+        form_id: str,
+        form_version: Optional[int] = None,
+        status: str = "in_progress",
+        current_field: int = 0,
+        last_activity: Optional[float] = None,
+        collected_data: Optional[Dict[str, str]] = None,
+        form_data: Optional[Dict[str, Any]] = None,
+    ):
+        self.form_id = _intern(form_id)
+        self.form_version = form_version
+        self.status = _intern(status)
+        self.current_field = current_field
+        self.last_activity = last_activity if last_activity is not None else time.time()
+        collected_data = collected_data or {}
+        self.fields = _layout(tuple(collected_data))
+        self.values = tuple(collected_data.values())
+        # Only sessions created before the form registry embed their own form copy
+        self.form_data = form_data
+
+    @property
+    def collected_data(self) -> Dict[str, str]:
+        """The collected answers as a field name -> value dict."""
+        return dict(zip(self.fields, self.values))
+
+    def set_response(self, name: str, value: str) -> None:
+        """Record (or replace) the answer to a field."""
+        if name in self.fields:
+            index = self.fields.index(name)
+            self.values = self.values[:index] + (value,) + self.values[index + 1:]
+        else:
+            self.fields = _layout(self.fields + (name,))
+            self.values += (value,)
+
+    def to_record(self) -> Dict[str, Any]:
+        """Serialize to the storage layer's session record."""
+        record = {
+            "form_id": self.form_id,
+            "status": self.status,
+            "current_field": self.current_field,
+            "last_activity": self.last_activity,
+            "collected_data": self.collected_data,
+        }
+        if self.form_version is not None:
+            record["form_version"] = self.form_version
+        if self.form_data is not None:
+            record["form_data"] = self.form_data
+        return record
+
+    @classmethod
+    def from_record(cls, record: Dict[str, Any]) -> "Session":
+        """Build a session from a storage record."""
+        return cls(
+            record["form_id"],
+            record.get("form_version"),
+            record["status"],
+            record.get("current_field", 0),
+            record.get("last_activity"),
+            record.get("collected_data"),
+            record.get("form_data"),
+        )
+
+
+class User:
+    """A registered user. The password hash is kept as raw digest bytes."""
+
+    __slots__ = ("username", "password_hash", "forms", "sessions")
+
+    def __init__(self, username: str, password_hash: bytes, forms: tuple = (), sessions: Optional[Dict[str, Session]] = None):
+        self.username = username
+        self.password_hash = password_hash
+        self.forms = forms
+        self.sessions = sessions if sessions is not None else {}
+
+    def approx_size(self) -> int:
+        """Approximate bytes held by this user and their sessions.
+
+        Shared and interned objects (field names, form ids, statuses) are not
+        counted, and neither are the form copies embedded in legacy sessions.
+        """
+        size = sys.getsizeof(self) + sys.getsizeof(self.username) + sys.getsizeof(self.password_hash) + sys.getsizeof(self.sessions)
+        for session_id, session in self.sessions.items():
+            size += sys.getsizeof(session_id) + sys.getsizeof(session) + sys.getsizeof(session.last_activity)
+            size += sys.getsizeof(session.values) + sum(sys.getsizeof(value) for value in session.values)
+        return size
+
+    def to_record(self) -> Dict[str, Any]:
+        """Serialize the account fields to the storage layer's user record (without sessions)."""
+        return {
+            "username": self.username,
+            "password_hash": self.password_hash.hex(),
+            "forms": list(self.forms),
+        }
+
+    @classmethod
+    def from_record(cls, record: Dict[str, Any]) -> "User":
+        """Build a user, with their sessions, from a storage record."""
+        sessions = {
+            session_id: Session.from_record(session)
+            for session_id, session in record.get("sessions", {}).items()
+        }
+        return cls(record["username"], bytes.fromhex(record["password_hash"]), tuple(record.get("forms", ())), sessions)
@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional, Set
+
+import discord
+
+import metrics
+import tracing
+from agent import DISCORD_SEND_TIME, MESSAGE_LIMIT
+from agent_pool import TokenBucket
+
+# Setup logging
+logger = logging.getLogger("outbound")
+
+INTERACTIVE = 0
+BULK = 1
+
+OUTBOUND_MESSAGES = metrics.counter(
+    "outbound_messages", "Queued DMs by outcome (sent, merged, failed)", ["outcome"]
+)
+
+
+def _parse_rate(spec: str, default: str) -> TokenBucket:
+    """Build a token bucket from a "messages/seconds" string."""
+    try:
+        count, _, seconds = spec.partition("/")
+        count, seconds = int(count), float(seconds)
+    except ValueError:
+        logger.warning(f"Invalid rate {spec}, using {default}")
+        return _parse_rate(default, default)
+    return TokenBucket(count / seconds, count)
+
+
+class _Outgoing:
+    __slots__ = ("text", "priority", "future", "span")
+
+    def __init__(self, text: str, priority: int, future: asyncio.Future):
+        self.text = text
+        self.priority = priority
+        self.future = future
+        # Covers the time queued as well as the send, in the trace of the code that queued it
+        self.span = tracing.get_tracer().start_span("discord.send", priority="interactive" if priority == INTERACTIVE else "bulk")
+
+
+class _Channel:
+    """Pending messages and send budget of one destination."""
+
+    __slots__ = ("destination", "pending", "bucket", "interactive")
+
+    def __init__(self, destination: discord.abc.Messageable, bucket: TokenBucket):
+        self.destination = destination
+        self.pending: Deque[_Outgoing] = deque()
+        self.bucket = bucket
+        self.interactive = 0
+
+
+class OutboundScheduler:
+    """Queues outgoing messages and sends them within Discord's rate limits.
+
+    Every destination has its own FIFO queue and token bucket
+    (OUTBOUND_CHANNEL_RATE, Discord allows 5 messages per 5 seconds per
+    channel), and all sends share a global bucket (OUTBOUND_GLOBAL_RATE).
+    Destinations with an interactive message waiting are served before bulk
+    traffic. Consecutive messages waiting for the same destination are merged
+    into one send when they fit in a single Discord message. The buckets only
+    pace sends below Discord's limits; a 429 that still gets through is retried
+    by discord.py itself after the advertised delay.
+
+    ``send`` returns as soon as the message is queued; the returned future
+    resolves to the sent ``discord.Message`` or the error that prevented it.
+    ``deliver`` waits for that outcome, for callers that must know the message
+    arrived (such as a form's first message, which fails if DMs are closed).
+    """
+
+    def __init__(self, max_concurrency: Optional[int] = None):
+        """Initialize the scheduler with limits taken from arguments or the environment."""
+        self.max_concurrency = max_concurrency or int(os.getenv("OUTBOUND_CONCURRENCY", "8"))
+        self.channel_rate = os.getenv("OUTBOUND_CHANNEL_RATE", "5/5")
+        self.global_bucket = _parse_rate(os.getenv("OUTBOUND_GLOBAL_RATE", "40/1"), "40/1")
+
+        self._channels: Dict[str, _Channel] = {}
+        # Destinations with pending messages, in the order they'll be served
+        self._ready = (OrderedDict(), OrderedDict())
+        self._in_flight: Set[str] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._task: Optional[asyncio.Task] = None
+
+        self.sent = 0
+        self.merged = 0
+        self.failed = 0
+
+    def start(self) -> None:
+        """Start the scheduler on the running event loop. Calling it again is a no-op."""
+        if self._task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        self._task = asyncio.create_task(self._run())
+
+    async def send(self, destination: discord.abc.Messageable, text: str, priority: int = INTERACTIVE) -> asyncio.Future:
+        """Queue a message and return a future for its delivery without waiting for it."""
+        self.start()
+        key = str(destination.id)
+        channel = self._channels.get(key)
+        if channel is None:
+            if len(self._channels) > 10000:
+                self._prune()
+            channel = self._channels[key] = _Channel(destination, _parse_rate(self.channel_rate, "5/5"))
+
+        future = asyncio.get_running_loop().create_future()
+        channel.pending.append(_Outgoing(text, priority, future))
+        if priority == INTERACTIVE:
+            channel.interactive += 1
+        self._mark_ready(key, channel)
+        self._wakeup.set()
+        return future
+
+    async def deliver(self, destination: discord.abc.Messageable, text: str, priority: int = INTERACTIVE) -> discord.Message:
+        """Queue a message and wait until it is sent, raising the error that prevented it."""
+        return await (await self.send(destination, text, priority))
+
+    def _prune(self) -> None:
+        """Forget idle destinations whose bucket has refilled (they carry no state)."""
+        now = time.monotonic()
+        for key, channel in list(self._channels.items()):
+            if not channel.pending and key not in self._in_flight and channel.bucket.refill(now) >= channel.bucket.capacity:
+                del self._channels[key]
+
+    def _mark_ready(self, key: str, channel: _Channel) -> None:
+        interactive, bulk = self._ready
+        interactive.pop(key, None)
+        bulk.pop(key, None)
+        if channel.pending:
+            (interactive if channel.interactive else bulk)[key] = None
+
+    def _pick(self, now: float):
+        """Return the next destination allowed to send, or None and how long until one may be."""
+        if self.global_bucket.refill(now) < 1:
+            return None, (1 - self.global_bucket.tokens) / self.global_bucket.rate
+
+        wait = None
+        for ready in self._ready:
+            for key in ready:
+                if key in self._in_flight:
+                    continue
+                channel = self._channels[key]
+                if channel.bucket.refill(now) < 1:
+                    delay = (1 - channel.bucket.tokens) / channel.bucket.rate
+                else:
+                    return key, None
+                wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def _take_batch(self, channel: _Channel) -> List[_Outgoing]:
+        """Pop the next message and any following ones that fit with it in one Discord message."""
+        batch = [channel.pending.popleft()]
+        length = len(batch[0].text)
+        while channel.pending and length + 2 + len(channel.pending[0].text) <= MESSAGE_LIMIT:
+            batch.append(channel.pending.popleft())
+            length += 2 + len(batch[-1].text)
+        channel.interactive -= sum(1 for item in batch if item.priority == INTERACTIVE)
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            await self._slots.acquire()
+            key, wait = self._pick(time.monotonic())
+            if key is None:
+                self._slots.release()
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            channel = self._channels[key]
+            batch = self._take_batch(channel)
+            channel.bucket.tokens -= 1
+            self.global_bucket.tokens -= 1
+            self._in_flight.add(key)
+            self._mark_ready(key, channel)
+            asyncio.create_task(self._deliver(key, channel, batch))
+
+    async def _deliver(self, key: str, channel: _Channel, batch: List[_Outgoing]) -> None:
+        kind = "dm" if any(item.priority == INTERACTIVE for item in batch) else "dm_bulk"
+        try:
+            with DISCORD_SEND_TIME.labels(kind).time():
+                message = await channel.destination.send("\n\n".join(item.text for item in batch))
+        except Exception as e:
+            self._fail(batch, e)
+        else:
+            self.sent += 1
+            self.merged += len(batch) - 1
+            OUTBOUND_MESSAGES.labels("sent").inc()
+            if len(batch) > 1:
+                OUTBOUND_MESSAGES.labels("merged").inc(len(batch) - 1)
+            for item in batch:
+                item.span.set("batch", len(batch))
+                item.span.end()
+                if not item.future.done():
+                    item.future.set_result(message)
+        finally:
+            self._in_flight.discard(key)
+            self._slots.release()
+            if channel.pending:
+                self._mark_ready(key, channel)
+            self._wakeup.set()
+
+    def _fail(self, batch: List[_Outgoing], error: Exception) -> None:
+        self.failed += 1
+        OUTBOUND_MESSAGES.labels("failed").inc(len(batch))
+        for item in batch:
+            item.span.end(error)
+            if not item.future.done():
+                item.future.set_exception(error)
+                # Mark the error as retrieved for callers that don't wait for delivery
+                item.future.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        """Return queue sizes and counters."""
+        interactive, bulk = self._ready
+        return {
+            "queued": sum(len(channel.pending) for channel in self._channels.values()),
+            "interactive_channels": len(interactive),
+            "bulk_channels": len(bulk),
+            "in_flight": len(self._in_flight),
+            "sent": self.sent,
+            "merged": self.merged,
+            "failed": self.failed,
+        }
@@ -0,0 +1,87 @@
+import hashlib
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+
+
+class PromptCache:
+    """Bounded LRU cache with TTL expiry for generated conversational messages.
+
+    Each key holds a pool of up to ``variants`` generated messages. Until the pool
+    is full a lookup counts as a miss so the caller generates another variant;
+    once it is full, lookups return a random variant so wording still varies
+    between users without another LLM call.
+    """
+
+    def __init__(self, max_entries: Optional[int] = None, ttl: Optional[float] = None, variants: Optional[int] = None):
+        """Initialize the cache with limits taken from arguments or the environment."""
+        self.max_entries = max_entries or int(os.getenv("PROMPT_CACHE_SIZE", "1024"))
+        self.ttl = ttl or float(os.getenv("PROMPT_CACHE_TTL", "3600"))
+        self.variants = max(1, variants or int(os.getenv("PROMPT_CACHE_VARIANTS", "1")))
+
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def make_key(model: str, *parts: Any) -> str:
+        """Hash the model and prompt inputs into a cache key."""
+        digest = hashlib.sha256(model.encode())
+        for part in parts:
+            digest.update(b"\x00")
+            digest.update(str(part).encode())
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Return a cached variant for the key, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry["expires_at"] <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+
+            if entry is None or len(entry["values"]) < self.variants:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return random.choice(entry["values"])
+
+    def put(self, key: str, value: str) -> None:
+        """Add a generated variant to the pool for a key."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = {"values": [], "expires_at": time.monotonic() + self.ttl}
+            if len(entry["values"]) < self.variants:
+                entry["values"].append(value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """Drop every cached entry."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss counters and the current size."""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
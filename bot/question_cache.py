@@ -0,0 +1,139 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+import unicodedata
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Any, Iterator, List, Optional
+
+import metrics
+from storage import BASE_DIR
+
+# Setup logging
+logger = logging.getLogger("question_cache")
+
+DEFAULT_CACHE_PATH = BASE_DIR.parent / "instance" / "question_cache.db"
+
+QUESTION_CACHE_LOOKUPS = metrics.counter("question_cache_lookups", "Question cache lookups by kind and outcome (hit, miss)", ["kind", "outcome"])
+QUESTION_CACHE_EVICTIONS = metrics.counter("question_cache_evictions", "Question arrays evicted to keep the cache under its size limit")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS question_cache (
+    key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    questions TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS question_cache_last_used ON question_cache (last_used);
+"""
+
+_WHITESPACE = re.compile(r"\s+")
+
+# Hits refresh an entry's recency at most this often, so hot entries don't write on every read
+TOUCH_INTERVAL = 60.0
+
+
+def normalize(text: Any) -> str:
+    """Canonical form of a free-text input: Unicode-normalized, case-folded, single-spaced."""
+    text = unicodedata.normalize("NFKC", str(text)).casefold()
+    return _WHITESPACE.sub(" ", text).strip().rstrip(".!")
+
+
+def prompt_version(*parts: Any) -> str:
+    """Fingerprint the prompt templates and sampling settings behind a cached result."""
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+class QuestionCache:
+    """Persistent, size-bounded cache of validated survey question arrays.
+
+    Entries are content-addressed: the key hashes the kind of request, the model,
+    a prompt version and the normalized inputs, so a repeat (or a near-repeat
+    differing only in case, spacing or trailing punctuation) is answered from
+    disk, and changing a prompt or model simply stops matching old entries. When
+    the stored arrays exceed ``max_bytes`` (QUESTION_CACHE_BYTES) the least
+    recently used ones are evicted. The SQLite file (QUESTION_CACHE_PATH) can be
+    shared by several worker processes and deleted at any time.
+    """
+
+    def __init__(self, path: Optional[Path] = None, max_bytes: Optional[int] = None):
+        """Initialize the cache with settings taken from arguments or the environment."""
+        self.path = Path(path or os.getenv("QUESTION_CACHE_PATH", DEFAULT_CACHE_PATH))
+        self.max_bytes = max_bytes or int(os.getenv("QUESTION_CACHE_BYTES", str(64 * 1024 * 1024)))
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def make_key(kind: str, model: str, version: str, *inputs: Any) -> str:
+        """Hash a request's kind, model, prompt version and normalized inputs into a cache key."""
+        payload = json.dumps([kind, model, version, [normalize(part) for part in inputs]], ensure_ascii=False)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, kind: str, key: str) -> Optional[List[Dict[str, Any]]]:
+        """Return the cached question array for a key, or None on a miss."""
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                row = conn.execute("SELECT questions FROM question_cache WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE question_cache SET last_used = ? WHERE key = ? AND last_used < ?",
+                        (now, key, now - TOUCH_INTERVAL),
+                    )
+        except sqlite3.Error as e:
+            logger.error(f"Error reading question cache {self.path}: {e}")
+            row = None
+
+        QUESTION_CACHE_LOOKUPS.labels(kind, "miss" if row is None else "hit").inc()
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, kind: str, key: str, questions: List[Dict[str, Any]]) -> None:
+        """Store a validated question array, evicting least recently used entries if over the size limit."""
+        data = json.dumps(questions, ensure_ascii=False)
+        size = len(data.encode())
+        if size > self.max_bytes:
+            return
+
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO question_cache (key, kind, questions, size, created_at, last_used) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, kind, data, size, now, now),
+                )
+                self._evict(conn)
+        except sqlite3.Error as e:
+            logger.error(f"Error writing question cache {self.path}: {e}")
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        excess = conn.execute("SELECT COALESCE(SUM(size), 0) FROM question_cache").fetchone()[0] - self.max_bytes
+        if excess <= 0:
+            return
+
+        evicted = []
+        for key, size in conn.execute("SELECT key, size FROM question_cache ORDER BY last_used"):
+            evicted.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        conn.executemany("DELETE FROM question_cache WHERE key = ?", evicted)
+        QUESTION_CACHE_EVICTIONS.inc(len(evicted))
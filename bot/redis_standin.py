@@ -0,0 +1,250 @@
+"""In-memory stand-in for a Redis server, for local multi-worker runs and tests.
+
+Implements the subset of the Redis protocol used by survey_state.RedisSurveyState:
+PING, AUTH, SELECT, GET, SET (NX, XX, EX, PX), DEL, EXISTS, EXPIRE, TTL,
+FLUSHDB and optimistic transactions (WATCH, UNWATCH, MULTI, EXEC, DISCARD).
+Everything lives in memory and is lost when the server stops.
+
+    python redis_standin.py --port 6379
+    SURVEY_STATE=redis SURVEY_STATE_URL=redis://127.0.0.1:6379/0 gunicorn -w 4 server:app
+"""
+import argparse
+import socketserver
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class RedisError(Exception):
+    """A command error, sent to the client as an error reply."""
+
+
+def _encode(reply: Any) -> bytes:
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, RedisError):
+        return b"-ERR %s\r\n" % str(reply).encode()
+    if isinstance(reply, str):
+        return b"+%s\r\n" % reply.encode()
+    if isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, bytes):
+        return b"$%d\r\n%s\r\n" % (len(reply), reply)
+    if isinstance(reply, list):
+        return b"*%d\r\n" % len(reply) + b"".join(_encode(item) for item in reply)
+    raise TypeError(f"Cannot encode {type(reply).__name__}")
+
+
+NULL_ARRAY = b"*-1\r\n"
+
+
+class Keyspace:
+    """Keys with optional expiry, and a version per key so WATCH can detect changes."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values: Dict[bytes, Tuple[bytes, Optional[float]]] = {}
+        self.versions: Dict[bytes, int] = {}
+        self.epoch = 0
+
+    def version(self, key: bytes) -> Tuple[int, int]:
+        self._expire(key)
+        return self.epoch, self.versions.get(key, 0)
+
+    def _touch(self, key: bytes) -> None:
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def _expire(self, key: bytes) -> None:
+        item = self.values.get(key)
+        if item is not None and item[1] is not None and item[1] <= time.monotonic():
+            del self.values[key]
+            self._touch(key)
+
+    def get(self, key: bytes) -> Optional[bytes]:
+        self._expire(key)
+        item = self.values.get(key)
+        return item[0] if item is not None else None
+
+    def set(self, key: bytes, value: bytes, expires_at: Optional[float]) -> None:
+        self.values[key] = (value, expires_at)
+        self._touch(key)
+
+    def delete(self, key: bytes) -> bool:
+        self._expire(key)
+        if self.values.pop(key, None) is None:
+            return False
+        self._touch(key)
+        return True
+
+    def execute(self, name: str, args: List[bytes]) -> Any:
+        """Run one data command; the caller holds ``lock``."""
+        if name == "PING":
+            return args[0] if args else "PONG"
+        if name == "GET":
+            return self.get(args[0])
+        if name == "SET":
+            key, value, options = args[0], args[1], [arg.upper() for arg in args[2:]]
+            expires_at = None
+            for unit, scale in ((b"EX", 1.0), (b"PX", 0.001)):
+                if unit in options:
+                    expires_at = time.monotonic() + int(options[options.index(unit) + 1]) * scale
+            exists = self.get(key) is not None
+            if (b"NX" in options and exists) or (b"XX" in options and not exists):
+                return None
+            self.set(key, value, expires_at)
+            return "OK"
+        if name == "DEL":
+            return sum(self.delete(key) for key in args)
+        if name == "EXISTS":
+            return sum(self.get(key) is not None for key in args)
+        if name == "EXPIRE":
+            value = self.get(args[0])
+            if value is None:
+                return 0
+            self.set(args[0], value, time.monotonic() + int(args[1]))
+            return 1
+        if name == "TTL":
+            self._expire(args[0])
+            item = self.values.get(args[0])
+            if item is None:
+                return -2
+            return -1 if item[1] is None else max(0, round(item[1] - time.monotonic()))
+        if name == "FLUSHDB":
+            self.values.clear()
+            self.epoch += 1
+            return "OK"
+        raise RedisError(f"unknown command '{name}'")
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """One client connection, with its own WATCH and MULTI state."""
+
+    server: "_Server"
+
+    def _read_command(self) -> Optional[List[bytes]]:
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def handle(self) -> None:
+        keyspace = self.server.keyspace
+        watched: Dict[bytes, Tuple[int, int]] = {}
+        queued: Optional[List[Tuple[str, List[bytes]]]] = None
+
+        while True:
+            command = self._read_command()
+            if command is None:
+                return
+            if not command:
+                continue
+            name, args = command[0].decode().upper(), command[1:]
+
+            if name in ("AUTH", "SELECT"):
+                reply: Any = "OK"
+            elif name == "QUIT":
+                self.wfile.write(_encode("OK"))
+                return
+            elif name == "WATCH":
+                with keyspace.lock:
+                    for key in args:
+                        watched.setdefault(key, keyspace.version(key))
+                reply = "OK"
+            elif name == "UNWATCH":
+                watched.clear()
+                reply = "OK"
+            elif name == "MULTI":
+                queued = []
+                reply = "OK"
+            elif name == "DISCARD":
+                queued = None
+                watched.clear()
+                reply = "OK"
+            elif name == "EXEC":
+                if queued is None:
+                    reply = RedisError("EXEC without MULTI")
+                else:
+                    with keyspace.lock:
+                        if any(keyspace.version(key) != version for key, version in watched.items()):
+                            reply = None
+                        else:
+                            reply = [self._run(keyspace, queued_name, queued_args) for queued_name, queued_args in queued]
+                    queued = None
+                    watched.clear()
+                    if reply is None:
+                        self.wfile.write(NULL_ARRAY)
+                        continue
+            elif queued is not None:
+                queued.append((name, args))
+                reply = "QUEUED"
+            else:
+                with keyspace.lock:
+                    reply = self._run(keyspace, name, args)
+            self.wfile.write(_encode(reply))
+
+    @staticmethod
+    def _run(keyspace: Keyspace, name: str, args: List[bytes]) -> Any:
+        try:
+            return keyspace.execute(name, args)
+        except RedisError as e:
+            return e
+        except (IndexError, ValueError):
+            return RedisError(f"wrong arguments for '{name}' command")
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: Tuple[str, int]):
+        super().__init__(address, _Handler)
+        self.keyspace = Keyspace()
+
+
+class RedisStandIn:
+    """Runs the stand-in server on a background thread."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self._server = _Server((host, port))
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"redis://{host}:{port}/0"
+
+    def start(self) -> str:
+        """Start serving and return the redis:// URL to connect to."""
+        self._thread = threading.Thread(target=self._server.serve_forever, name="redis-standin", daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    args = parser.parse_args()
+
+    server = _Server((args.host, args.port))
+    print(f"Redis stand-in listening on redis://{args.host}:{args.port}/0")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+import hashlib
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Set, Tuple
+
+NUM_PERMUTATIONS = 64
+BANDS = 16
+ROWS = NUM_PERMUTATIONS // BANDS
+SHINGLE_SIZE = 4
+
+_PRIME = (1 << 61) - 1
+_random = random.Random(0x5EED)
+_PERMUTATIONS = [(_random.randrange(1, _PRIME), _random.randrange(0, _PRIME)) for _ in range(NUM_PERMUTATIONS)]
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+
+CacheKey = Tuple[str, str]
+
+
+def normalize(text: str) -> str:
+    """Fold case, punctuation and whitespace so trivially different phrasings compare equal."""
+    return _WHITESPACE.sub(" ", _PUNCTUATION.sub(" ", text.casefold())).strip()
+
+
+def signature(normalized: str) -> Tuple[int, ...]:
+    """MinHash signature of the character shingles of a normalized text."""
+    if len(normalized) <= SHINGLE_SIZE:
+        shingles = {normalized}
+    else:
+        shingles = {normalized[i:i + SHINGLE_SIZE] for i in range(len(normalized) - SHINGLE_SIZE + 1)}
+    hashes = [int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "big") for shingle in shingles]
+    return tuple(min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMUTATIONS)
+
+
+def similarity(first: Tuple[int, ...], second: Tuple[int, ...]) -> float:
+    """Estimate the Jaccard similarity of two texts from their signatures."""
+    return sum(1 for a, b in zip(first, second) if a == b) / NUM_PERMUTATIONS
+
+
+class ResponseCache:
+    """Cache of agent replies for repeated questions, within a caller-chosen scope (a guild or one DM).
+
+    Lookups first try the normalized question text, then near-duplicates: a
+    locality-sensitive index over MinHash signatures finds candidates, and the
+    most similar one is used if its estimated similarity reaches ``threshold``.
+    Entries expire after ``ttl`` seconds and the least recently used are evicted
+    beyond ``max_entries``. Questions shorter than ``min_words`` (usually
+    follow-ups that depend on the conversation) are never cached.
+    """
+
+    def __init__(
+        self,
+        max_entries: Optional[int] = None,
+        ttl: Optional[float] = None,
+        threshold: Optional[float] = None,
+        min_words: Optional[int] = None,
+    ):
+        """Initialize the cache with limits taken from arguments or the environment."""
+        self.max_entries = max_entries or int(os.getenv("RESPONSE_CACHE_SIZE", "2000"))
+        self.ttl = ttl or float(os.getenv("RESPONSE_CACHE_TTL", "21600"))
+        self.threshold = threshold or float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.85"))
+        self.min_words = min_words or int(os.getenv("RESPONSE_CACHE_MIN_WORDS", "3"))
+
+        self._entries: "OrderedDict[CacheKey, Dict[str, Any]]" = OrderedDict()
+        self._buckets: Dict[Tuple[str, int, Tuple[int, ...]], Set[CacheKey]] = {}
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _cacheable(self, normalized: str) -> bool:
+        return normalized.count(" ") + 1 >= self.min_words
+
+    @staticmethod
+    def _bands(scope: str, sig: Tuple[int, ...]) -> List[Tuple[str, int, Tuple[int, ...]]]:
+        return [(scope, band, sig[band * ROWS:(band + 1) * ROWS]) for band in range(BANDS)]
+
+    def _remove(self, key: CacheKey) -> None:
+        entry = self._entries.pop(key)
+        for bucket in self._bands(key[0], entry["signature"]):
+            keys = self._buckets.get(bucket)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._buckets[bucket]
+
+    def _live(self, key: CacheKey, now: float) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is not None and entry["expires_at"] <= now:
+            self._remove(key)
+            self.expirations += 1
+            return None
+        return entry
+
+    def get(self, scope: str, question: str) -> Optional[str]:
+        """Return the cached reply to a question or a near-duplicate of it, or None."""
+        normalized = normalize(question)
+        if not self._cacheable(normalized):
+            return None
+
+        now = time.monotonic()
+        with self._lock:
+            key = (scope, normalized)
+            entry = self._live(key, now)
+            if entry is not None:
+                self.exact_hits += 1
+            else:
+                sig = signature(normalized)
+                best_key, best_score = None, self.threshold
+                candidates = set()
+                for bucket in self._bands(scope, sig):
+                    candidates.update(self._buckets.get(bucket, ()))
+                for candidate in candidates:
+                    score = similarity(sig, self._entries[candidate]["signature"])
+                    if score >= best_score:
+                        best_key, best_score = candidate, score
+                if best_key is not None:
+                    entry = self._live(best_key, now)
+                    key = best_key
+                if entry is None:
+                    self.misses += 1
+                    return None
+                self.near_hits += 1
+
+            self._entries.move_to_end(key)
+            return entry["response"]
+
+    def put(self, scope: str, question: str, response: str) -> None:
+        """Cache the reply to a question."""
+        normalized = normalize(question)
+        if not self._cacheable(normalized) or not response:
+            return
+
+        sig = signature(normalized)
+        key = (scope, normalized)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = {"response": response, "signature": sig, "expires_at": time.monotonic() + self.ttl}
+            for bucket in self._bands(scope, sig):
+                self._buckets.setdefault(bucket, set()).add(key)
+
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self, scope: Optional[str] = None) -> None:
+        """Drop every cached reply, or only those of one scope."""
+        with self._lock:
+            for key in [key for key in self._entries if scope is None or key[0] == scope]:
+                self._remove(key)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss counters and the current size."""
+        hits = self.exact_hits + self.near_hits
+        lookups = hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "exact_hits": self.exact_hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
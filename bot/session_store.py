@@ -0,0 +1,135 @@
+import secrets
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from models import Session
+
+IN_PROGRESS = "in_progress"
+COMPLETED = "completed"
+EXPIRED = "expired"
+
+SessionKey = Tuple[str, str]
+
+
+class SessionStore:
+    """In-memory index over form sessions.
+
+    The per-user index is each user's own ``sessions`` mapping, shared rather
+    than copied (see ``add_user``); the store adds secondary indexes by status
+    and form_id, plus a direct user -> active session map, so hot-path lookups
+    stay constant-time however long a user's history gets. Sessions are keyed
+    by ``(user_id, session_id)`` because older data reused IDs across users;
+    a session indexed by ``add`` or ``add_user`` shares one key tuple between
+    both secondary indexes, and the status and form_id keys are interned by
+    the models. All status changes must go through ``set_status`` to keep the
+    indexes consistent.
+
+    Only users loaded into memory are indexed. UserManager always loads users
+    with an in-progress session, so the active map and ``idle_sessions`` are
+    complete; status and form lookups cover loaded users only.
+    """
+
+    def __init__(self):
+        self._by_user: Dict[str, Dict[str, Session]] = {}
+        self._by_status: Dict[str, Set[SessionKey]] = {}
+        self._by_form: Dict[str, Set[SessionKey]] = {}
+        self._active: Dict[str, str] = {}
+
+    def __len__(self) -> int:
+        return sum(len(sessions) for sessions in self._by_user.values())
+
+    @staticmethod
+    def new_session_id() -> str:
+        """Generate a random, collision-free session ID."""
+        return f"session_{secrets.token_hex(12)}"
+
+    def add_user(self, user_id: str, sessions: Dict[str, Session]) -> None:
+        """Index every session of a user, sharing their ``sessions`` mapping."""
+        self._by_user[user_id] = sessions
+        for session_id, session in sessions.items():
+            self._index(user_id, session_id, session)
+
+    def add(self, user_id: str, session_id: str, session: Session) -> None:
+        """Index a session."""
+        self.remove(user_id, session_id)
+        self._by_user.setdefault(user_id, {})[session_id] = session
+        self._index(user_id, session_id, session)
+
+    def _index(self, user_id: str, session_id: str, session: Session) -> None:
+        key = (user_id, session_id)
+        self._by_status.setdefault(session.status, set()).add(key)
+        self._by_form.setdefault(session.form_id, set()).add(key)
+        if session.status == IN_PROGRESS:
+            self._active[user_id] = session_id
+
+    def remove_user(self, user_id: str) -> None:
+        """Drop every session of a user from the indexes, leaving their ``sessions`` mapping intact."""
+        sessions = self._by_user.pop(user_id, {})
+        for session_id, session in sessions.items():
+            key = (user_id, session_id)
+            self._by_status.get(session.status, set()).discard(key)
+            self._by_form.get(session.form_id, set()).discard(key)
+        self._active.pop(user_id, None)
+
+    def remove(self, user_id: str, session_id: str) -> None:
+        """Drop a session from every index."""
+        key = (user_id, session_id)
+        session = self._by_user.get(user_id, {}).pop(session_id, None)
+        if session is None:
+            return
+        self._by_status.get(session.status, set()).discard(key)
+        self._by_form.get(session.form_id, set()).discard(key)
+        if self._active.get(user_id) == session_id:
+            del self._active[user_id]
+
+    def get(self, user_id: str, session_id: str) -> Optional[Session]:
+        """Get a session."""
+        return self._by_user.get(user_id, {}).get(session_id)
+
+    def active_session_id(self, user_id: str) -> Optional[str]:
+        """Get the ID of a user's in-progress session."""
+        return self._active.get(user_id)
+
+    def set_status(self, user_id: str, session_id: str, status: str) -> None:
+        """Change a session's status and update the indexes."""
+        key = (user_id, session_id)
+        session = self._by_user[user_id][session_id]
+        self._by_status.get(session.status, set()).discard(key)
+        session.status = status
+        self._by_status.setdefault(status, set()).add(key)
+
+        if status == IN_PROGRESS:
+            self._active[user_id] = session_id
+        elif self._active.get(user_id) == session_id:
+            del self._active[user_id]
+
+    def touch(self, user_id: str, session_id: str) -> None:
+        """Record activity on a session."""
+        session = self.get(user_id, session_id)
+        if session is not None:
+            session.last_activity = time.time()
+
+    def for_user(self, user_id: str) -> Set[str]:
+        """IDs of every session of a user."""
+        return set(self._by_user.get(user_id, {}))
+
+    def with_status(self, status: str) -> Set[SessionKey]:
+        """(user_id, session_id) of every session with a status."""
+        return set(self._by_status.get(status, ()))
+
+    def for_form(self, form_id: str) -> Set[SessionKey]:
+        """(user_id, session_id) of every session of a form."""
+        return set(self._by_form.get(form_id, ()))
+
+    def active_users(self) -> Dict[str, str]:
+        """Map of user ID to in-progress session ID."""
+        return dict(self._active)
+
+    def idle_sessions(self, ttl: float, now: Optional[float] = None) -> List[SessionKey]:
+        """(user_id, session_id) of in-progress sessions idle for longer than ``ttl`` seconds."""
+        cutoff = (now if now is not None else time.time()) - ttl
+        return [
+            (user_id, session_id)
+            for user_id, session_id in self._active.items()
+            if self._by_user[user_id][session_id].last_activity < cutoff
+        ]
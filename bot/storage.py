@@ -0,0 +1,446 @@
+import asyncio
+import json
+import logging
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Any, Optional
+
+import metrics
+
+# Setup logging
+logger = logging.getLogger("storage")
+
+STORE_WRITE_TIME = metrics.histogram(
+    "user_store_write_seconds", "Time to persist one batch of user store changes", ["backend"]
+)
+STORE_BYTES_WRITTEN = metrics.counter("user_store_bytes_written", "Bytes written by the user store", ["backend"])
+STORE_CHANGES = metrics.counter("user_store_changes", "Row-level changes persisted by the user store", ["backend"])
+# SQLite result codes worth retrying: another connection holds a lock, or the disk is full
+TRANSIENT_ERRORS = {sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED, sqlite3.SQLITE_FULL}
+
+STORE_WRITE_ERRORS = metrics.counter(
+    "user_store_write_errors", "Failed user store writes by outcome (retried, dropped)", ["backend", "outcome"]
+)
+
+BASE_DIR = Path(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_DB_PATH = BASE_DIR.parent / "instance" / "users.db"
+
+
+def _thread_written_bytes() -> Optional[int]:
+    """Bytes the calling thread has passed to write syscalls so far, where the OS reports it (Linux)."""
+    try:
+        with open("/proc/thread-self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class UserStore:
+    """Interface for persisting users, form sessions and collected fields.
+
+    Every save method describes one row-level change so backends can avoid
+    rewriting unrelated data. Backends may persist asynchronously; ``flush``
+    waits until every change handed over so far is durable.
+    """
+
+    def load_users(self) -> Dict[str, Dict[str, Any]]:
+        """Load every user, with their sessions, as storage records."""
+        raise NotImplementedError
+
+    def load_user(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Load one user, with their sessions, or None if they don't exist."""
+        return self.load_users().get(user_id)
+
+    async def load_user_async(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """``load_user`` for callers on the event loop; backends whose reads block override it."""
+        return self.load_user(user_id)
+
+    def load_active_users(self) -> Dict[str, Dict[str, Any]]:
+        """Load only the users with an in-progress session, with all their sessions."""
+        return {
+            user_id: user
+            for user_id, user in self.load_users().items()
+            if any(session["status"] == "in_progress" for session in user.get("sessions", {}).values())
+        }
+
+    def save_user(self, user_id: str, user: Dict[str, Any]) -> None:
+        """Insert or update a user's account fields (sessions are saved separately)."""
+        raise NotImplementedError
+
+    def save_session(self, user_id: str, session_id: str, session: Dict[str, Any]) -> None:
+        """Insert or update a session's state, without its collected data."""
+        raise NotImplementedError
+
+    def save_field(self, user_id: str, session_id: str, field_name: str, value: str) -> None:
+        """Insert or update one collected field of a session."""
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        """Block until all pending changes are persisted."""
+
+    def pending(self) -> int:
+        """Number of changes handed over but not yet persisted."""
+        return 0
+
+    def close(self) -> None:
+        """Flush pending changes and release resources."""
+        self.flush()
+
+
+class JSONUserStore(UserStore):
+    """Stores everything in a single JSON file, rewritten on every change."""
+
+    def __init__(self, data_file: Path):
+        self.data_file = Path(data_file)
+        self._data: Optional[Dict[str, Dict[str, Any]]] = None
+
+    def _read(self) -> Dict[str, Dict[str, Any]]:
+        if self._data is None:
+            self._data = {}
+            if self.data_file.exists():
+                try:
+                    with open(self.data_file, 'r') as f:
+                        self._data = json.load(f)
+                except json.JSONDecodeError:
+                    logger.error(f"Error decoding {self.data_file}. Starting with empty user database.")
+        return self._data
+
+    def load_users(self) -> Dict[str, Dict[str, Any]]:
+        return json.loads(json.dumps(self._read()))
+
+    def load_user(self, user_id: str) -> Optional[Dict[str, Any]]:
+        user = self._read().get(user_id)
+        return json.loads(json.dumps(user)) if user is not None else None
+
+    def _write(self) -> None:
+        with STORE_WRITE_TIME.labels("json").time():
+            with open(self.data_file, 'w') as f:
+                json.dump(self._data, f, indent=2)
+                written = f.tell()
+        STORE_BYTES_WRITTEN.labels("json").inc(written)
+        STORE_CHANGES.labels("json").inc()
+
+    def save_user(self, user_id: str, user: Dict[str, Any]) -> None:
+        record = self._read().setdefault(user_id, {"sessions": {}})
+        record.update({key: value for key, value in user.items() if key != "sessions"})
+        self._write()
+
+    def save_session(self, user_id: str, session_id: str, session: Dict[str, Any]) -> None:
+        sessions = self._read()[user_id]["sessions"]
+        collected = sessions.get(session_id, {}).get("collected_data", {})
+        sessions[session_id] = {**session, "collected_data": collected}
+        self._write()
+
+    def save_field(self, user_id: str, session_id: str, field_name: str, value: str) -> None:
+        self._read()[user_id]["sessions"][session_id]["collected_data"][field_name] = value
+        self._write()
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bot_users (
+    user_id TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    password_hash TEXT NOT NULL,
+    forms TEXT NOT NULL DEFAULT '[]'
+);
+CREATE TABLE IF NOT EXISTS bot_sessions (
+    user_id TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    form_id TEXT NOT NULL,
+    form_version INTEGER,
+    form_data TEXT,
+    status TEXT NOT NULL,
+    current_field INTEGER NOT NULL DEFAULT 0,
+    last_activity REAL,
+    PRIMARY KEY (user_id, session_id)
+);
+CREATE INDEX IF NOT EXISTS bot_sessions_status ON bot_sessions (status);
+CREATE INDEX IF NOT EXISTS bot_sessions_form ON bot_sessions (form_id);
+CREATE INDEX IF NOT EXISTS bot_sessions_active ON bot_sessions (user_id) WHERE status = 'in_progress';
+CREATE TABLE IF NOT EXISTS bot_session_fields (
+    user_id TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    field_name TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (user_id, session_id, field_name)
+);
+"""
+
+_STOP = object()
+
+
+class SQLiteUserStore(UserStore):
+    """SQLite backend in WAL mode with row-level updates.
+
+    Writes are handed to a single background thread, so callers on the event loop
+    never block on disk I/O. The writer drains everything queued since its last
+    commit into one transaction, which keeps commit cost flat under bursts. A
+    batch that fails on a transient error (a busy, locked or full database) is
+    retried with backoff, up to ``retries`` times (USER_STORE_RETRIES); after
+    that, or on any other error, its changes are applied one at a time so only
+    the ones the database rejects are dropped.
+    Reads on the event loop go through ``load_user_async``, which runs the query
+    on a worker thread.
+    """
+
+    def __init__(self, db_path: Path = DEFAULT_DB_PATH):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+
+        conn = self._connect()
+        with conn:
+            conn.executescript(SCHEMA)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(bot_sessions)")}
+            for column, column_type in (("last_activity", "REAL"), ("form_version", "INTEGER")):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE bot_sessions ADD COLUMN {column} {column_type}")
+        conn.close()
+
+        self.retry_delay = float(os.getenv("USER_STORE_RETRY_DELAY", "0.1"))
+        self.retry_max = float(os.getenv("USER_STORE_RETRY_MAX", "30"))
+        self.retries = int(os.getenv("USER_STORE_RETRIES", "10"))
+        self._queue: "queue.Queue" = queue.Queue()
+        self._unwritten = 0
+        self._writer = threading.Thread(target=self._run_writer, name="sqlite-user-store", daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _run_writer(self) -> None:
+        conn = self._connect()
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            changes = [item for item in batch if isinstance(item, tuple)]
+            if changes:
+                written_before = _thread_written_bytes()
+                self._write_batch(conn, changes)
+                STORE_CHANGES.labels("sqlite").inc(len(changes))
+                written_after = _thread_written_bytes()
+                if written_before is not None and written_after is not None:
+                    STORE_BYTES_WRITTEN.labels("sqlite").inc(written_after - written_before)
+
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+                elif item is _STOP:
+                    running = False
+        conn.close()
+
+    @staticmethod
+    def _transient(error: sqlite3.Error) -> bool:
+        code = getattr(error, "sqlite_errorcode", None)
+        if code is not None:
+            # Extended codes (e.g. SQLITE_BUSY_SNAPSHOT) keep the primary code in the low byte
+            return code & 0xFF in TRANSIENT_ERRORS
+        message = str(error)
+        return "locked" in message or "busy" in message or "full" in message
+
+    def _write_batch(self, conn: sqlite3.Connection, changes: list) -> None:
+        """Commit a batch, retrying transient failures with backoff, then falling back to one change at a time."""
+        delay = self.retry_delay
+        self._unwritten = len(changes)
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    with STORE_WRITE_TIME.labels("sqlite").time(), conn:
+                        for change in changes:
+                            conn.execute(*change)
+                    return
+                except sqlite3.Error as e:
+                    if not self._transient(e) or attempt == self.retries:
+                        # One bad change would fail every retry, so apply them one by one
+                        logger.error(f"Error writing {len(changes)} changes to {self.db_path}, writing them one at a time: {e}")
+                        break
+                    STORE_WRITE_ERRORS.labels("sqlite", "retried").inc()
+                    logger.warning(f"Error writing {len(changes)} changes to {self.db_path}, retrying in {delay:.1f}s: {e}")
+                    time.sleep(delay)
+                    delay = min(delay * 2, self.retry_max)
+
+            for change in changes:
+                try:
+                    with conn:
+                        conn.execute(*change)
+                except sqlite3.Error as e:
+                    STORE_WRITE_ERRORS.labels("sqlite", "dropped").inc()
+                    logger.error(f"Dropped a change that {self.db_path} rejected ({change[0].split(' (')[0]}): {e}")
+        finally:
+            self._unwritten = 0
+
+    def is_empty(self) -> bool:
+        """Return True if no user has been stored yet."""
+        self.flush()
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT 1 FROM bot_users LIMIT 1").fetchone() is None
+        finally:
+            conn.close()
+
+    def _load(self, user_filter: str = "", params: tuple = ()) -> Dict[str, Dict[str, Any]]:
+        """Load the users matching a ``WHERE`` clause on ``user_id``, with their sessions and fields."""
+        self.flush()
+        conn = self._connect()
+        try:
+            users = {}
+            for user_id, username, password_hash, forms in conn.execute(
+                f"SELECT user_id, username, password_hash, forms FROM bot_users {user_filter}", params
+            ):
+                users[user_id] = {
+                    "username": username,
+                    "password_hash": password_hash,
+                    "sessions": {},
+                    "forms": json.loads(forms),
+                }
+
+            for user_id, session_id, form_id, form_version, form_data, status, current_field, last_activity in conn.execute(
+                "SELECT user_id, session_id, form_id, form_version, form_data, status, current_field, last_activity "
+                f"FROM bot_sessions {user_filter} ORDER BY rowid", params
+            ):
+                if user_id in users:
+                    session = {
+                        "form_id": form_id,
+                        "status": status,
+                        "current_field": current_field,
+                        "collected_data": {},
+                    }
+                    # Older sessions embed the form definition instead of a registry version
+                    if form_version is not None:
+                        session["form_version"] = form_version
+                    if form_data:
+                        session["form_data"] = json.loads(form_data)
+                    if last_activity is not None:
+                        session["last_activity"] = last_activity
+                    users[user_id]["sessions"][session_id] = session
+
+            for user_id, session_id, field_name, value in conn.execute(
+                f"SELECT user_id, session_id, field_name, value FROM bot_session_fields {user_filter} ORDER BY rowid", params
+            ):
+                session = users.get(user_id, {}).get("sessions", {}).get(session_id)
+                if session is not None:
+                    session["collected_data"][field_name] = value
+            return users
+        finally:
+            conn.close()
+
+    def load_users(self) -> Dict[str, Dict[str, Any]]:
+        return self._load()
+
+    def load_user(self, user_id: str) -> Optional[Dict[str, Any]]:
+        return self._load("WHERE user_id = ?", (user_id,)).get(user_id)
+
+    async def load_user_async(self, user_id: str) -> Optional[Dict[str, Any]]:
+        # The read waits for pending writes and queries disk, so keep it off the event loop
+        return await asyncio.get_running_loop().run_in_executor(None, self.load_user, user_id)
+
+    def load_active_users(self) -> Dict[str, Dict[str, Any]]:
+        # Served by the partial bot_sessions_active index, so cost tracks active sessions, not users
+        return self._load(
+            "WHERE user_id IN (SELECT user_id FROM bot_sessions WHERE status = 'in_progress')"
+        )
+
+    def save_user(self, user_id: str, user: Dict[str, Any]) -> None:
+        self._queue.put((
+            "INSERT INTO bot_users (user_id, username, password_hash, forms) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET username = excluded.username, "
+            "password_hash = excluded.password_hash, forms = excluded.forms",
+            (user_id, user["username"], user["password_hash"], json.dumps(user.get("forms", []))),
+        ))
+
+    def save_session(self, user_id: str, session_id: str, session: Dict[str, Any]) -> None:
+        self._queue.put((
+            "INSERT INTO bot_sessions (user_id, session_id, form_id, form_version, form_data, status, current_field, last_activity) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (user_id, session_id) DO UPDATE SET "
+            "form_id = excluded.form_id, form_version = excluded.form_version, form_data = excluded.form_data, "
+            "status = excluded.status, current_field = excluded.current_field, last_activity = excluded.last_activity",
+            (user_id, session_id, session["form_id"], session.get("form_version"),
+             json.dumps(session["form_data"]) if session.get("form_data") else None,
+             session["status"], session["current_field"], session.get("last_activity")),
+        ))
+
+    def save_field(self, user_id: str, session_id: str, field_name: str, value: str) -> None:
+        self._queue.put((
+            "INSERT INTO bot_session_fields (user_id, session_id, field_name, value) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (user_id, session_id, field_name) DO UPDATE SET value = excluded.value",
+            (user_id, session_id, field_name, value),
+        ))
+
+    def pending(self) -> int:
+        return self._queue.qsize() + self._unwritten
+
+    def flush(self) -> None:
+        if not self._writer.is_alive():
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        # The writer may stop (close) before it reaches the event
+        while not done.wait(1.0):
+            if not self._writer.is_alive():
+                return
+
+    def close(self) -> None:
+        if self._writer.is_alive():
+            self._queue.put(_STOP)
+            self._writer.join()
+
+
+def migrate_json_to_sqlite(json_path: Path, db_path: Path = DEFAULT_DB_PATH) -> int:
+    """Copy every user and session from a users.json file into a SQLite store.
+
+    Returns the number of users migrated. Existing rows with the same keys are
+    overwritten, so running the migration twice is harmless.
+    """
+    users = JSONUserStore(json_path).load_users()
+    store = SQLiteUserStore(db_path)
+    try:
+        for user_id, user in users.items():
+            store.save_user(user_id, user)
+            for session_id, session in user.get("sessions", {}).items():
+                store.save_session(user_id, session_id, session)
+                for field_name, value in session.get("collected_data", {}).items():
+                    store.save_field(user_id, session_id, field_name, value)
+    finally:
+        store.close()
+    return len(users)
+
+
+def create_store(data_file: Path) -> UserStore:
+    """Create the store selected by USER_STORE ("sqlite" by default, or "json").
+
+    The first time the SQLite store is used, users from an existing JSON data
+    file are migrated into it.
+    """
+    backend = os.getenv("USER_STORE", "sqlite").lower()
+    if backend == "json":
+        return JSONUserStore(data_file)
+
+    db_path = Path(os.getenv("USER_DB_PATH", DEFAULT_DB_PATH))
+    store = SQLiteUserStore(db_path)
+    if data_file.exists() and store.is_empty():
+        count = migrate_json_to_sqlite(data_file, db_path)
+        logger.info(f"Migrated {count} users from {data_file} to {db_path}")
+    return store
+
+
+if __name__ == "__main__":
+    # One-shot migration: python storage.py [users.json] [users.db]
+    source = Path(sys.argv[1]) if len(sys.argv) > 1 else BASE_DIR / "users.json"
+    target = Path(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_DB_PATH
+    print(f"Migrated {migrate_json_to_sqlite(source, target)} users from {source} to {target}")
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import os
+import re
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Union
+
+import discord
+
+from outbound import BULK, OutboundScheduler
+
+# Setup logging
+logger = logging.getLogger("survey_dispatch")
+
+NOT_FOUND = "user not found"
+NOT_REGISTERED = "not registered"
+IN_PROGRESS = "already filling in a form"
+DMS_CLOSED = "DMs closed"
+FAILED = "failed to start"
+
+_USER_ID = re.compile(r"\d{15,20}")
+
+Target = Union[str, discord.abc.User]
+
+
+def parse_user_ids(text: str) -> List[str]:
+    """Extract every Discord user ID from free text (mentions, CSV, one per line...)."""
+    return list(dict.fromkeys(_USER_ID.findall(text)))
+
+
+class DispatchReport:
+    """Outcome of a bulk survey dispatch."""
+
+    def __init__(self, total: int):
+        self.total = total
+        self.started: List[str] = []
+        self.failures: Dict[str, List[str]] = {}
+        self.started_at = time.monotonic()
+        self.finished_at: Optional[float] = None
+
+    @property
+    def done(self) -> int:
+        return len(self.started) + sum(len(user_ids) for user_ids in self.failures.values())
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    def fail(self, user_id: str, reason: str) -> None:
+        self.failures.setdefault(reason, []).append(user_id)
+
+    def summary(self) -> str:
+        """One-line progress or result summary."""
+        failed = self.done - len(self.started)
+        return f"{self.done}/{self.total} processed, {len(self.started)} started, {failed} failed ({self.elapsed:.0f}s)"
+
+    def failure_csv(self) -> str:
+        """Failures as ``user_id,reason`` lines."""
+        lines = ["user_id,reason"]
+        for reason, user_ids in self.failures.items():
+            lines.extend(f"{user_id},{reason}" for user_id in user_ids)
+        return "\n".join(lines) + "\n"
+
+
+class SurveyDispatcher:
+    """Starts a form for many users at once.
+
+    Users are resolved and DMed concurrently, with at most ``concurrency``
+    (DISPATCH_CONCURRENCY) in flight. DMs go through the outbound scheduler as
+    bulk traffic, so interactive replies to other users aren't held up behind
+    the batch. A user who can't be reached is recorded in the report and the
+    batch carries on.
+    """
+
+    def __init__(
+        self,
+        bot: discord.Client,
+        form_handler,
+        outbound: OutboundScheduler,
+        on_started: Callable[[str, str], None],
+        concurrency: Optional[int] = None,
+    ):
+        """Initialize the dispatcher; ``on_started(user_id, session_id)`` is called for each started session."""
+        self.bot = bot
+        self.form_handler = form_handler
+        self.outbound = outbound
+        self.on_started = on_started
+        self.concurrency = concurrency or int(os.getenv("DISPATCH_CONCURRENCY", "8"))
+
+    async def _resolve(self, target: Target) -> Optional[discord.abc.User]:
+        if not isinstance(target, str):
+            return target
+        user = self.bot.get_user(int(target))
+        if user is None:
+            try:
+                user = await self.bot.fetch_user(int(target))
+            except discord.NotFound:
+                return None
+        return user
+
+    async def _dispatch_one(self, target: Target, form_id: str, report: DispatchReport) -> None:
+        user_id = target if isinstance(target, str) else str(target.id)
+        user_manager = self.form_handler.user_manager
+        if await user_manager.get_user(user_id) is None:
+            report.fail(user_id, NOT_REGISTERED)
+            return
+        if user_manager.sessions.active_session_id(user_id) is not None:
+            report.fail(user_id, IN_PROGRESS)
+            return
+
+        user = await self._resolve(target)
+        if user is None:
+            report.fail(user_id, NOT_FOUND)
+            return
+
+        dms_closed = False
+
+        async def send(text: str):
+            nonlocal dms_closed
+            try:
+                # Wait for delivery so closed DMs are detected
+                return await self.outbound.deliver(user, text, BULK)
+            except discord.Forbidden:
+                dms_closed = True
+                raise
+
+        success, session_id = await self.form_handler.start_form_collection(user_id, form_id, callback=send)
+        if success:
+            self.on_started(user_id, session_id)
+            report.started.append(user_id)
+        else:
+            report.fail(user_id, DMS_CLOSED if dms_closed else FAILED)
+
+    async def dispatch(
+        self,
+        targets: Iterable[Target],
+        form_id: str,
+        on_progress: Optional[Callable[[DispatchReport], Awaitable[None]]] = None,
+        progress_interval: float = 5.0,
+    ) -> DispatchReport:
+        """Start ``form_id`` for every target (user ID or user object), reporting progress periodically."""
+        targets = list(targets)
+        report = DispatchReport(len(targets))
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run(target: Target) -> None:
+            async with semaphore:
+                try:
+                    await self._dispatch_one(target, form_id, report)
+                except Exception as e:
+                    user_id = target if isinstance(target, str) else str(target.id)
+                    logger.error(f"Error dispatching form {form_id} to {user_id}: {e}")
+                    report.fail(user_id, FAILED)
+
+        tasks = [asyncio.ensure_future(run(target)) for target in targets]
+        pending = set(tasks)
+        while pending:
+            _, pending = await asyncio.wait(pending, timeout=progress_interval)
+            if pending and on_progress is not None:
+                try:
+                    await on_progress(report)
+                except Exception as e:
+                    logger.error(f"Error reporting dispatch progress: {e}")
+
+        report.finished_at = time.monotonic()
+        logger.info(f"Dispatched form {form_id}: {report.summary()}")
+        return report
@@ -0,0 +1,364 @@
+import json
+import logging
+import os
+import secrets
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Any, Callable, Iterator, List, Optional
+from urllib.parse import unquote, urlsplit
+
+from storage import DEFAULT_DB_PATH
+
+# Setup logging
+logger = logging.getLogger("survey_state")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dev_api_keys (
+    api_key TEXT PRIMARY KEY,
+    created_at TEXT NOT NULL,
+    questions TEXT NOT NULL DEFAULT '[]'
+);
+CREATE TABLE IF NOT EXISTS dev_surveys (
+    user_id TEXT PRIMARY KEY,
+    survey_id TEXT NOT NULL,
+    questions TEXT NOT NULL,
+    answers TEXT NOT NULL DEFAULT '[]',
+    current_question INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS dev_surveys_updated_at ON dev_surveys (updated_at);
+"""
+
+
+def new_survey(questions: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """A survey record positioned on its first question."""
+    return {
+        "survey_id": secrets.token_hex(8),
+        "current_question": 0,
+        "questions": questions,
+        "answers": [],
+    }
+
+
+class SurveyStateStore:
+    """Interface for the devplatform's API keys and in-progress DM surveys.
+
+    Keeping this state outside the web process lets any worker, on any host,
+    serve any request. ``advance_survey`` is an atomic compare-and-advance: when
+    two workers race to record an answer to the same question, exactly one wins.
+    In-progress surveys are forgotten after ``ttl`` seconds without an answer.
+    """
+
+    def create_api_key(self, api_key: str, created_at: str) -> None:
+        """Store a new API key with no questions."""
+        raise NotImplementedError
+
+    def get_api_key(self, api_key: str) -> Optional[Dict[str, Any]]:
+        """Get an API key's record ({"created_at", "questions"}), or None if it doesn't exist."""
+        raise NotImplementedError
+
+    def has_api_key(self, api_key: str) -> bool:
+        return self.get_api_key(api_key) is not None
+
+    def set_questions(self, api_key: str, questions: List[Dict[str, Any]]) -> None:
+        """Replace the questions saved for an API key."""
+        raise NotImplementedError
+
+    def start_survey(self, user_id: str, questions: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Start (or restart) a user's survey and return its record."""
+        raise NotImplementedError
+
+    def get_survey(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Get a user's survey: {"survey_id", "current_question", "questions", "answers"}."""
+        raise NotImplementedError
+
+    def advance_survey(self, user_id: str, survey_id: str, expected: int, answer: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Record ``answer`` and move to the next question, if the survey is still on question ``expected``.
+
+        Returns the updated survey, or None if the survey was restarted, ended or
+        already advanced by another request.
+        """
+        raise NotImplementedError
+
+    def end_survey(self, user_id: str, survey_id: str) -> None:
+        """Forget a user's survey, unless it has since been restarted."""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteSurveyState(SurveyStateStore):
+    """SQLite backend for workers sharing one host (and one database file).
+
+    Every operation is a single short transaction, and compare-and-advance is
+    one conditional UPDATE, so concurrent workers never see a half-written survey.
+    """
+
+    def __init__(self, db_path: Path = DEFAULT_DB_PATH, ttl: Optional[float] = None):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl or float(os.getenv("SURVEY_TTL", "86400"))
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def create_api_key(self, api_key: str, created_at: str) -> None:
+        with self._connect() as conn:
+            conn.execute("INSERT INTO dev_api_keys (api_key, created_at) VALUES (?, ?)", (api_key, created_at))
+
+    def get_api_key(self, api_key: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT created_at, questions FROM dev_api_keys WHERE api_key = ?", (api_key,)).fetchone()
+        if row is None:
+            return None
+        return {"created_at": row[0], "questions": json.loads(row[1])}
+
+    def set_questions(self, api_key: str, questions: List[Dict[str, Any]]) -> None:
+        with self._connect() as conn:
+            conn.execute("UPDATE dev_api_keys SET questions = ? WHERE api_key = ?", (json.dumps(questions), api_key))
+
+    def start_survey(self, user_id: str, questions: List[Dict[str, Any]]) -> Dict[str, Any]:
+        survey = new_survey(questions)
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("DELETE FROM dev_surveys WHERE updated_at < ?", (now - self.ttl,))
+            conn.execute(
+                "INSERT OR REPLACE INTO dev_surveys (user_id, survey_id, questions, answers, current_question, updated_at) "
+                "VALUES (?, ?, ?, '[]', 0, ?)",
+                (user_id, survey["survey_id"], json.dumps(questions), now),
+            )
+        return survey
+
+    @staticmethod
+    def _load(conn: sqlite3.Connection, user_id: str, since: float) -> Optional[Dict[str, Any]]:
+        row = conn.execute(
+            "SELECT survey_id, current_question, questions, answers FROM dev_surveys WHERE user_id = ? AND updated_at >= ?",
+            (user_id, since),
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "survey_id": row[0],
+            "current_question": row[1],
+            "questions": json.loads(row[2]),
+            "answers": json.loads(row[3]),
+        }
+
+    def get_survey(self, user_id: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            return self._load(conn, user_id, time.time() - self.ttl)
+
+    def advance_survey(self, user_id: str, survey_id: str, expected: int, answer: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE dev_surveys SET current_question = current_question + 1, "
+                "answers = json_insert(answers, '$[#]', json(?)), updated_at = ? "
+                "WHERE user_id = ? AND survey_id = ? AND current_question = ? AND updated_at >= ?",
+                (json.dumps(answer), now, user_id, survey_id, expected, now - self.ttl),
+            )
+            if cursor.rowcount != 1:
+                return None
+            return self._load(conn, user_id, now - self.ttl)
+
+    def end_survey(self, user_id: str, survey_id: str) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM dev_surveys WHERE user_id = ? AND survey_id = ?", (user_id, survey_id))
+
+
+class RedisError(Exception):
+    """An error reply from a Redis server."""
+
+
+class RedisConnection:
+    """Minimal blocking client for the Redis protocol (RESP2) over one socket."""
+
+    def __init__(self, host: str, port: int, db: int = 0, password: Optional[str] = None, timeout: float = 5.0):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._reader = self.sock.makefile("rb")
+        if password:
+            self.execute("AUTH", password)
+        if db:
+            self.execute("SELECT", db)
+
+    @staticmethod
+    def _encode(args: tuple) -> bytes:
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(parts)
+
+    def _read(self, nested: bool = False) -> Any:
+        line = self._reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Connection closed by the Redis server")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode()
+        if kind == b"-":
+            error = RedisError(payload.decode())
+            # Errors inside an array (EXEC results) must not stop the rest being read
+            if nested:
+                return error
+            raise error
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            return None if length < 0 else self._reader.read(length + 2)[:-2]
+        if kind == b"*":
+            length = int(payload)
+            return None if length < 0 else [self._read(nested=True) for _ in range(length)]
+        raise RedisError(f"Unexpected reply from the Redis server: {line!r}")
+
+    def execute(self, *args) -> Any:
+        """Send one command and return its decoded reply."""
+        self.sock.sendall(self._encode(args))
+        return self._read()
+
+    def close(self) -> None:
+        try:
+            self._reader.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+_DELETE = object()
+
+
+class RedisSurveyState(SurveyStateStore):
+    """Redis backend for workers spread over several hosts.
+
+    Each API key and survey is one JSON value. Read-modify-write changes use
+    WATCH/MULTI/EXEC, so a change based on a stale read is rejected and retried
+    rather than overwriting a concurrent one. Each thread has its own connection.
+    """
+
+    def __init__(self, url: Optional[str] = None, ttl: Optional[float] = None, prefix: str = "devplatform:"):
+        self.url = url or os.getenv("SURVEY_STATE_URL", "redis://127.0.0.1:6379/0")
+        parts = urlsplit(self.url)
+        if parts.scheme != "redis":
+            raise ValueError(f"Unsupported survey state URL: {self.url}")
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port or 6379
+        self.password = unquote(parts.password) if parts.password else None
+        self.db = int(parts.path.lstrip("/") or 0)
+        self.ttl = int(ttl or float(os.getenv("SURVEY_TTL", "86400")))
+        self.prefix = prefix
+        self._local = threading.local()
+
+    @contextmanager
+    def _connection(self) -> Iterator[RedisConnection]:
+        """Yield this thread's connection, dropping it if a command fails midway."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = RedisConnection(self.host, self.port, self.db, self.password)
+        try:
+            yield conn
+        except (OSError, ConnectionError, RedisError):
+            conn.close()
+            self._local.conn = None
+            raise
+
+    def _api_key(self, api_key: str) -> str:
+        return f"{self.prefix}api_key:{api_key}"
+
+    def _survey(self, user_id: str) -> str:
+        return f"{self.prefix}survey:{user_id}"
+
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._connection() as conn:
+            raw = conn.execute("GET", key)
+        return json.loads(raw) if raw is not None else None
+
+    def _update(self, key: str, change: Callable[[Optional[Dict[str, Any]]], Any], expire: Optional[int] = None, attempts: int = 20) -> Any:
+        """Apply ``change`` to the value at ``key`` atomically, retrying if it changes underneath.
+
+        ``change`` gets the current value and returns the new one, None to leave
+        it as it is, or _DELETE to remove the key.
+        """
+        with self._connection() as conn:
+            for _ in range(attempts):
+                conn.execute("WATCH", key)
+                raw = conn.execute("GET", key)
+                value = change(json.loads(raw) if raw is not None else None)
+                if value is None:
+                    conn.execute("UNWATCH")
+                    return None
+
+                conn.execute("MULTI")
+                if value is _DELETE:
+                    conn.execute("DEL", key)
+                else:
+                    conn.execute("SET", key, json.dumps(value), *(("EX", expire) if expire else ()))
+                if conn.execute("EXEC") is not None:
+                    return value
+        raise RedisError(f"Gave up updating {key} after {attempts} conflicting writes")
+
+    def create_api_key(self, api_key: str, created_at: str) -> None:
+        with self._connection() as conn:
+            if conn.execute("SET", self._api_key(api_key), json.dumps({"created_at": created_at, "questions": []}), "NX") is None:
+                raise ValueError("API key already exists")
+
+    def get_api_key(self, api_key: str) -> Optional[Dict[str, Any]]:
+        return self._get(self._api_key(api_key))
+
+    def set_questions(self, api_key: str, questions: List[Dict[str, Any]]) -> None:
+        def change(record):
+            return {**record, "questions": questions} if record is not None else None
+        self._update(self._api_key(api_key), change)
+
+    def start_survey(self, user_id: str, questions: List[Dict[str, Any]]) -> Dict[str, Any]:
+        survey = new_survey(questions)
+        with self._connection() as conn:
+            conn.execute("SET", self._survey(user_id), json.dumps(survey), "EX", self.ttl)
+        return survey
+
+    def get_survey(self, user_id: str) -> Optional[Dict[str, Any]]:
+        return self._get(self._survey(user_id))
+
+    def advance_survey(self, user_id: str, survey_id: str, expected: int, answer: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        def change(survey):
+            if survey is None or survey["survey_id"] != survey_id or survey["current_question"] != expected:
+                return None
+            return {**survey, "current_question": expected + 1, "answers": survey["answers"] + [answer]}
+        return self._update(self._survey(user_id), change, expire=self.ttl)
+
+    def end_survey(self, user_id: str, survey_id: str) -> None:
+        def change(survey):
+            return _DELETE if survey is not None and survey["survey_id"] == survey_id else None
+        self._update(self._survey(user_id), change)
+
+    def close(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def create_survey_state() -> SurveyStateStore:
+    """Create the backend selected by SURVEY_STATE: "sqlite" (default) or "redis" (SURVEY_STATE_URL)."""
+    backend = os.getenv("SURVEY_STATE", "sqlite").lower()
+    if backend == "redis":
+        state = RedisSurveyState()
+        logger.info(f"Keeping survey state in Redis at {state.host}:{state.port}/{state.db}")
+        return state
+    return SQLiteSurveyState(Path(os.getenv("USER_DB_PATH", DEFAULT_DB_PATH)))
@@ -0,0 +1,336 @@
+import asyncio
+import contextvars
+import cProfile
+import functools
+import io
+import json
+import logging
+import logging.handlers
+import os
+import pstats
+import queue
+import random
+import secrets
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+# Setup logging
+logger = logging.getLogger("tracing")
+
+DEFAULT_TRACE_FILE = Path(os.path.dirname(os.path.abspath(__file__))).parent / "instance" / "traces.jsonl"
+
+_current: "contextvars.ContextVar[Optional[Span]]" = contextvars.ContextVar("current_span", default=None)
+
+
+class Trace:
+    """Spans recorded for one sampled root operation."""
+
+    __slots__ = ("trace_id", "started_at", "wall_start", "spans", "open", "closed")
+
+    def __init__(self):
+        self.trace_id = secrets.token_hex(8)
+        self.started_at = time.perf_counter()
+        self.wall_start = time.time()
+        self.spans: List["Span"] = []
+        self.open = 0
+        # Set when the root span ends; no spans may be added after that
+        self.closed = False
+
+
+class Span:
+    """A timed operation within a trace; end it exactly once (or use ``Tracer.span``)."""
+
+    __slots__ = ("tracer", "trace", "name", "span_id", "parent_id", "started_at", "duration", "attributes", "error")
+
+    def __init__(self, tracer: "Tracer", trace: Trace, name: str, parent_id: Optional[int], attributes: Dict[str, Any]):
+        self.tracer = tracer
+        self.trace = trace
+        self.name = name
+        self.span_id = len(trace.spans)
+        self.parent_id = parent_id
+        self.started_at = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.attributes = attributes
+        self.error: Optional[str] = None
+        trace.spans.append(self)
+        trace.open += 1
+
+    def set(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def end(self, error: Optional[BaseException] = None) -> None:
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self.started_at
+        if error is not None:
+            self.error = type(error).__name__
+        self.trace.open -= 1
+        if self.parent_id is None:
+            self.trace.closed = True
+        if self.trace.open == 0:
+            self.tracer._finish(self.trace)
+
+    def as_dict(self) -> Dict[str, Any]:
+        data = {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "offset": round(self.started_at - self.trace.started_at, 6),
+            "duration": round(self.duration, 6) if self.duration is not None else None,
+        }
+        if self.attributes:
+            data["attributes"] = self.attributes
+        if self.error:
+            data["error"] = self.error
+        return data
+
+
+class _NoopSpan:
+    """Stands in for a span when the operation isn't sampled."""
+
+    __slots__ = ()
+
+    def set(self, key: str, value: Any) -> None:
+        pass
+
+    def end(self, error: Optional[BaseException] = None) -> None:
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Tracer:
+    """Lightweight in-process tracing of bot operations.
+
+    ``trace`` starts a root span for a fraction ``sample_rate`` (TRACE_SAMPLE_RATE)
+    of operations; ``span`` and ``start_span`` record children of the current span
+    and cost next to nothing when there is none. Child tasks inherit the current
+    span. A trace is closed to new spans when its root ends and finished once
+    the spans already started have ended too, so work begun during the handler
+    (queued sends) is attributed to it, while spans that background work starts
+    afterwards (a prefetch for a later turn) are not recorded.
+
+    Finished traces go to a rotating JSONL file (TRACE_FILE), written from a
+    background thread, and the most recent ones are kept in memory for
+    ``slowest``.
+    """
+
+    def __init__(
+        self,
+        sample_rate: Optional[float] = None,
+        path: Optional[Path] = None,
+        max_bytes: Optional[int] = None,
+        backups: Optional[int] = None,
+        keep: Optional[int] = None,
+    ):
+        """Initialize the tracer with settings taken from arguments or the environment."""
+        self.sample_rate = sample_rate if sample_rate is not None else float(os.getenv("TRACE_SAMPLE_RATE", "0.05"))
+        self.path = Path(path or os.getenv("TRACE_FILE", DEFAULT_TRACE_FILE))
+        self.max_bytes = max_bytes or int(os.getenv("TRACE_FILE_BYTES", str(10 * 1024 * 1024)))
+        self.backups = backups or int(os.getenv("TRACE_FILE_BACKUPS", "3"))
+        self.recent: Deque[Dict[str, Any]] = deque(maxlen=keep or int(os.getenv("TRACE_KEEP", "500")))
+        self.sampled = 0
+        self._queue: Optional[queue.Queue] = None
+        self._listener: Optional[logging.handlers.QueueListener] = None
+
+    def current(self) -> Optional[Span]:
+        return _current.get()
+
+    def start_trace(self, name: str, **attributes) -> Any:
+        """Start a root span if this operation is sampled, else return a no-op span."""
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return NOOP_SPAN
+        self.sampled += 1
+        return Span(self, Trace(), name, None, attributes)
+
+    def start_span(self, name: str, parent: Optional[Span] = None, **attributes) -> Any:
+        """Start a child of ``parent`` (default: the current span) without making it current."""
+        parent = parent or _current.get()
+        if parent is None or parent.trace.closed:
+            return NOOP_SPAN
+        return Span(self, parent.trace, name, parent.span_id, attributes)
+
+    @contextmanager
+    def _activate(self, span: Any) -> Iterator[Any]:
+        if span is NOOP_SPAN:
+            yield span
+            return
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.end(e)
+            raise
+        finally:
+            _current.reset(token)
+            span.end()
+
+    def trace(self, name: str, **attributes):
+        """Context manager running its block as a (possibly sampled) root span."""
+        return self._activate(self.start_trace(name, **attributes))
+
+    def span(self, name: str, **attributes):
+        """Context manager running its block as a child of the current span."""
+        return self._activate(self.start_span(name, **attributes))
+
+    def _finish(self, trace: Trace) -> None:
+        root = trace.spans[0]
+        record = {
+            "trace_id": trace.trace_id,
+            "name": root.name,
+            "start": trace.wall_start,
+            "duration": round(max(span.started_at + span.duration for span in trace.spans) - trace.started_at, 6),
+            "spans": [span.as_dict() for span in trace.spans],
+        }
+        self.recent.append(record)
+        self._write(record)
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        if self._queue is None:
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                handler = logging.handlers.RotatingFileHandler(self.path, maxBytes=self.max_bytes, backupCount=self.backups)
+            except OSError as e:
+                logger.error(f"Could not open trace file {self.path}: {e}")
+                self.sample_rate = 0
+                return
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._queue = queue.Queue()
+            self._listener = logging.handlers.QueueListener(self._queue, handler)
+            self._listener.start()
+        self._queue.put(logging.makeLogRecord({"msg": json.dumps(record, default=str), "levelno": logging.INFO}))
+
+    def slowest(self, count: int = 5) -> List[Dict[str, Any]]:
+        """Return the slowest of the recently finished traces."""
+        return sorted(self.recent, key=lambda record: record["duration"], reverse=True)[:count]
+
+    def close(self) -> None:
+        """Write out queued traces."""
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+            self._queue = None
+
+
+def format_trace(record: Dict[str, Any]) -> str:
+    """Render a trace as an indented span tree with offsets and durations."""
+    children: Dict[Optional[int], List[Dict[str, Any]]] = {}
+    for span in record["spans"]:
+        children.setdefault(span["parent_id"], []).append(span)
+
+    started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record["start"]))
+    lines = [f"{record['duration'] * 1000:.0f}ms {record['name']} {record['trace_id']} at {started}"]
+
+    def walk(parent_id: Optional[int], depth: int) -> None:
+        for span in children.get(parent_id, []):
+            duration = f"{span['duration'] * 1000:.0f}ms" if span["duration"] is not None else "open"
+            attributes = " ".join(f"{key}={value}" for key, value in span.get("attributes", {}).items())
+            error = f" !{span['error']}" if span.get("error") else ""
+            lines.append(f"{'  ' * depth}+{span['offset'] * 1000:.0f}ms {span['name']} {duration} {attributes}{error}".rstrip())
+            walk(span["span_id"], depth + 1)
+
+    walk(None, 1)
+    return "\n".join(lines)
+
+
+_tracer: Optional[Tracer] = None
+
+
+def get_tracer() -> Tracer:
+    """Return the process-wide tracer."""
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer()
+    return _tracer
+
+
+def span(name: str, **attributes):
+    """Context manager recording a child of the current span on the process-wide tracer."""
+    return get_tracer().span(name, **attributes)
+
+
+def traced(name: str):
+    """Decorator recording every call of a function or coroutine function as a span."""
+    def decorator(function):
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                if _current.get() is None:
+                    return await function(*args, **kwargs)
+                with get_tracer().span(name):
+                    return await function(*args, **kwargs)
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if _current.get() is None:
+                    return function(*args, **kwargs)
+                with get_tracer().span(name):
+                    return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Profiler:
+    """Opt-in CPU (cProfile) or memory (tracemalloc) capture over a fixed window.
+
+    Only one capture runs at a time. The raw profile is saved next to the trace
+    file (TRACE_PROFILE_DIR) and a short text summary is returned.
+    """
+
+    def __init__(self, directory: Optional[Path] = None):
+        self.directory = Path(directory or os.getenv("TRACE_PROFILE_DIR", DEFAULT_TRACE_FILE.parent))
+        self.running: Optional[str] = None
+
+    async def capture(self, kind: str, seconds: float, top: int = 15) -> Tuple[str, Optional[Path]]:
+        """Profile the process for ``seconds`` and return (summary, saved file)."""
+        if kind not in ("cpu", "memory"):
+            raise ValueError("Profile kind must be 'cpu' or 'memory'")
+        if self.running is not None:
+            raise RuntimeError(f"A {self.running} profile is already running")
+
+        self.running = kind
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            stamp = time.strftime("%Y%m%d-%H%M%S")
+            if kind == "cpu":
+                return await self._capture_cpu(seconds, top, self.directory / f"cpu-{stamp}.prof")
+            return await self._capture_memory(seconds, top, self.directory / f"memory-{stamp}.txt")
+        finally:
+            self.running = None
+
+    @staticmethod
+    async def _capture_cpu(seconds: float, top: int, path: Path) -> Tuple[str, Path]:
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profile.disable()
+        profile.dump_stats(path)
+
+        output = io.StringIO()
+        pstats.Stats(profile, stream=output).strip_dirs().sort_stats("cumulative").print_stats(top)
+        lines = [line for line in output.getvalue().splitlines() if line.strip()]
+        return "\n".join(lines[-(top + 1):]), path
+
+    @staticmethod
+    async def _capture_memory(seconds: float, top: int, path: Path) -> Tuple[str, Path]:
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start(10)
+        try:
+            before = tracemalloc.take_snapshot()
+            await asyncio.sleep(seconds)
+            after = tracemalloc.take_snapshot()
+        finally:
+            if started:
+                tracemalloc.stop()
+
+        stats = after.compare_to(before, "lineno")
+        path.write_text("\n".join(str(stat) for stat in stats[:200]) + "\n")
+        return "\n".join(str(stat) for stat in stats[:top]), path
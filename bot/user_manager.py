@@ -1,124 +1,311 @@
-import json
+import asyncio
+import logging
 import os
 import hashlib
+import hmac
+import sys
+from collections import OrderedDict
 from pathlib import Path
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Callable, List, Optional, Tuple
+
+import metrics
+from form_registry import FormRegistry
+from models import Session, User
+from session_store import COMPLETED, EXPIRED, IN_PROGRESS, SessionStore
+from storage import UserStore, create_store
+from tracing import traced
+
+# Setup logging
+logger = logging.getLogger("user_manager")
+
+USER_CACHE_LOOKUPS = metrics.counter("user_cache_lookups", "User working-set lookups by outcome (hit, miss)", ["outcome"])
+USER_CACHE_EVICTIONS = metrics.counter("user_cache_evictions", "Users evicted to keep the working set under its memory budget")
 
 class UserManager:
     """Manages user accounts and data for the Discord bot."""
     
-    def __init__(self, data_file: str = "users.json"):
-        """Initialize the user manager with a data file."""
+    def __init__(
+        self,
+        data_file: str = "users.json",
+        store: Optional[UserStore] = None,
+        form_registry: Optional[FormRegistry] = None,
+        cache_bytes: Optional[int] = None,
+    ):
+        """Initialize the user manager with a storage backend (see storage.create_store) and a form registry.
+
+        Users are kept in memory up to about ``cache_bytes`` (USER_CACHE_BYTES) as
+        measured by ``User.approx_size`` when they are loaded, plus any user with a
+        form in progress. A typical user with one completed session takes about
+        1 KB, so the 32 MB default holds roughly 30,000 users.
+        """
         self.data_file = Path(os.path.dirname(os.path.abspath(__file__))) / data_file
-        self.users = {}
+        self.store = store or create_store(self.data_file)
+        self.form_registry = form_registry or FormRegistry()
+        self.cache_bytes = cache_bytes or int(os.getenv("USER_CACHE_BYTES", str(32 * 1024 * 1024)))
+        self.users: "OrderedDict[str, User]" = OrderedDict()
+        self.sizes: Dict[str, int] = {}
+        self.resident_bytes = 0
+        self.sessions = SessionStore()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
         self.load_users()
     
     def load_users(self) -> None:
-        """Load users from the data file."""
-        if self.data_file.exists():
-            try:
-                with open(self.data_file, 'r') as f:
-                    self.users = json.load(f)
-            except json.JSONDecodeError:
-                print(f"Error decoding {self.data_file}. Starting with empty user database.")
-                self.users = {}
+        """Load the users with an in-progress session and index their sessions.
+
+        Everyone else is loaded from the store on first access, so startup cost
+        follows the number of active sessions rather than the size of the user base.
+        """
+        self.users = OrderedDict()
+        self.sizes = {}
+        self.resident_bytes = 0
+        self.sessions = SessionStore()
+        for user_id, record in self.store.load_active_users().items():
+            self._add_user(user_id, User.from_record(record))
+        logger.info(f"Loaded {len(self.users)} users with an active form session")
+    
+    def _add_user(self, user_id: str, user: User) -> User:
+        self.users[user_id] = user
+        self.sizes[user_id] = sys.getsizeof(user_id) + user.approx_size()
+        self.resident_bytes += self.sizes[user_id]
+        self.sessions.add_user(user_id, user.sessions)
+        self._evict()
+        return user
+    
+    def _evict(self) -> None:
+        """Drop least recently used users until the working set fits in ``cache_bytes``.
+
+        Users with a session in progress are never evicted. Every change has
+        already been handed to the store, whose reads flush pending writes, so an
+        evicted user reloads with all of their data.
+        """
+        pinned = 0
+        while self.resident_bytes - pinned > self.cache_bytes:
+            user_id = next(iter(self.users))
+            if self.sessions.active_session_id(user_id) is not None:
+                self.users.move_to_end(user_id)
+                pinned += self.sizes[user_id]
+                continue
+            del self.users[user_id]
+            self.resident_bytes -= self.sizes.pop(user_id)
+            self.sessions.remove_user(user_id)
+            self.evictions += 1
+            USER_CACHE_EVICTIONS.inc()
+    
+    def _cached(self, user_id: str) -> Optional[User]:
+        user = self.users.get(user_id)
+        if user is not None:
+            self.users.move_to_end(user_id)
+            self.hits += 1
+            USER_CACHE_LOOKUPS.labels("hit").inc()
+        return user
+    
+    def _user(self, user_id: str) -> Optional[User]:
+        """Get a user, loading their record from the store if they aren't in memory.
+
+        For session operations, whose users are pinned in memory while a form is in
+        progress; entry points that may miss use ``_load_user`` so the read doesn't
+        block the event loop.
+        """
+        user = self._cached(user_id)
+        if user is not None:
+            return user
+        
+        self.misses += 1
+        USER_CACHE_LOOKUPS.labels("miss").inc()
+        record = self.store.load_user(user_id)
+        return self._add_user(user_id, User.from_record(record)) if record is not None else None
+    
+    async def _load_user(self, user_id: str) -> Optional[User]:
+        """Get a user, reading their record from the store off the event loop if they aren't in memory."""
+        user = self._cached(user_id)
+        if user is not None:
+            return user
+        
+        self.misses += 1
+        USER_CACHE_LOOKUPS.labels("miss").inc()
+        record = await self.store.load_user_async(user_id)
+        # Another task may have loaded or registered the user while the read was in flight
+        user = self.users.get(user_id)
+        if user is not None:
+            return user
+        return self._add_user(user_id, User.from_record(record)) if record is not None else None
     
-    def save_users(self) -> None:
-        """Save users to the data file."""
-        with open(self.data_file, 'w') as f:
-            json.dump(self.users, f, indent=2)
+    def cache_stats(self) -> Dict[str, Any]:
+        """Return working-set hit/miss counters and the current size."""
+        lookups = self.hits + self.misses
+        return {
+            "resident": len(self.users),
+            "active": len(self.sessions.active_users()),
+            "resident_bytes": self.resident_bytes,
+            "capacity_bytes": self.cache_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+    
+    def _get_session(self, user_id: str, session_id: str) -> Optional[Session]:
+        """Get one of a user's sessions."""
+        user = self._user(user_id)
+        return user.sessions.get(session_id) if user is not None else None
+    
+    def _save_session(self, user_id: str, session_id: str) -> None:
+        """Persist a session's state (not its collected data)."""
+        self.store.save_session(user_id, session_id, self.users[user_id].sessions[session_id].to_record())
+    
+    def _set_status(self, user_id: str, session_id: str, status: str) -> None:
+        """Change a session's status, keeping the session indexes in sync, and persist it."""
+        self.sessions.set_status(user_id, session_id, status)
+        self._save_session(user_id, session_id)
     
     def hash_password(self, password: str) -> str:
         """Hash a password for secure storage."""
         return hashlib.sha256(password.encode()).hexdigest()
     
-    def register_user(self, user_id: str, username: str, password: str) -> bool:
+    async def register_user(self, user_id: str, username: str, password: str) -> bool:
         """Register a new user."""
-        if user_id in self.users:
+        if await self._load_user(user_id) is not None:
             return False  # User already exists
         
-        self.users[user_id] = {
-            "username": username,
-            "password_hash": self.hash_password(password),
-            "sessions": {},
-            "forms": []
-        }
-        self.save_users()
+        user = self._add_user(user_id, User(username, bytes.fromhex(self.hash_password(password))))
+        self.store.save_user(user_id, user.to_record())
         return True
     
-    def authenticate_user(self, user_id: str, password: str) -> bool:
+    async def authenticate_user(self, user_id: str, password: str) -> bool:
         """Authenticate a user with their password."""
-        if user_id not in self.users:
+        user = await self._load_user(user_id)
+        if user is None:
             return False
         
-        return self.users[user_id]["password_hash"] == self.hash_password(password)
+        return hmac.compare_digest(user.password_hash, bytes.fromhex(self.hash_password(password)))
     
-    def get_user(self, user_id: str) -> Optional[Dict[str, Any]]:
+    async def get_user(self, user_id: str) -> Optional[User]:
         """Get a user by their ID."""
-        return self.users.get(user_id)
+        return await self._load_user(user_id)
     
-    def start_form_session(self, user_id: str, form_id: str, form_data: Dict[str, Any]) -> str:
-        """Start a new form session for a user."""
-        if user_id not in self.users:
+    @traced("user_manager.start_session")
+    async def start_form_session(self, user_id: str, form: Dict[str, Any]) -> str:
+        """Start a new form session for a user on a published form version."""
+        if await self._load_user(user_id) is None:
             return None
         
-        session_id = f"session_{len(self.users[user_id]['sessions']) + 1}"
-        self.users[user_id]["sessions"][session_id] = {
-            "form_id": form_id,
-            "form_data": form_data,
-            "status": "in_progress",
-            "current_field": 0,
-            "collected_data": {}
-        }
-        self.save_users()
+        # A user has at most one session in progress; starting a new one abandons the old one
+        previous_id = self.sessions.active_session_id(user_id)
+        if previous_id is not None:
+            self._set_status(user_id, previous_id, EXPIRED)
+        
+        session_id = self.sessions.new_session_id()
+        session = Session(form["form_id"], form["version"], IN_PROGRESS)
+        self.sessions.add(user_id, session_id, session)
+        self._save_session(user_id, session_id)
         return session_id
     
     def get_active_session(self, user_id: str) -> Optional[Dict[str, Any]]:
         """Get the active session for a user."""
-        if user_id not in self.users:
+        session_id = self.sessions.active_session_id(user_id)
+        if session_id is None:
             return None
         
-        for session_id, session in self.users[user_id]["sessions"].items():
-            if session["status"] == "in_progress":
-                return {"session_id": session_id, **session}
-        
-        return None
+        session = self.sessions.get(user_id, session_id)
+        return {
+            "session_id": session_id,
+            "form_id": session.form_id,
+            "form_version": session.form_version,
+            "status": session.status,
+            "current_field": session.current_field,
+            "collected_data": session.collected_data,
+            "form_data": self.session_form(session),
+        }
+    
+    def session_form(self, session: Session) -> Dict[str, Any]:
+        """Get the form definition a session was started on."""
+        # Sessions created before the form registry embed their own copy
+        if session.form_data:
+            return session.form_data
+        return self.form_registry.get(session.form_id, session.form_version)
     
+    def touch_session(self, user_id: str, session_id: str) -> None:
+        """Record user activity on a session so it isn't reaped as idle, persisting it across restarts."""
+        if self.sessions.get(user_id, session_id) is None:
+            return
+        self.sessions.touch(user_id, session_id)
+        self._save_session(user_id, session_id)
+    
+    @traced("user_manager.save_field")
     def save_field_response(self, user_id: str, session_id: str, field_name: str, response: str) -> bool:
         """Save a field response for a form session."""
-        if user_id not in self.users or session_id not in self.users[user_id]["sessions"]:
+        session = self._get_session(user_id, session_id)
+        if session is None:
             return False
         
-        session = self.users[user_id]["sessions"][session_id]
-        session["collected_data"][field_name] = response
-        self.save_users()
+        session.set_response(field_name, response)
+        self.sessions.touch(user_id, session_id)
+        self.store.save_field(user_id, session_id, field_name, response)
         return True
     
+    @traced("user_manager.advance_session")
     def advance_session(self, user_id: str, session_id: str) -> Optional[Dict[str, Any]]:
         """Advance the session to the next field."""
-        if user_id not in self.users or session_id not in self.users[user_id]["sessions"]:
+        session = self._get_session(user_id, session_id)
+        if session is None:
             return None
         
-        session = self.users[user_id]["sessions"][session_id]
-        session["current_field"] += 1
+        session.current_field += 1
+        self.sessions.touch(user_id, session_id)
         
         # Check if we've reached the end of the form
-        if session["current_field"] >= len(session["form_data"]["fields"]):
-            session["status"] = "completed"
-            self.save_users()
-            return {"status": "completed", "data": session["collected_data"]}
+        fields = self.session_form(session)["fields"]
+        if session.current_field >= len(fields):
+            self._set_status(user_id, session_id, COMPLETED)
+            return {"status": "completed", "data": session.collected_data}
         
         # Return the next field
-        field = session["form_data"]["fields"][session["current_field"]]
-        self.save_users()
+        field = fields[session.current_field]
+        self._save_session(user_id, session_id)
         return {"status": "in_progress", "field": field}
     
     def complete_session(self, user_id: str, session_id: str) -> Dict[str, Any]:
         """Mark a session as completed and return the collected data."""
-        if user_id not in self.users or session_id not in self.users[user_id]["sessions"]:
+        session = self._get_session(user_id, session_id)
+        if session is None:
             return None
         
-        session = self.users[user_id]["sessions"][session_id]
-        session["status"] = "completed"
-        self.save_users()
-        return session["collected_data"]
+        self._set_status(user_id, session_id, COMPLETED)
+        return session.collected_data
+    
+    def expire_session(self, user_id: str, session_id: str) -> None:
+        """Mark a session as expired."""
+        if self._get_session(user_id, session_id) is not None:
+            self._set_status(user_id, session_id, EXPIRED)
+    
+    def expire_idle_sessions(self, ttl: float) -> List[Tuple[str, str]]:
+        """Mark in-progress sessions idle for longer than ``ttl`` seconds as expired."""
+        expired = self.sessions.idle_sessions(ttl)
+        for user_id, session_id in expired:
+            self._set_status(user_id, session_id, EXPIRED)
+        return expired
+    
+    async def run_session_reaper(
+        self,
+        ttl: Optional[float] = None,
+        interval: Optional[float] = None,
+        on_expire: Optional[Callable[[str, str], None]] = None,
+    ) -> None:
+        """Periodically expire idle in-progress sessions (SESSION_IDLE_TTL / SESSION_REAP_INTERVAL seconds)."""
+        ttl = ttl or float(os.getenv("SESSION_IDLE_TTL", "86400"))
+        interval = interval or float(os.getenv("SESSION_REAP_INTERVAL", "300"))
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                expired = self.expire_idle_sessions(ttl)
+            except Exception as e:
+                logger.error(f"Error expiring idle sessions: {e}")
+                continue
+            
+            if expired:
+                logger.info(f"Expired {len(expired)} idle form sessions")
+            if on_expire is not None:
+                for user_id, session_id in expired:
+                    on_expire(user_id, session_id)
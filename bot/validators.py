@@ -0,0 +1,168 @@
+import re
+from typing import Dict, Any, Callable, NamedTuple, Optional
+
+# Verdicts returned by local validators
+ACCEPT = "accept"
+REJECT = "reject"
+UNSURE = "unsure"
+
+
+class ValidationResult(NamedTuple):
+    """Outcome of a local validation: a verdict and the normalized value."""
+    verdict: str
+    value: str
+
+
+Validator = Callable[[Dict[str, Any], str], ValidationResult]
+
+_validators: Dict[str, Validator] = {}
+
+
+def register_validator(field_type: str) -> Callable[[Validator], Validator]:
+    """Register a local validator for a field type, replacing any existing one."""
+    def decorator(func: Validator) -> Validator:
+        _validators[field_type] = func
+        return func
+    return decorator
+
+
+def get_validator(field_type: str) -> Optional[Validator]:
+    """Return the validator for a field type, or None if there is none."""
+    return _validators.get(field_type)
+
+
+def validate_locally(field: Dict[str, Any], response: str) -> ValidationResult:
+    """Validate a response without calling the LLM.
+
+    Clear-cut answers come back as ACCEPT (with a normalized value) or REJECT.
+    Anything the local rules can't settle comes back as UNSURE and should be
+    passed on to the LLM validator.
+    """
+    text = response.strip()
+    if not text:
+        return ValidationResult(REJECT, response)
+
+    validator = _validators.get(field.get("type"))
+    if validator is None:
+        return ValidationResult(UNSURE, response)
+    return validator(field, text)
+
+
+EMAIL_RE = re.compile(r"^[A-Za-z0-9._%+-]+@[A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)*\.[A-Za-z]{2,}$")
+EMAIL_SEARCH_RE = re.compile(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)*\.[A-Za-z]{2,}")
+PHONE_SEARCH_RE = re.compile(r"(?:\+|00)?\d[\d\s().-]{5,}\d")
+PHONE_SEPARATORS_RE = re.compile(r"[\s().-]")
+WORD_RE = re.compile(r"[\w']+")
+
+
+def _normalize_email(email: str) -> str:
+    """Lower-case the domain part of an email address."""
+    local, _, domain = email.rpartition("@")
+    return f"{local}@{domain.lower()}"
+
+
+@register_validator("email")
+def validate_email(field: Dict[str, Any], text: str) -> ValidationResult:
+    """Accept a well-formed address, possibly embedded in a short sentence."""
+    if "@" not in text:
+        return ValidationResult(REJECT, text)
+    if EMAIL_RE.match(text):
+        return ValidationResult(ACCEPT, _normalize_email(text))
+
+    matches = EMAIL_SEARCH_RE.findall(text)
+    if len(matches) == 1:
+        return ValidationResult(ACCEPT, _normalize_email(matches[0]))
+    return ValidationResult(UNSURE, text)
+
+
+@register_validator("phone")
+def validate_phone(field: Dict[str, Any], text: str) -> ValidationResult:
+    """Accept numbers with a country code and normalize them to E.164."""
+    matches = PHONE_SEARCH_RE.findall(text)
+    if not matches:
+        if not any(char.isdigit() for char in text):
+            return ValidationResult(REJECT, text)
+        return ValidationResult(UNSURE, text)
+    if len(matches) > 1:
+        return ValidationResult(UNSURE, text)
+
+    number = PHONE_SEPARATORS_RE.sub("", matches[0])
+    if number.startswith("00"):
+        number = "+" + number[2:]
+    digits = number.lstrip("+")
+
+    if len(digits) < 7 or len(digits) > 15:
+        return ValidationResult(REJECT, text)
+    if not number.startswith("+"):
+        # Without an explicit country code only the LLM can guess the region
+        return ValidationResult(UNSURE, text)
+    if digits.startswith("0"):
+        return ValidationResult(REJECT, text)
+    return ValidationResult(ACCEPT, number)
+
+
+# Words that may surround an option without changing which one is meant
+CHOICE_FILLER = {"by", "via", "through", "over", "please", "pls", "thanks", "i", "i'd", "prefer", "choose", "pick", "the", "a", "an", "option"}
+
+
+@register_validator("choice")
+def validate_choice(field: Dict[str, Any], text: str) -> ValidationResult:
+    """Match the whole answer against the field options, ignoring case, punctuation and filler words."""
+    options = field.get("options") or []
+    if not options:
+        return ValidationResult(UNSURE, text)
+
+    folded = " ".join(WORD_RE.findall(text.casefold()))
+    by_folded = {" ".join(WORD_RE.findall(option.casefold())): option for option in options}
+
+    if folded in by_folded:
+        return ValidationResult(ACCEPT, by_folded[folded])
+    if folded.isdigit() and 1 <= int(folded) <= len(options):
+        return ValidationResult(ACCEPT, options[int(folded) - 1])
+
+    # "by email please" names an option; anything else ("not phone", "phone or email") goes to the LLM
+    words = folded.split()
+    while words and words[0] in CHOICE_FILLER:
+        words.pop(0)
+    while words and words[-1] in CHOICE_FILLER:
+        words.pop()
+    stripped = " ".join(words)
+    if stripped in by_folded:
+        return ValidationResult(ACCEPT, by_folded[stripped])
+    return ValidationResult(UNSURE, text)
+
+
+YES_WORDS = {"yes", "y", "yeah", "yep", "sure", "true"}
+NO_WORDS = {"no", "n", "nope", "nah", "false"}
+
+
+@register_validator("yesno")
+def validate_yesno(field: Dict[str, Any], text: str) -> ValidationResult:
+    """Map common yes/no answers onto "yes" or "no"."""
+    folded = " ".join(WORD_RE.findall(text.casefold()))
+    if folded in YES_WORDS:
+        return ValidationResult(ACCEPT, "yes")
+    if folded in NO_WORDS:
+        return ValidationResult(ACCEPT, "no")
+    return ValidationResult(UNSURE, text)
+
+
+@register_validator("number")
+def validate_number(field: Dict[str, Any], text: str) -> ValidationResult:
+    """Accept integers inside the field's min/max range (1-10 by default)."""
+    try:
+        value = int(text)
+    except ValueError:
+        return ValidationResult(UNSURE, text)
+
+    if field.get("min", 1) <= value <= field.get("max", 10):
+        return ValidationResult(ACCEPT, str(value))
+    return ValidationResult(REJECT, text)
+
+
+@register_validator("string")
+def validate_string(field: Dict[str, Any], text: str) -> ValidationResult:
+    """Reject answers with no letters or digits; leave the rest to the LLM."""
+    if not any(char.isalnum() for char in text):
+        return ValidationResult(REJECT, text)
+    return ValidationResult(UNSURE, text)
@@ -1,20 +1,59 @@
 from flask import Flask, send_from_directory, jsonify, request, render_template
 import secrets
+import hashlib
+import functools
 import json
+import threading
 from pathlib import Path
 from datetime import datetime
 import os
-from mistralai import Mistral
+import sys
 from dotenv import load_dotenv
 
 load_dotenv()
 
-app = Flask(__name__)
-client = Mistral(api_key=os.getenv('MISTRAL_API_KEY'))
+# The LLM gateway, form registry and survey state live with the bot so both processes share one implementation
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'bot'))
+from llm_gateway import get_gateway, message_content
+from form_registry import FormRegistry, form_from_questions
+from survey_state import create_survey_state
+from question_cache import QuestionCache, prompt_version
 
-# Store active surveys and API keys
-active_surveys = {}
-api_keys = {}
+app = Flask(__name__)
+gateway = get_gateway()
+form_registry = FormRegistry()
+
+# API keys and in-progress surveys live outside the process (SURVEY_STATE), so any
+# worker on any host can serve any request
+survey_state = create_survey_state()
+
+# Validated question arrays from the question generators, reused for repeat requests
+question_cache = QuestionCache()
+
+# LLM-backed views are async only so they can await the shared gateway, which runs every
+# upstream call on one pooled client and caps them (LLM_MAX_CONCURRENCY). Under Flask's
+# WSGI server each request still holds one worker thread for the whole call, so this does
+# not let more requests wait than there are threads; it only sheds load: at most this many
+# run at once and the rest get a 503 instead of queueing without bound.
+MAX_IN_FLIGHT = int(os.getenv('DEVPLATFORM_MAX_IN_FLIGHT', '256'))
+in_flight = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+
+# Conversational replies are on the participant's turn: give up on Mistral after this
+# many seconds and send the template reply instead, optionally hedging slow requests
+HUMAN_RESPONSE_DEADLINE = float(os.getenv('DEVPLATFORM_LLM_DEADLINE', '4')) or None
+HUMAN_RESPONSE_HEDGE_AFTER = float(os.getenv('DEVPLATFORM_LLM_HEDGE_AFTER', '0')) or None
+
+def limit_in_flight(view):
+    """Reject requests to an async view with 503 while MAX_IN_FLIGHT are already running."""
+    @functools.wraps(view)
+    async def wrapper(*args, **kwargs):
+        if not in_flight.acquire(blocking=False):
+            return jsonify({'error': 'Server is busy, please try again shortly'}), 503
+        try:
+            return await view(*args, **kwargs)
+        finally:
+            in_flight.release()
+    return wrapper
 
 # Question generation prompt template
 QUESTION_GENERATION_PROMPT = """
@@ -66,8 +105,35 @@ Remember:
 - No additional text or explanations
 """
 
-def translate_natural_language_to_questions(description):
+QUESTION_MODEL = "mistral-large-latest"
+
+TRANSLATE_SYSTEM_PROMPT = """You are a JSON-only survey question generator.
+Your responses must:
+1. Start with [
+2. End with ]
+3. Contain only valid JSON
+4. Include no explanatory text
+5. Format questions exactly as shown in the example"""
+
+TRANSLATE_PARAMS = {
+    "temperature": 0.1,  # Lower temperature for more consistent JSON output
+    "max_tokens": 1000,  # Ensure we get complete responses
+    "random_seed": 42,   # For consistent outputs
+}
+
+QUESTION_GENERATION_SYSTEM_PROMPT = "You are a helpful assistant that generates survey questions. Output only valid JSON."
+
+# Editing a prompt or its settings changes its version, so stale cached questions stop matching
+TRANSLATE_PROMPT_VERSION = prompt_version(TRANSLATE_SYSTEM_PROMPT, TRANSLATE_PROMPT, TRANSLATE_PARAMS)
+QUESTION_GENERATION_PROMPT_VERSION = prompt_version(QUESTION_GENERATION_SYSTEM_PROMPT, QUESTION_GENERATION_PROMPT)
+
+async def translate_natural_language_to_questions(description):
     """Translate a natural language survey description into structured questions."""
+    cache_key = question_cache.make_key("translate", QUESTION_MODEL, TRANSLATE_PROMPT_VERSION, description)
+    cached = question_cache.get("translate", cache_key)
+    if cached is not None:
+        return cached
+
     try:
         if not os.getenv('MISTRAL_API_KEY'):
             print("Error: MISTRAL_API_KEY not found in environment variables")
@@ -76,30 +142,23 @@ def translate_natural_language_to_questions(description):
         print(f"Sending request to Mistral API with description: {description}")
 
         # Update the system message to be more explicit about JSON formatting
-        response = client.chat.complete(
-            model="mistral-large-latest",
-            messages=[
+        response = await gateway.chat_async(
+            "devplatform.translate_questions",
+            QUESTION_MODEL,
+            [
                 {
                     "role": "system",
-                    "content": """You are a JSON-only survey question generator.
-Your responses must:
-1. Start with [
-2. End with ]
-3. Contain only valid JSON
-4. Include no explanatory text
-5. Format questions exactly as shown in the example"""
+                    "content": TRANSLATE_SYSTEM_PROMPT
                 },
                 {
                     "role": "user",
                     "content": TRANSLATE_PROMPT.format(description=description)
                 }
             ],
-            temperature=0.1,  # Lower temperature for more consistent JSON output
-            max_tokens=1000,  # Ensure we get complete responses
-            random_seed=42    # For consistent outputs
+            **TRANSLATE_PARAMS
         )
 
-        content = response.choices[0].message.content.strip()
+        content = message_content(response).strip()
         print(f"Raw API response: {content}")
 
         # Clean up the response if needed
@@ -148,6 +207,7 @@ Your responses must:
                 print(f"Invalid question format type: {question['format']}")
                 raise ValueError(f"Invalid question format: {question['format']}")
 
+        question_cache.put("translate", cache_key, questions)
         return questions
     except json.JSONDecodeError as e:
         print(f"JSON parsing error: {str(e)}")
@@ -159,12 +219,18 @@ Your responses must:
         print(f"Raw response content: {content if 'content' in locals() else 'Not available'}")
         return None
 
-def generate_questions(topic, num_questions, requirements=""):
+async def generate_questions(topic, num_questions, requirements=""):
+    cache_key = question_cache.make_key("generate", QUESTION_MODEL, QUESTION_GENERATION_PROMPT_VERSION, topic, num_questions, requirements)
+    cached = question_cache.get("generate", cache_key)
+    if cached is not None:
+        return cached
+
     try:
-        response = client.chat.complete(
-            model="mistral-large-latest",
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant that generates survey questions. Output only valid JSON."},
+        response = await gateway.chat_async(
+            "devplatform.generate_questions",
+            QUESTION_MODEL,
+            [
+                {"role": "system", "content": QUESTION_GENERATION_SYSTEM_PROMPT},
                 {"role": "user", "content": QUESTION_GENERATION_PROMPT.format(
                     topic=topic,
                     num_questions=num_questions,
@@ -174,7 +240,7 @@ def generate_questions(topic, num_questions, requirements=""):
         )
 
         # Parse the response and validate the structure
-        questions = json.loads(response.choices[0].message.content)
+        questions = json.loads(message_content(response))
 
         # Validate each question has required fields
         for question in questions:
@@ -185,6 +251,7 @@ def generate_questions(topic, num_questions, requirements=""):
             if question['format'] == 'multiple' and 'options' not in question:
                 raise ValueError("Multiple choice question missing options")
 
+        question_cache.put("generate", cache_key, questions)
         return questions
     except Exception as e:
         print(f"Error generating questions: {str(e)}")
@@ -201,26 +268,38 @@ def send_static(path):
 @app.route('/api/generate-key', methods=['POST'])
 def generate_key():
     api_key = secrets.token_urlsafe(32)
-    api_keys[api_key] = {
-        'created_at': datetime.now().isoformat(),
-        'questions': []
-    }
+    survey_state.create_api_key(api_key, datetime.now().isoformat())
     return jsonify({'api_key': api_key})
 
+def publish_questions(api_key, questions):
+    """Store an API key's questions and publish them to the bot's form registry.
+
+    Returns the form ID the bot serves them under (usable with !api_collect).
+    """
+    survey_state.set_questions(api_key, questions)
+    form_id = f"survey-{hashlib.sha256(api_key.encode()).hexdigest()[:12]}"
+    if questions:
+        form_registry.publish(form_id, form_from_questions("Survey", questions))
+    return form_id
+
 @app.route('/api/save-questions', methods=['POST'])
 def save_questions():
     data = request.json
     api_key = data.get('api_key')
     questions = data.get('questions', [])
 
-    if not api_key or api_key not in api_keys:
+    if not api_key or not survey_state.has_api_key(api_key):
         return jsonify({'error': 'Invalid API key'}), 401
 
-    api_keys[api_key]['questions'] = questions
-    return jsonify({'success': True})
+    form_id = publish_questions(api_key, questions)
+    return jsonify({'success': True, 'form_id': form_id})
+
+async def generate_human_response(context, response_type="general"):
+    """Generate a human-like response using Mistral API.
 
-def generate_human_response(context, response_type="general"):
-    """Generate a human-like response using Mistral API."""
+    Returns None, so the caller sends its template reply, if Mistral doesn't answer
+    within HUMAN_RESPONSE_DEADLINE or its circuit breaker is open.
+    """
     try:
         prompts = {
             "welcome": """
@@ -313,23 +392,26 @@ Example bad response:
             print("Warning: MISTRAL_API_KEY not found in environment variables")
             return None
 
-        response = client.chat.complete(
-            model="mistral-large-latest",
-            messages=[
+        response = await gateway.chat_async(
+            f"devplatform.human_response.{response_type}",
+            "mistral-large-latest",
+            [
                 {
                     "role": "system",
-                    "content": prompts.get(response_type, prompts["general"])
+                    "content": prompts[response_type]
                 },
                 {
                     "role": "user",
                     "content": context
                 }
             ],
+            deadline=HUMAN_RESPONSE_DEADLINE,
+            hedge_after=HUMAN_RESPONSE_HEDGE_AFTER,
             temperature=0.7,
             max_tokens=150
         )
 
-        return response.choices[0].message.content.strip()
+        return message_content(response).strip()
     except Exception as e:
         print(f"Error generating human response: {str(e)}")
         return None
@@ -345,7 +427,8 @@ def get_format_instructions(format_type, options=None):
     return instructions.get(format_type, "")
 
 @app.route('/api/dm', methods=['POST'])
-def handle_dm():
+@limit_in_flight
+async def handle_dm():
     data = request.json
     user_id = data.get('user_id')
     message = data.get('message')
@@ -354,11 +437,7 @@ def handle_dm():
 
     if is_start:
         # Store the questions for this user's survey
-        active_surveys[user_id] = {
-            'current_question': 0,
-            'questions': questions,
-            'answers': []
-        }
+        survey_state.start_survey(user_id, questions)
 
         # Generate welcome message with first question
         first_question = questions[0]
@@ -367,7 +446,7 @@ def handle_dm():
             "format": get_format_instructions(first_question['format'], first_question.get('options'))
         }
 
-        response = generate_human_response(json.dumps(context), "welcome")
+        response = await generate_human_response(json.dumps(context), "welcome")
         if not response:
             response = f"Welcome to the survey! {first_question['question']} {get_format_instructions(first_question['format'], first_question.get('options'))}"
 
@@ -377,11 +456,12 @@ def handle_dm():
         })
 
     # Handle response and send next question
-    if user_id not in active_surveys:
+    survey = survey_state.get_survey(user_id)
+    if survey is None:
         return jsonify({'error': 'No active survey found'}), 400
 
-    survey = active_surveys[user_id]
-    current_question = survey['questions'][survey['current_question']]
+    current_index = survey['current_question']
+    current_question = survey['questions'][current_index]
 
     # Validate response format
     if not validate_response(message, current_question['format'], current_question.get('options')):
@@ -391,19 +471,20 @@ def handle_dm():
             "invalid_response": message
         }
 
-        response = generate_human_response(json.dumps(context), "invalid_format")
+        response = await generate_human_response(json.dumps(context), "invalid_format")
         if not response:
             response = f"That format isn't quite right. {get_format_instructions(current_question['format'], current_question.get('options'))}"
 
         return jsonify({'error': response}), 400
 
-    # Store answer
-    survey['answers'].append({
+    # Store answer, unless another request already answered this question or restarted the survey
+    survey = survey_state.advance_survey(user_id, survey['survey_id'], current_index, {
         'question': current_question['question'],
         'answer': message,
         'format': current_question['format']
     })
-    survey['current_question'] += 1
+    if survey is None:
+        return jsonify({'error': 'This question was already answered'}), 409
 
     # Check if survey is complete
     if survey['current_question'] >= len(survey['questions']):
@@ -413,11 +494,11 @@ def handle_dm():
 
         print("SURVEY IS COMPLETE", survey);
 
-        response = generate_human_response(json.dumps(context), "completion")
+        response = await generate_human_response(json.dumps(context), "completion")
         if not response:
             response = "Thank you for completing the survey! Your responses have been recorded."
 
-        del active_surveys[user_id]  # Clear the survey data
+        survey_state.end_survey(user_id, survey['survey_id'])  # Clear the survey data
         return jsonify({
             'success': True,
             'message': response
@@ -432,7 +513,7 @@ def handle_dm():
         "format": get_format_instructions(next_question['format'], next_question.get('options'))
     }
 
-    response = generate_human_response(json.dumps(context), "next_question")
+    response = await generate_human_response(json.dumps(context), "next_question")
     if not response:
         response = f"{next_question['question']} {get_format_instructions(next_question['format'], next_question.get('options'))}"
 
@@ -459,12 +540,23 @@ def validate_response(response, format, options=None):
         return options and response.upper() in options
     return False
 
+@app.route('/api/llm-stats', methods=['GET'])
+def llm_stats():
+    """Return latency, token and error counters for each LLM call site."""
+    api_key = request.args.get('api_key') or request.headers.get('X-API-Key')
+
+    if not api_key or not survey_state.has_api_key(api_key):
+        return jsonify({'error': 'Invalid API key'}), 401
+
+    return jsonify(gateway.snapshot())
+
 @app.route('/api/generate-questions', methods=['POST'])
-def generate_survey_questions():
+@limit_in_flight
+async def generate_survey_questions():
     data = request.json
     api_key = data.get('api_key')
 
-    if not api_key or api_key not in api_keys:
+    if not api_key or not survey_state.has_api_key(api_key):
         return jsonify({'error': 'Invalid API key'}), 401
 
     topic = data.get('topic')
@@ -477,21 +569,23 @@ def generate_survey_questions():
     if not 1 <= num_questions <= 20:
         return jsonify({'error': 'Number of questions must be between 1 and 20'}), 400
 
-    questions = generate_questions(topic, num_questions, requirements)
+    questions = await generate_questions(topic, num_questions, requirements)
 
     if questions is None:
         return jsonify({'error': 'Failed to generate questions'}), 500
 
     # Store the generated questions
-    api_keys[api_key]['questions'] = questions
+    form_id = publish_questions(api_key, questions)
 
     return jsonify({
         'success': True,
-        'questions': questions
+        'questions': questions,
+        'form_id': form_id
     })
 
 @app.route('/api/translate-questions', methods=['POST'])
-def translate_questions():
+@limit_in_flight
+async def translate_questions():
     """Endpoint to translate natural language survey descriptions into structured questions."""
     try:
         data = request.json
@@ -500,7 +594,7 @@ def translate_questions():
         api_key = data.get('api_key')
         description = data.get('description')
 
-        if not api_key or api_key not in api_keys:
+        if not api_key or not survey_state.has_api_key(api_key):
             print(f"Invalid API key: {api_key}")
             return jsonify({'error': 'Invalid API key'}), 401
 
@@ -509,7 +603,7 @@ def translate_questions():
             return jsonify({'error': 'Survey description is required'}), 400
 
         print(f"Processing description: {description}")
-        questions = translate_natural_language_to_questions(description)
+        questions = await translate_natural_language_to_questions(description)
 
         if questions is None:
             print("Failed to generate questions from description")
@@ -518,11 +612,12 @@ def translate_questions():
         print(f"Successfully generated questions: {questions}")
 
         # Store the generated questions
-        api_keys[api_key]['questions'] = questions
+        form_id = publish_questions(api_key, questions)
 
         return jsonify({
             'success': True,
             'questions': questions,
+            'form_id': form_id,
             'message': 'Survey questions generated successfully'
         })
     except Exception as e: